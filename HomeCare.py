@@ -1,17 +1,53 @@
 import os
+import re
 import json
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+import heapq
+import bisect
+import math
+import cProfile
+import io
+import pstats
+import sys
+import functools
+import hashlib
+import hmac
+import operator
+import itertools
+import shutil
+import signal
+import uuid
+import contextvars
+from array import array
+from collections import Counter as StackCounter, OrderedDict, deque, namedtuple
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, __version_info__ as PTB_VERSION
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ConversationHandler,
     ContextTypes,
+    PersistenceInput,
+    TypeHandler,
 )
 from telegram.ext.filters import TEXT, COMMAND
 
+logger = logging.getLogger(__name__)
+
 # Define all conversation states
 (
     MAIN_MENU,              # 0
@@ -48,6 +84,18 @@ from telegram.ext.filters import TEXT, COMMAND
     DOCTOR_ALERT           # 20
 ) = range(21)
 
+STATE_NAMES = (
+    "MAIN_MENU", "VITAL_SIGNS_MENU", "ENTER_VITAL_SIGN_VALUE",
+    "ENTER_PAIN_SCORE", "ENTER_PAIN_LOCATION", "ENTER_PAIN_TYPE", "ENTER_PAIN_SYMPTOMS",
+    "RESPIRATORY_SYSTEM", "GASTROINTESTINAL_SYSTEM", "CONSCIOUSNESS",
+    "EMOTIONAL_STATUS_MENU", "ENTER_EMOTIONAL_STATUS", "PROBLEM_MENU", "ENTER_PROBLEM_DESCRIPTION",
+    "WOUND_HEALING_MENU", "ENTER_WOUND_INFO", "SLEEP_PATTERN", "SLEEP_POSITION",
+    "QOR_ASSESSMENT_MENU", "ENTER_QOR_RESPONSE", "DOCTOR_ALERT",
+)
+
+# Bot token (set your bot token from BotFather here)
+BOT_TOKEN = ""
+
 # Doctor chat ID (set your actual doctor's chat ID here)
 DOCTOR1_CHAT_ID = ""
 DOCTOR2_CHAT_ID = ""
@@ -61,272 +109,4021 @@ PARAMETER_RANGES = {
     "temperature": {"max": 37.5, "unit": "°C"},
 }
 
+# Findings whose doctor alerts are sent ahead of every other message
+CRITICAL_FINDINGS = ["unresponsive", "no_breadthe", "impaired_consciousness"]
+
+# Record types of the yes/no problem menus and symptom submenus
+PROBLEM_RECORD_TYPES = [
+    "respiratory", "gastrointestinal", "medication_compliance", "postop_adaptation",
+    "stocking_socks", "diet_compliance", "activity_adaptation", "daily_mobilization",
+    "social_adaptation", "shower", "return_to_work", "driving", "sleep_pattern", "sleep_position",
+]
+# Of those, the symptom submenus, whose description is the callback data of a button
+SYMPTOM_RECORD_TYPES = ["respiratory", "gastrointestinal", "sleep_pattern", "sleep_position"]
+# Submenu symptoms that can wait for the doctor digest; every other reported problem is alerted
+ROUTINE_SYMPTOMS = ["constipation", "no_appetite", "falling_asleep", "short_time", "feeling_tired", "back", "side"]
+
 # Patient data storage
-DATA_DIR = "patient_data"
+DATA_DIR = os.environ.get("HOMECARE_DATA_DIR", "patient_data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# Record store backend: "jsonl" (one log file per patient) or "sqlite"
+RECORD_STORE = os.environ.get("HOMECARE_RECORD_STORE", "jsonl")
+SQLITE_PATH = os.path.join(DATA_DIR, "records.db")
+SQLITE_BATCH_SIZE = 200        # records per transaction
+SQLITE_COMMIT_INTERVAL = 1.0   # max seconds a record waits for its commit
+
+# Records per entry of the sparse timestamp index of each JSONL log
+RECORD_INDEX_INTERVAL = 64
+# Patients whose JSONL index and vital stats stay in memory, least recently used evicted
+RECORD_CACHE_PATIENTS = 1024
+
+# Bulk export: patients per worker task and rows buffered per table part
+EXPORT_CHUNK_PATIENTS = 100
+EXPORT_BATCH_ROWS = 10000
+
+# Progress of the legacy patient_<id>.json migration, one line per patient
+MIGRATION_CHECKPOINT_PATH = os.path.join(DATA_DIR, "migration_checkpoint.jsonl")
+# SQLite migration workers take turns on the write lock; each retries "database is locked"
+MIGRATION_LOCK_TIMEOUT = 60.0      # seconds one attempt waits for the lock
+MIGRATION_LOCK_RETRIES = 10
+
+# Clinical alert rules (JSON, see DEFAULT_RULES). Without the file the
+# built-in defaults apply; changes are picked up every RULES_POLL_INTERVAL seconds.
+RULES_PATH = os.environ.get("HOMECARE_RULES_PATH", os.path.join(DATA_DIR, "rules.json"))
+RULES_POLL_INTERVAL = 5
+
+# Care teams (JSON, see CareTeams): which chats get a patient's alerts at what
+# time. Without the file all alerts go to DOCTOR1_CHAT_ID and DOCTOR2_CHAT_ID.
+CARE_TEAMS_PATH = os.environ.get("HOMECARE_CARE_TEAMS_PATH", os.path.join(DATA_DIR, "care_teams.json"))
+CARE_TEAMS_POLL_INTERVAL = 5
+
+# Weight of the newest reading in the per-patient vital sign EWMA
+VITAL_EWMA_ALPHA = 0.3
+
+# Write-behind queue between the handlers and the record store.
+# RECORD_DURABILITY must be one of:
+#   "commit"   - handlers wait until the group commit holding their record
+#                has been written (the event loop keeps serving other patients)
+#   "buffered" - handlers return as soon as the record is queued; it is
+#                written by the next group commit and flushed on shutdown,
+#                but lost if the process is killed before that
+RECORD_DURABILITY = os.environ.get("HOMECARE_RECORD_DURABILITY", "commit")
+RECORD_QUEUE_SIZE = 10000      # queued records before handlers wait for the writer
+RECORD_BATCH_SIZE = 500        # max records per group commit
+RECORD_WRITE_RETRIES = 5       # retries of a failing group commit before it is given up
+# Records of a group commit that could not be written are appended here
+UNWRITTEN_RECORDS_PATH = os.path.join(DATA_DIR, "unwritten_records.jsonl")
+
+# Doctor alert outbox
+ALERT_OUTBOX_PATH = os.path.join(DATA_DIR, "alert_outbox.jsonl")
+ALERT_RETRY_BASE = 1.0         # seconds before the first retry of a failed send
+ALERT_RETRY_MAX = 300.0        # cap on the retry delay
+ALERT_OUTBOX_COMPACT_SIZE = 1024 * 1024  # truncate the drained outbox past this size
+
+# Repeated alerts about the same patient and parameter within
+# ALERT_COALESCE_WINDOW seconds update the first alert message in place
+# instead of sending new ones; 0 disables coalescing.
+ALERT_COALESCE_WINDOW = float(os.environ.get("HOMECARE_ALERT_COALESCE_WINDOW", "900"))
+ALERT_COALESCE_MAX_WINDOWS = 10000   # open windows kept in memory, oldest closed first
+ALERT_COALESCE_MAX_REPORTS = 10      # latest reports listed in a coalesced alert
+
+# Findings of rule priority "digest" are sent to each care team as one digest
+# every DIGEST_INTERVAL hours (counted from midnight); 0 alerts them at once
+DIGEST_INTERVAL = float(os.environ.get("HOMECARE_DIGEST_INTERVAL", "4"))
+DIGEST_PATH = os.path.join(DATA_DIR, "digest.jsonl")
+DIGEST_MAX_FINDINGS_PER_PATIENT = 20   # distinct findings listed per patient
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Vital sign trend checks (require numpy). Every TREND_CHECK_INTERVAL hours the
+# last TREND_WINDOW_DAYS of each patient's readings are compared with their own
+# TREND_BASELINE_DAYS before that; 0 disables the periodic check.
+TREND_CHECK_INTERVAL = float(os.environ.get("HOMECARE_TREND_CHECK_INTERVAL", "6"))
+TREND_WINDOW_DAYS = 3
+TREND_BASELINE_DAYS = 14
+TREND_MIN_READINGS = 3         # readings needed in both the window and the baseline
+TREND_Z_THRESHOLD = 2.5        # window mean vs baseline mean, in baseline SDs
+# When each patient and parameter was last alerted, so a restart does not repeat trend alerts
+TREND_ALERTS_PATH = os.path.join(DATA_DIR, "trend_alerts.json")
+TREND_ALERTS_MAX = 10000       # remembered alerts, oldest forgotten first
+
+# Outbound rate limits (Telegram allows about 30 messages/s overall and
+# about 1 message/s per chat)
+RATE_LIMIT_GLOBAL = 30.0       # messages per second across all chats
+RATE_LIMIT_GLOBAL_BURST = 30
+RATE_LIMIT_PER_CHAT = 1.0      # messages per second to one chat
+RATE_LIMIT_PER_CHAT_BURST = 3
+RATE_LIMIT_MAX_RETRIES = 3     # resends of a request after a RetryAfter
+
+# Send priorities, passed as rate_limit_args={"priority": ...}; lower goes first
+PRIORITY_CRITICAL = 0          # life-threatening findings
+PRIORITY_ALERT = 1             # other doctor alerts
+PRIORITY_ROUTINE = 2           # replies and menu edits
+PRIORITY_BULK = 3              # scheduled reminders
+
+# Patient reminders. Reminders due within REMINDER_HORIZON seconds are loaded
+# from REMINDER_DB_PATH every REMINDER_LOAD_INTERVAL seconds; occurrences
+# missed by more than REMINDER_MAX_LATE seconds are skipped, not sent late
+REMINDER_DB_PATH = os.path.join(DATA_DIR, "reminders.db")
+REMINDER_HORIZON = 600
+REMINDER_LOAD_INTERVAL = 60
+REMINDER_BATCH_SIZE = 200      # reminders handed to the rate limiter at a time
+REMINDER_MAX_LATE = 3600
+
+# Conversation persistence: changed sessions are written every
+# SESSION_FLUSH_INTERVAL seconds and loaded on a patient's first update
+SESSION_DB_PATH = os.path.join(DATA_DIR, "sessions.db")
+SESSION_FLUSH_INTERVAL = 5
+
+# Sessions without updates for SESSION_IDLE_TIMEOUT seconds are dropped from
+# memory and the store, ending their conversation; 0 keeps them forever
+SESSION_IDLE_TIMEOUT = float(os.environ.get("HOMECARE_SESSION_IDLE_TIMEOUT", str(6 * 3600)))
+SESSION_EVICT_INTERVAL = 300   # seconds between checks for idle sessions
+
+# Updates of different chats are handled by up to UPDATE_WORKERS concurrent
+# workers, each chat's updates strictly in order; 1 handles one at a time
+UPDATE_WORKERS = int(os.environ.get("HOMECARE_UPDATE_WORKERS", "32"))
+
+# Duplicate updates: update and message IDs remembered, and the time within
+# which a second tap on the same button of the same message is ignored
+UPDATE_DEDUP_SIZE = 20000
+UPDATE_DEDUP_TAP_WINDOW = 3.0
+# The recent update IDs, one per line, so redeliveries after a restart are dropped too
+UPDATE_IDS_PATH = os.path.join(DATA_DIR, "update_ids.jsonl")
+
+# Webhook mode. WEBHOOK_URL is the public HTTPS address Telegram posts to; it
+# must route to WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH. All replicas behind
+# a load balancer need the same WEBHOOK_SECRET.
+WEBHOOK_LISTEN = os.environ.get("HOMECARE_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("HOMECARE_WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_URL = os.environ.get("HOMECARE_WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.environ.get("HOMECARE_WEBHOOK_SECRET", "")
+
+# Prometheus metrics endpoint (http://METRICS_LISTEN:METRICS_PORT/metrics); 0 disables it
+METRICS_LISTEN = os.environ.get("HOMECARE_METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("HOMECARE_METRICS_PORT", "9464"))
+
+# Chats allowed to use admin commands such as /profile (comma separated)
+ADMIN_CHAT_IDS = [chat_id for chat_id in os.environ.get("HOMECARE_ADMIN_CHAT_IDS", "").split(",") if chat_id]
+
+# Handler profiling (see /profile); results are written to PROFILE_DIR
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+PROFILE_SAMPLE_INTERVAL = 0.002  # seconds between stack samples in collapsed mode
+
 # ======================
-# KEYBOARD DEFINITIONS
+# PROFILING
 # ======================
 
-def main_menu_keyboard():
-    """Create the main menu keyboard with all options from the Word doc"""
-    return [
-        [InlineKeyboardButton("1. Vital Signs", callback_data='vital_signs')],
-        [InlineKeyboardButton("2. Pain Assessment", callback_data='pain')],
-        [InlineKeyboardButton("3. Respiratory System", callback_data='respiratory')],
-        [InlineKeyboardButton("4. Gastrointestinal", callback_data='gastrointestinal')],
-        [InlineKeyboardButton("5. Consciousness", callback_data='consciousness')],
-        [InlineKeyboardButton("6. Emotional Status", callback_data='emotional_status')],
-        [InlineKeyboardButton("7. Medication Compliance", callback_data='medication_compliance')],
-        [InlineKeyboardButton("8. Wound Healing", callback_data='wound_healing')],
-        [InlineKeyboardButton("9. Post-op Adaptation", callback_data='postop_adaptation')],
-        [InlineKeyboardButton("10. Stocking Socks Use", callback_data='stocking_socks')],
-        [InlineKeyboardButton("11. Diet Compliance", callback_data='diet_compliance')],
-        [InlineKeyboardButton("12. Activity Adaptation", callback_data='activity_adaptation')],
-        [InlineKeyboardButton("13. Daily Mobilization", callback_data='daily_mobilization')],
-        [InlineKeyboardButton("14. Social Life Adaptation", callback_data='social_adaptation')],
-        [InlineKeyboardButton("15. Shower", callback_data='shower')],
-        [InlineKeyboardButton("16. Return to Work", callback_data='return_to_work')],
-        [InlineKeyboardButton("17. Driving", callback_data='driving')],
-        [InlineKeyboardButton("18. Sleep Pattern", callback_data='sleep_pattern')],
-        [InlineKeyboardButton("19. Sleeping Position", callback_data='sleep_position')],
-        [InlineKeyboardButton("20. Postoperative Quality of Recovery", callback_data='postoperative_quality_of_recovery')]
-    ]
+class SampleGate:
+    """Reader/writer gate letting a sampled handler call run alone.
 
-def back_only_keyboard(target):
-    return [[InlineKeyboardButton("◀ Back", callback_data=f'back_to_{target}')]]
+    Unsampled calls run concurrently. A sampled call waits until the calls
+    in flight have finished and then runs by itself; while it waits or runs,
+    new calls wait for it, so a steady stream of unsampled calls cannot keep
+    it waiting forever.
+    """
 
-def problem_menu_keyboard():
-    return [
-        [InlineKeyboardButton("No problem", callback_data='no_problem')],
-        [InlineKeyboardButton("There is a problem", callback_data='problem')],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
-    ]
+    def __init__(self):
+        self._running = 0          # unsampled calls in flight
+        self._sampled = False      # a sampled call is running
+        self._sampled_waiting = 0  # sampled calls waiting for the others to finish
+        self._waiters = []         # futures of calls waiting for a release
+
+    async def _wait(self, ready):
+        while not ready():
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+            await future
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    async def acquire(self, sampled: bool):
+        if not sampled:
+            await self._wait(lambda: not self._sampled and not self._sampled_waiting)
+            self._running += 1
+            return
+        self._sampled_waiting += 1
+        try:
+            await self._wait(lambda: not self._running and not self._sampled)
+        finally:
+            self._sampled_waiting -= 1
+            self._wake()
+        self._sampled = True
+
+    def release(self, sampled: bool):
+        if sampled:
+            self._sampled = False
+        else:
+            self._running -= 1
+        self._wake()
+
+class UpdateProfiler:
+    """Opt-in profiler for handler calls, switched on and off at runtime.
+
+    In "sample" mode every handler call of one update in `every` is profiled
+    from start to finish, including the storage and alert I/O it awaits; in
+    "window" mode everything on the event loop is profiled for a number of
+    seconds. Results are aggregated until stop() and written either as a
+    pstats file (format "pstats", from cProfile) or as collapsed stacks for
+    flamegraph tools (format "collapsed", from a thread sampling the event
+    loop's stack every PROFILE_SAMPLE_INTERVAL seconds).
+
+    Whether an update is sampled is decided at its first handler call and
+    kept in a context variable, so it holds for all of the update's calls
+    even when updates are handled concurrently. cProfile and the stack
+    sampler see everything on the event loop, so while sample mode is on, a
+    SampleGate runs each sampled call alone and its profile is not mixed
+    with other updates' handlers; unsampled calls still run concurrently.
+    """
+
+    # (update_id, sampled) of the update whose handlers run in this context
+    _decision = contextvars.ContextVar('profiled_update', default=None)
+
+    FORMATS = ("pstats", "collapsed")
+
+    def __init__(self, directory: str = PROFILE_DIR, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.mode = None
+        self.format = None
+        self.every = 0
+        self.calls = 0
+        self.started = None
+        self._profile = None       # cProfile of the window, or of the call in flight
+        self._stats = None         # pstats aggregated over sampled calls
+        self._stacks = StackCounter()
+        self._sampling = threading.Event()
+        self._sampler = None
+        self._window_timer = None
+        self._on_window_end = None
+        self._report_task = None
+        self._loop_thread = None
+        self._updates = 0
+        self._gate = None          # SampleGate of the handler calls in sample mode
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode is not None
+
+    def start(self, mode: str, value: float, fmt: str = "pstats", on_window_end=None):
+        """Start "sample" mode (1 update in `value`) or a `value` second "window".
+
+        When the window ends, `on_window_end(path)` (a coroutine function) is
+        run with the file written, or None if nothing was profiled.
+        """
+        if self.enabled:
+            raise ValueError("Profiling is already running")
+        if mode not in ("sample", "window") or fmt not in self.FORMATS:
+            raise ValueError(f"Unknown profiling mode or format: {mode} {fmt}")
+        if not 0 < value < float('inf'):
+            raise ValueError("The sampling rate and window length must be positive")
+        if mode == "sample" and int(value) < 1:
+            raise ValueError("The sampling rate must be at least 1 update")
+        self.mode, self.format = mode, fmt
+        self.every = int(value) if mode == "sample" else 0
+        self.calls = 0
+        self._updates = 0
+        self._gate = SampleGate() if mode == "sample" else None
+        self.started = time.monotonic()
+        self._stats = None
+        self._stacks = StackCounter()
+        self._loop_thread = threading.get_ident()
+        if fmt == "collapsed":
+            self._sampler = threading.Thread(target=self._sample_stacks, name="stack-sampler", daemon=True)
+            self._sampler.start()
+        if mode == "window":
+            if fmt == "pstats":
+                self._profile = cProfile.Profile()
+                self._profile.enable()
+            else:
+                self._sampling.set()
+            self._on_window_end = on_window_end
+            self._window_timer = asyncio.get_running_loop().call_later(value, self._end_window)
+
+    def _end_window(self):
+        self._window_timer = None
+        on_window_end, self._on_window_end = self._on_window_end, None
+        path = self.stop()
+        if on_window_end is not None:
+            self._report_task = asyncio.ensure_future(on_window_end(path))
+
+    def stop(self):
+        """Stop profiling and write the results; returns the file written, if any."""
+        if not self.enabled:
+            return None
+        if self._window_timer is not None:
+            self._window_timer.cancel()
+            self._window_timer = None
+        self._on_window_end = None
+        if self.mode == "window" and self._profile is not None:
+            self._profile.disable()
+            self._add_profile(self._profile)
+            self._profile = None
+        mode, fmt = self.mode, self.format
+        self.mode = None
+        self._sampling.clear()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"profile-{datetime.now():%Y%m%d-%H%M%S}-{mode}"
+        if fmt == "pstats":
+            if self._stats is None:
+                return None
+            path = os.path.join(self.directory, name + ".prof")
+            self._stats.dump_stats(path)
+        else:
+            if not self._stacks:
+                return None
+            path = os.path.join(self.directory, name + ".collapsed")
+            with open(path, 'w') as f:
+                for stack, count in self._stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        logger.info("Wrote %s profile of %d handler calls to %s", mode, self.calls, path)
+        return path
+
+    def summary(self, limit: int = 15) -> str:
+        """Top functions by cumulative time (pstats) or top stacks (collapsed)."""
+        if self._stats is not None and self.format != "collapsed":
+            stream = io.StringIO()
+            self._stats.stream = stream
+            self._stats.sort_stats('cumulative').print_stats(limit)
+            return stream.getvalue()
+        total = sum(self._stacks.values()) or 1
+        return "\n".join(f"{100 * count / total:5.1f}% {stack.rsplit(';', 1)[-1]}"
+                         for stack, count in self._stacks.most_common(limit))
+
+    async def call(self, callback, update, context):
+        """Run a handler callback, profiling it if this update is sampled."""
+        if self.mode == "window":
+            self.calls += 1
+            return await callback(update, context)
+        update_id = getattr(update, 'update_id', None)
+        decision = self._decision.get()
+        if decision is None or decision[0] != update_id:
+            # Decide once per update so all of its handler calls are profiled
+            self._updates += 1
+            decision = (update_id, self._updates % self.every == 0)
+            self._decision.set(decision)
+        gate, sampled = self._gate, decision[1]
+        if gate is None:
+            return await callback(update, context)
+        await gate.acquire(sampled)
+        try:
+            if self.mode != "sample" or not sampled:
+                return await callback(update, context)
+            return await self._profile_call(callback, update, context)
+        finally:
+            gate.release(sampled)
+
+    async def _profile_call(self, callback, update, context):
+        self.calls += 1
+        if self.format == "collapsed":
+            self._sampling.set()
+            try:
+                return await callback(update, context)
+            finally:
+                self._sampling.clear()
+        profile = self._profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return await callback(update, context)
+        finally:
+            profile.disable()
+            self._profile = None
+            self._add_profile(profile)
+
+    def _add_profile(self, profile):
+        if self._stats is None:
+            self._stats = pstats.Stats(profile)
+        else:
+            self._stats.add(profile)
+
+    def _sample_stacks(self):
+        while self.mode is not None:
+            if not self._sampling.wait(0.1):
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self._stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+update_profiler = UpdateProfiler()
 
 # ======================
-# HANDLER FUNCTIONS
+# METRICS
 # ======================
+# Counters, gauges and histograms kept as plain numbers in memory and rendered
+# in the Prometheus text format on METRICS_PORT. Updating one costs a dict
+# lookup and an addition (plus a bisect for histograms); all updates happen on
+# the event loop thread.
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Start the conversation and show main menu."""
-    user = update.message.from_user
-    context.user_data['patient_id'] = user.id
-    
-    await update.message.reply_text(
-        "🏥 Home Care Monitoring\nPlease select a parameter to report:",
-        reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
-    )
-    return MAIN_MENU
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
-async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handle all main menu options from the Word doc"""
-    query = update.callback_query
-    await query.answer()
-    
-    if query.data == 'vital_signs':
-        reply_markup = InlineKeyboardMarkup(vital_signs_menu_keyboard())
-        await query.edit_message_text(
-            text="Select vital sign to report:",
-            reply_markup=reply_markup
-        )
-        return VITAL_SIGNS_MENU
-    
-    elif query.data == 'pain':
-        await query.edit_message_text(
-            "What is your pain score numerical rating (0 - 10)?\n"
-            "(0 = No pain, 5 = Moderate pain, 10 = Worst possible pain)",
-            reply_markup=InlineKeyboardMarkup(back_only_keyboard('main'))
-        )
-        return ENTER_PAIN_SCORE
-    
-    elif query.data == 'respiratory':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(respiratory_menu_keyboard())
-        await query.edit_message_text(
-            "Do you breathe well or there is a problem?\n",
-            reply_markup=reply_markup
-        )
-        return RESPIRATORY_SYSTEM
-    
-    elif query.data == 'gastrointestinal':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(gastrointestinal_menu_keyboard())
-        await query.edit_message_text(
-            "Do you eat well or there is a problem?\n",
-            reply_markup=reply_markup
-        )
-        return GASTROINTESTINAL_SYSTEM
-    
-    elif query.data == 'consciousness':
-        await query.edit_message_text(
-            "Describe your alertness level:\n"
-            "(e.g., fully alert, drowsy, confused)\n"
-            "OR are you oriented to time, place, and person?\n"
-            "(e.g., 'I know who/where/when I am')\n"
-            "Reply with Okay(Open conscious), confused or unresposive",
-            reply_markup=InlineKeyboardMarkup(back_only_keyboard('main'))
-        )
-        return CONSCIOUSNESS
-    
-    elif query.data == 'emotional_status':
-        await query.edit_message_text(
-            "How would you describe your emotional state today?\n"
-            "(e.g., anxious, calm, depressed, happy)",
-            reply_markup=InlineKeyboardMarkup(back_only_keyboard('main'))
-        )
-        return EMOTIONAL_STATUS_MENU
-        
-    elif query.data == 'medication_compliance':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(problem_menu_keyboard())
-        await query.edit_message_text(
-            "Have you taken all medications as prescribed today?\n",
-            reply_markup=reply_markup
-        )
-        return PROBLEM_MENU
-        
-    elif query.data == 'wound_healing':
-        reply_markup = InlineKeyboardMarkup(wound_healing_menu_keyboard())
-        await query.edit_message_text(
-            "Choose any of the following issues related to wound healing.?\n",
-            reply_markup=reply_markup
-        )
-        return WOUND_HEALING_MENU
-        
-    elif query.data == 'postop_adaptation':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(problem_menu_keyboard())
-        await query.edit_message_text(
-            "How are you adapting to post-operative requirements?\n"
-            "(Please describe if there are any problems)",
-            reply_markup=reply_markup
-        )
-        return PROBLEM_MENU
-    
-    elif query.data == 'stocking_socks':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(problem_menu_keyboard())
-        await query.edit_message_text(
-            "Have you been using your compression stockings as recommended?\n"
-            "(Please describe usage duration if there are any problems)",
-            reply_markup=reply_markup
-        )
-        return PROBLEM_MENU
-        
-    elif query.data == 'diet_compliance':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(problem_menu_keyboard())
-        await query.edit_message_text(
-            "How is your diet compliance?\n"
-            "(Please describe what you've eaten and any issues)",
-            reply_markup=reply_markup
-        )
-        return PROBLEM_MENU
-        
-    elif query.data == 'activity_adaptation':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(problem_menu_keyboard())
-        await query.edit_message_text(
-            "How are you adapting to recommended activity levels?\n"
-            "(Describe your activities and any difficulties)",
-            reply_markup=reply_markup
-        )
-        return PROBLEM_MENU
-        
-    elif query.data == 'daily_mobilization':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(problem_menu_keyboard())
-        await query.edit_message_text(
-            "Describe your daily mobility:\n"
-            "(How often do you get up and move around?)",
-            reply_markup=reply_markup
-        )
-        return PROBLEM_MENU
-        
-    elif query.data == 'social_adaptation':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(problem_menu_keyboard())
-        await query.edit_message_text(
-            "How are you adapting socially since your procedure?\n"
-            "(Describe any social activities or isolation)",
-            reply_markup=reply_markup
-        )
-        return PROBLEM_MENU
-        
-    elif query.data == 'shower':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(problem_menu_keyboard())
-        await query.edit_message_text(
-            "Have you been able to shower independently?\n"
-            "(Describe any difficulties)",
-            reply_markup=reply_markup
-        )
-        return PROBLEM_MENU
-        
-    elif query.data == 'return_to_work':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(problem_menu_keyboard())
-        await query.edit_message_text(
-            "What is your status regarding returning to work?\n"
-            "(Describe any plans or limitations)",
-            reply_markup=reply_markup
-        )
-        return PROBLEM_MENU
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
 
-    elif query.data == 'driving':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(problem_menu_keyboard())
-        await query.edit_message_text(
-            "Have you been driving your car normally?\n"
-            "(Please describe if there are any problems)",
-            reply_markup=reply_markup
-        )
-        return PROBLEM_MENU
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Monotonic count per label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, labels=(), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+class Gauge(Counter):
+    """Current value per label values, set directly or read from a function at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self.function = function
+
+    def set(self, value: float, labels=()):
+        self.values[labels] = value
+
+    def samples(self):
+        if self.function is not None:
+            self.values = dict(self.function())
+        yield from super().samples()
+
+class Histogram:
+    """Observations per label values in cumulative buckets, with sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.bounds = tuple(buckets)
+        self.values = {}       # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, labels=()):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.bounds) + 1) + [0.0]
+        series[bisect.bisect_left(self.bounds, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for labels, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds + ("+Inf",), series):
+                cumulative += count
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.labelnames, labels, f'le="{bound}"'), cumulative)
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labels), series[-1]
+            yield f"{self.name}_count", _format_labels(self.labelnames, labels), cumulative
+
+class MetricsRegistry:
+    """The metrics exposed on the metrics endpoint."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.register(Histogram(
+    "homecare_handler_seconds", "Time spent in each update handler.", ("handler",)))
+HANDLER_ERRORS = metrics.register(Counter(
+    "homecare_handler_errors_total", "Exceptions raised by update handlers.", ("handler",)))
+RECORD_WRITE_LATENCY = metrics.register(Histogram(
+    "homecare_record_write_seconds", "Time to write one group commit to the record store."))
+RECORDS_WRITTEN = metrics.register(Counter(
+    "homecare_records_written_total", "Patient records written to the record store."))
+RECORD_WRITE_FAILURES = metrics.register(Counter(
+    "homecare_record_write_failures_total", "Patient records given up after RECORD_WRITE_RETRIES failed writes."))
+RECORD_QUEUE_DEPTH = metrics.register(Gauge(
+    "homecare_record_queue_depth", "Records waiting for the record writer."))
+ALERT_SEND_LATENCY = metrics.register(Histogram(
+    "homecare_alert_send_seconds", "Duration of doctor alert send attempts."))
+ALERT_DELIVERY_LATENCY = metrics.register(Histogram(
+    "homecare_alert_delivery_seconds", "Time from queueing a doctor alert to its delivery to one doctor.",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)))
+ALERT_SENDS = metrics.register(Counter(
+    "homecare_alert_sends_total", "Doctor alert send attempts by result.", ("result",)))
+ALERTS_PENDING = metrics.register(Gauge(
+    "homecare_alerts_pending", "Doctor alerts not yet delivered to every recipient."))
+ALERTS_COALESCED = metrics.register(Counter(
+    "homecare_alerts_coalesced_total", "Doctor alerts merged into an open alert message."))
+DIGEST_FINDINGS = metrics.register(Counter(
+    "homecare_digest_findings_total", "Non-urgent findings held for the doctor digest."))
+DIGESTS_SENT = metrics.register(Counter(
+    "homecare_digests_sent_total", "Doctor digest messages queued for sending."))
+BOT_API_CALLS = metrics.register(Counter(
+    "homecare_bot_api_calls_total", "Outbound Bot API calls by method.", ("method",)))
+BOT_API_FLOOD_WAITS = metrics.register(Counter(
+    "homecare_bot_api_flood_waits_total", "RetryAfter responses from the Bot API."))
+DUPLICATE_UPDATES = metrics.register(Counter(
+    "homecare_duplicate_updates_total", "Updates dropped as duplicates, by what matched.", ("kind",)))
+UPDATE_WAIT = metrics.register(Histogram(
+    "homecare_update_wait_seconds", "Time updates wait for earlier updates of their chat and a free worker."))
+REMINDERS_SENT = metrics.register(Counter(
+    "homecare_reminders_total", "Patient reminders by kind and result (sent, failed, skipped).", ("kind", "result")))
+REMINDERS_LOADED = metrics.register(Gauge(
+    "homecare_reminders_loaded", "Upcoming reminders held in the timer heap."))
+ACTIVE_CONVERSATIONS = metrics.register(Gauge(
+    "homecare_active_conversations", "Conversations held in memory, by state.", ("state",)))
+
+def timed_handler(callback):
+    """Wrap a handler callback to record its latency and exceptions (and profile it)."""
+    name = getattr(callback, '__name__', type(callback).__name__)
+    labels = (name,)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start_time = time.perf_counter()
+        try:
+            if update_profiler.enabled:
+                return await update_profiler.call(callback, update, context)
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(labels)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start_time, labels)
+    return wrapper
+
+def instrument_handlers(handlers):
+    """Time the callbacks of the given handlers, recursing into conversations."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        else:
+            handler.callback = timed_handler(handler.callback)
+
+def conversations_per_state(conv_handler: ConversationHandler) -> dict:
+    """Number of in-memory conversations of a conversation handler per state."""
+    counts = {(name,): 0 for name in STATE_NAMES}
+    for state in list(conversation_states(conv_handler).values()):
+        if isinstance(state, int) and 0 <= state < len(STATE_NAMES):
+            counts[(STATE_NAMES[state],)] += 1
+    return counts
+
+class MetricsServer:
+    """Minimal HTTP server answering GET /metrics with the registry."""
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        if self.port <= 0 or self._server is not None:
+            return
+        try:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as exc:
+            logger.warning("Metrics endpoint not started on %s:%d: %s", self.host, self.port, exc)
+            return
+        logger.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split('?')[0] == "/metrics":
+                status, body = "200 OK", self.registry.render().encode('utf-8')
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+metrics_server = MetricsServer(metrics, METRICS_LISTEN, METRICS_PORT)
+
+# ======================
+# RECORD STORAGE
+# ======================
+
+def _iso(value):
+    """Normalise a datetime or ISO string bound for timestamp comparisons."""
+    if value is None or isinstance(value, str):
+        return value
+    return value.isoformat()
+
+def append_lines(filename: str, data: bytes) -> int:
+    """Append newline-terminated lines to a file with one write and fsync.
+
+    If an earlier write was torn by a crash, the partial line is terminated
+    first so it cannot swallow the new data; readers skip it. Returns the
+    size of the file after the append.
+    """
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        if size:
+            os.lseek(fd, size - 1, os.SEEK_SET)
+            if os.read(fd, 1) != b"\n":
+                data = b"\n" + data
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+        os.fsync(fd)
+        return os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+def read_lines(filename: str, offset: int = 0):
+    """Yield the JSON objects of a JSON Lines file, skipping torn lines.
+
+    Reading starts at byte `offset`, which must be the start of a line.
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+def scan_lines(filename: str, offset: int = 0):
+    """Yield (start, end, obj) for each line of a JSON Lines file from `offset`.
+
+    `obj` is None for blank and torn lines, which still advance the offsets.
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            start, offset = offset, offset + len(line)
+            try:
+                obj = json.loads(line) if line.strip() else None
+            except ValueError:
+                obj = None
+            yield start, offset, obj
+
+def record_type_filter(record_type):
+    """Normalise a query's record_type (None, a type or an iterable of types)."""
+    if record_type is None:
+        return None
+    if isinstance(record_type, str):
+        return frozenset([record_type])
+    return frozenset(record_type)
+
+class SparseLogIndex:
+    """Sparse timestamp -> byte offset index of one JSON Lines log.
+
+    The log is cut into blocks of RECORD_INDEX_INTERVAL lines; each finished
+    block appends [start, end, min timestamp, max timestamp so far] to the
+    index file. Because the last field is a running maximum it is sorted, so
+    the first block that can hold a timestamp >= `since` is found by
+    bisection. Scanning can stop before the first block from which every
+    later timestamp is >= `until`. Records need not be in time order; out of
+    order timestamps only make the scanned span wider. Lines the index has
+    not seen yet (after a crash, or a missing index file) are indexed on load.
+    """
+
+    def __init__(self, path: str, log_path: str, interval: int = RECORD_INDEX_INTERVAL):
+        self.path = path
+        self.log_path = log_path
+        self.interval = interval
+        self.entries = []
+        self.maxima = []        # running maximum of each entry, the bisection keys
+        self.scanned = 0        # log bytes seen, including the unfinished block
+        self._running_max = ""
+        self._block = None      # [start, lines, min timestamp] of the unfinished block
+
+    def load(self):
+        """Read the index file and index whatever the log holds beyond it."""
+        entries, end, stale = [], 0, False
+        for entry in read_lines(self.path):
+            if stale or not isinstance(entry, list) or len(entry) != 4 or entry[0] != end:
+                stale = True
+                continue
+            entries.append(entry)
+            end = entry[1]
+        log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        if end > log_size:
+            entries, end, stale = [], 0, True
+        self.entries = entries
+        self.maxima = [entry[3] for entry in entries]
+        self.scanned = end
+        self._running_max = entries[-1][3] if entries else ""
+        self._block = None
+
+        new_entries = []
+        for start, stop, record in scan_lines(self.log_path, end):
+            timestamp = record.get('timestamp', '') if isinstance(record, dict) else None
+            entry = self.add(start, stop, timestamp)
+            if entry:
+                new_entries.append(entry)
+        if stale:
+            self._rewrite()
+        elif new_entries:
+            self.write(new_entries)
+
+    def add(self, start: int, end: int, timestamp):
+        """Account for the log line at [start, end); return a finished entry."""
+        self.scanned = end
+        if self._block is None:
+            self._block = [start, 0, None]
+        self._block[1] += 1
+        if timestamp is not None:
+            if self._block[2] is None or timestamp < self._block[2]:
+                self._block[2] = timestamp
+            self._running_max = max(self._running_max, timestamp)
+        if self._block[1] < self.interval:
+            return None
+        entry = [self._block[0], end, self._block[2] or "", self._running_max]
+        self.entries.append(entry)
+        self.maxima.append(entry[3])
+        self._block = None
+        return entry
+
+    def write(self, entries):
+        """Append finished entries to the index file."""
+        append_lines(self.path, b"".join(json.dumps(entry).encode('utf-8') + b"\n" for entry in entries))
+
+    def _rewrite(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry).encode('utf-8') + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def span(self, since=None, until=None):
+        """Byte range (start, stop) of the log that can hold records in [since, until).
+
+        `stop` is None when the scan has to run to the end of the log.
+        """
+        first = 0
+        if since is not None:
+            first = bisect.bisect_left(self.maxima, since)
+        start = self.entries[first][0] if first < len(self.entries) else (
+            self._block[0] if self._block else self.scanned)
+        if until is None:
+            return start, None
+        stop = suffix_min = None
+        if self._block is not None:
+            if self._block[2] is not None and self._block[2] < until:
+                return start, None
+            stop, suffix_min = self._block[0], self._block[2]
+        for i in range(len(self.entries) - 1, first - 1, -1):
+            entry_min = self.entries[i][2]
+            suffix_min = entry_min if suffix_min is None else min(suffix_min, entry_min)
+            if suffix_min < until:
+                break
+            stop = self.entries[i][0]
+        return start, stop
+
+def is_vital_record(record: dict) -> bool:
+    """Whether a record is a finite reading of one of the PARAMETER_RANGES vitals."""
+    if record.get('type') != 'vital_sign' or record.get('parameter') not in PARAMETER_RANGES:
+        return False
+    try:
+        return math.isfinite(float(record.get('value')))
+    except (TypeError, ValueError):
+        return False
+
+def update_vital_aggregate(aggregate, record: dict, alpha: float = VITAL_EWMA_ALPHA) -> dict:
+    """Return `aggregate` with one vital sign reading folded in, in O(1).
+
+    `aggregate` is None for a parameter's first reading. The running mean
+    and EWMA are updated incrementally; the out-of-range streak counts the
+    consecutive readings flagged out_of_range and resets on a normal one.
+    A NaN or infinite reading would poison every statistic and is skipped.
+    """
+    value = float(record['value'])
+    if not math.isfinite(value):
+        return aggregate
+    if aggregate is None:
+        aggregate = {
+            "count": 0, "min": value, "max": value, "mean": 0.0, "ewma": value,
+            "last_value": None, "last_time": None,
+            "out_of_range_streak": 0, "longest_out_of_range_streak": 0,
+        }
+    else:
+        aggregate = dict(aggregate)
+    aggregate['count'] += 1
+    aggregate['min'] = min(aggregate['min'], value)
+    aggregate['max'] = max(aggregate['max'], value)
+    aggregate['mean'] += (value - aggregate['mean']) / aggregate['count']
+    if aggregate['count'] > 1:
+        aggregate['ewma'] = alpha * value + (1 - alpha) * aggregate['ewma']
+    aggregate['last_value'] = value
+    aggregate['last_time'] = record.get('timestamp')
+    if record.get('out_of_range'):
+        aggregate['out_of_range_streak'] += 1
+        aggregate['longest_out_of_range_streak'] = max(
+            aggregate['longest_out_of_range_streak'], aggregate['out_of_range_streak'])
+    else:
+        aggregate['out_of_range_streak'] = 0
+    return aggregate
+
+def fold_vital_records(aggregates: dict, records) -> dict:
+    """Fold the vital sign readings among `records` into {parameter: aggregate}."""
+    for record in records:
+        if is_vital_record(record):
+            parameter = record['parameter']
+            aggregates[parameter] = update_vital_aggregate(aggregates.get(parameter), record)
+    return aggregates
+
+def cache_put(cache: OrderedDict, key, value, size: int):
+    """Store `value` as the most recently used entry of `cache`, evicting the least recently used beyond `size`."""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > size:
+        cache.popitem(last=False)
+
+class JsonlRecordStore:
+    """One append-only JSON Lines log per patient.
+
+    Each append is written with a single write on an O_APPEND descriptor and
+    fsync'd, so a report costs the same however long the history is. Legacy
+    patient_<id>.json files ({"records": [...]}) are read transparently and
+    come before the log.
+
+    Each log has a sparse timestamp index in patient_<id>.idx (see
+    SparseLogIndex), so time-range queries seek straight to the window.
+
+    Vital sign aggregates live in patient_<id>.stats.json together with the
+    log size they cover. A crash between the log append and the stats write
+    is repaired on the next load by folding in only the log tail past that
+    offset; a missing stats file is rebuilt from the history once.
+
+    Indexes and stats of the `cache_patients` most recently used patients
+    are kept in memory; evicted ones are loaded from their files again.
+    """
+
+    FILE_PATTERN = re.compile(r'^patient_(-?\d+)\.jsonl?$')
+
+    def __init__(self, directory: str, cache_patients: int = RECORD_CACHE_PATIENTS):
+        self.directory = directory
+        self.cache_patients = cache_patients
+        self._stats = OrderedDict()       # patient_id -> stats, least recently used first
+        self._stats_lock = threading.RLock()
+        self._indexes = OrderedDict()     # patient_id -> SparseLogIndex, least recently used first
+        self._index_lock = threading.RLock()
+
+    def log_path(self, patient_id: int) -> str:
+        return os.path.join(self.directory, f"patient_{patient_id}.jsonl")
+
+    def legacy_path(self, patient_id: int) -> str:
+        return os.path.join(self.directory, f"patient_{patient_id}.json")
+
+    def index_path(self, patient_id: int) -> str:
+        return os.path.join(self.directory, f"patient_{patient_id}.idx")
+
+    def stats_path(self, patient_id: int) -> str:
+        return os.path.join(self.directory, f"patient_{patient_id}.stats.json")
+
+    def append(self, patient_id: int, record: dict):
+        self.append_many([(patient_id, record)])
+
+    def append_many(self, items):
+        """Append (patient_id, record) pairs, one write and fsync per patient."""
+        lines, timestamps = {}, {}
+        for patient_id, record in items:
+            lines.setdefault(patient_id, []).append(
+                json.dumps(record, ensure_ascii=False).encode('utf-8') + b"\n"
+            )
+            timestamps.setdefault(patient_id, []).append(record.get('timestamp', ''))
+        sizes = {}
+        for patient_id, chunks in lines.items():
+            sizes[patient_id] = append_lines(self.log_path(patient_id), b"".join(chunks))
+
+        with self._index_lock:
+            for patient_id, chunks in lines.items():
+                index = self._log_index(patient_id)
+                start = sizes[patient_id] - sum(len(chunk) for chunk in chunks)
+                new_entries = []
+                for chunk, timestamp in zip(chunks, timestamps[patient_id]):
+                    end = start + len(chunk)
+                    if end > index.scanned:  # else the load above already indexed it
+                        entry = index.add(start, end, timestamp)
+                        if entry:
+                            new_entries.append(entry)
+                    start = end
+                if new_entries:
+                    index.write(new_entries)
+
+        vitals = {}
+        for patient_id, record in items:
+            if is_vital_record(record):
+                vitals.setdefault(patient_id, []).append(record)
+        with self._stats_lock:
+            for patient_id, records in vitals.items():
+                stats = self._vital_stats(patient_id)
+                if stats['log_offset'] >= sizes[patient_id]:
+                    continue  # the load above already read this batch from the log
+                stats = {
+                    "log_offset": sizes[patient_id],
+                    "parameters": fold_vital_records(dict(stats['parameters']), records),
+                }
+                self._write_stats(patient_id, stats)
+                cache_put(self._stats, patient_id, stats, self.cache_patients)
+
+    def load_index(self, patient_id: int):
+        """Load a patient's log index, indexing whatever its file is missing."""
+        with self._index_lock:
+            self._log_index(patient_id)
+
+    def _log_index(self, patient_id: int) -> SparseLogIndex:
+        index = self._indexes.get(patient_id)
+        if index is None:
+            index = SparseLogIndex(self.index_path(patient_id), self.log_path(patient_id))
+            index.load()
+        cache_put(self._indexes, patient_id, index, self.cache_patients)
+        return index
+
+    def _vital_stats(self, patient_id: int) -> dict:
+        """Cached vital sign aggregates of a patient, caught up with the log."""
+        stats = self._stats.get(patient_id)
+        if stats is not None:
+            self._stats.move_to_end(patient_id)
+            return stats
+        path = self.stats_path(patient_id)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                stats = json.load(f)
+        else:
+            stats = {"log_offset": 0, "parameters": {}}
+            legacy = self.legacy_path(patient_id)
+            if os.path.exists(legacy):
+                with open(legacy, 'r') as f:
+                    fold_vital_records(stats['parameters'], json.load(f).get('records', []))
+        log = self.log_path(patient_id)
+        size = os.path.getsize(log) if os.path.exists(log) else 0
+        if size > stats['log_offset']:
+            fold_vital_records(stats['parameters'], read_lines(log, stats['log_offset']))
+            stats['log_offset'] = size
+            self._write_stats(patient_id, stats)
+        cache_put(self._stats, patient_id, stats, self.cache_patients)
+        return stats
+
+    def _write_stats(self, patient_id: int, stats: dict):
+        path = self.stats_path(patient_id)
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(stats, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def vital_summary(self, patient_id: int) -> dict:
+        """Running aggregates of a patient's vital signs, keyed by parameter."""
+        with self._stats_lock:
+            return dict(self._vital_stats(patient_id)['parameters'])
+
+    def records(self, patient_id: int):
+        """Yield all records of a patient, oldest first."""
+        legacy = self.legacy_path(patient_id)
+        if os.path.exists(legacy):
+            with open(legacy, 'r') as f:
+                yield from json.load(f).get('records', [])
+
+        yield from read_lines(self.log_path(patient_id))
+
+    def patient_ids(self):
+        ids = set()
+        for name in os.listdir(self.directory):
+            match = self.FILE_PATTERN.match(name)
+            if match:
+                ids.add(int(match.group(1)))
+        return sorted(ids)
+
+    def query(self, patient_id=None, record_type=None, since=None, until=None):
+        """Yield (patient_id, record) pairs matching the filters, streamed.
+
+        `record_type` is a record type (e.g. "vital_sign" or a problem
+        parameter such as "respiratory") or an iterable of them; `since` and
+        `until` bound the timestamp as [since, until). Within each patient's
+        log only the byte range given by its sparse index is read, one line at
+        a time.
+        """
+        since, until = _iso(since), _iso(until)
+        types = record_type_filter(record_type)
+
+        def matches(record):
+            if types is not None and record.get('type') not in types:
+                return False
+            timestamp = record.get('timestamp', '')
+            if since is not None and timestamp < since:
+                return False
+            return until is None or timestamp < until
+
+        patient_ids = self.patient_ids() if patient_id is None else [patient_id]
+        for pid in patient_ids:
+            legacy = self.legacy_path(pid)
+            if os.path.exists(legacy):
+                with open(legacy, 'r') as f:
+                    for record in json.load(f).get('records', []):
+                        if matches(record):
+                            yield pid, record
+
+            if since is None and until is None:
+                start, stop = 0, None
+            else:
+                with self._index_lock:
+                    start, stop = self._log_index(pid).span(since, until)
+            for _, end, record in scan_lines(self.log_path(pid), start):
+                if isinstance(record, dict) and matches(record):
+                    yield pid, record
+                if stop is not None and end >= stop:
+                    break
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class SqliteRecordStore:
+    """Records in one SQLite database, indexed on (patient_id, type, timestamp).
+
+    The database runs in WAL mode and appends are grouped into transactions of
+    up to SQLITE_BATCH_SIZE records. A partially filled batch is committed at
+    most SQLITE_COMMIT_INTERVAL seconds after its first record, and on flush()
+    and close().
+
+    Vital sign aggregates are kept in the vital_stats table and updated in
+    the same transaction as the records they summarise; the in-memory cache
+    of the `cache_patients` most recently used patients only takes them
+    over once that transaction has committed. A database
+    created before the table existed has its aggregates rebuilt once on open.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY,
+            patient_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS records_patient_type_time
+            ON records (patient_id, type, timestamp);
+        CREATE TABLE IF NOT EXISTS vital_stats (
+            patient_id INTEGER NOT NULL,
+            parameter TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (patient_id, parameter)
+        );
+    """
+
+    def __init__(self, path: str, batch_size: int = SQLITE_BATCH_SIZE,
+                 commit_interval: float = SQLITE_COMMIT_INTERVAL,
+                 cache_patients: int = RECORD_CACHE_PATIENTS):
+        self.path = path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.cache_patients = cache_patients
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._timer = None
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._stats = OrderedDict()       # patient_id -> committed aggregates, least recently used first
+        self._uncommitted = {}     # (patient_id, parameter) -> aggregate of the open transaction
+        self._rebuild_vital_stats()
+
+    def append(self, patient_id: int, record: dict):
+        self.append_many([(patient_id, record)])
+
+    def append_many(self, items):
+        """Append (patient_id, record) pairs to the current batch."""
+        rows = [
+            (patient_id, record.get('type', ''), record.get('timestamp', ''),
+             json.dumps(record, ensure_ascii=False))
+            for patient_id, record in items
+        ]
+        if not rows:
+            return
+        with self._lock:
+            try:
+                if not self._conn.in_transaction:
+                    self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT INTO records (patient_id, type, timestamp, data) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                updated = {}
+                for patient_id, record in items:
+                    if is_vital_record(record):
+                        parameter = record['parameter']
+                        key = (patient_id, parameter)
+                        if key in updated:
+                            current = updated[key]
+                        elif key in self._uncommitted:
+                            current = self._uncommitted[key]
+                        else:
+                            current = self._vital_stats(patient_id).get(parameter)
+                        updated[key] = update_vital_aggregate(current, record)
+                if updated:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO vital_stats (patient_id, parameter, data) VALUES (?, ?, ?)",
+                        [(pid, parameter, json.dumps(aggregate))
+                         for (pid, parameter), aggregate in updated.items()],
+                    )
+            except Exception:
+                self._rollback()
+                raise
+            self._uncommitted.update(updated)
+            self._pending += len(rows)
+            if self._pending >= self.batch_size:
+                self._commit()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.commit_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _vital_stats(self, patient_id: int) -> dict:
+        """Cached vital sign aggregates of a patient, keyed by parameter."""
+        stats = self._stats.get(patient_id)
+        if stats is None:
+            rows = self._conn.execute(
+                "SELECT parameter, data FROM vital_stats WHERE patient_id = ?", (patient_id,)
+            ).fetchall()
+            stats = {parameter: json.loads(data) for parameter, data in rows}
+        cache_put(self._stats, patient_id, stats, self.cache_patients)
+        return stats
+
+    def _rebuild_vital_stats(self):
+        """Compute the aggregates from the records if the table is still empty."""
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM vital_stats LIMIT 1").fetchone():
+                return
+            aggregates = {}
+            cursor = self._conn.execute(
+                "SELECT patient_id, data FROM records WHERE type = 'vital_sign' ORDER BY id")
+            for patient_id, data in cursor:
+                fold_vital_records(aggregates.setdefault(patient_id, {}), [json.loads(data)])
+            rows = [(pid, parameter, json.dumps(aggregate))
+                    for pid, parameters in aggregates.items()
+                    for parameter, aggregate in parameters.items()]
+            if rows:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT INTO vital_stats (patient_id, parameter, data) VALUES (?, ?, ?)", rows)
+                self._conn.execute("COMMIT")
+
+    def vital_summary(self, patient_id: int) -> dict:
+        """Running aggregates of a patient's vital signs, keyed by parameter."""
+        with self._lock:
+            self._commit()
+            return dict(self._vital_stats(patient_id))
+
+    def _commit(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._conn.in_transaction:
+            try:
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._rollback()
+                raise
+        for (pid, parameter), aggregate in self._uncommitted.items():
+            self._vital_stats(pid)[parameter] = aggregate
+        self._uncommitted.clear()
+        self._pending = 0
+
+    def _rollback(self):
+        """Abandon the open transaction and the aggregates computed in it."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._conn.in_transaction:
+            self._conn.execute("ROLLBACK")
+        for patient_id, _ in self._uncommitted:
+            self._stats.pop(patient_id, None)  # may have been read inside the transaction
+        self._uncommitted.clear()
+        self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def records(self, patient_id: int):
+        """Yield all records of a patient, oldest first."""
+        for _, record in self.query(patient_id=patient_id):
+            yield record
+
+    def patient_ids(self):
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT patient_id FROM records ORDER BY patient_id").fetchall()
+        return [row[0] for row in rows]
+
+    def query(self, patient_id=None, record_type=None, since=None, until=None):
+        """Yield (patient_id, record) pairs matching the filters, streamed.
+
+        Filters are as for JsonlRecordStore.query(). Pending appends are
+        committed first; rows are streamed from a separate
+        read connection so writers are not blocked while the caller iterates.
+        """
+        self.flush()
+        clauses, params = [], []
+        for clause, value in (("patient_id = ?", patient_id),
+                              ("timestamp >= ?", _iso(since)), ("timestamp < ?", _iso(until))):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        types = record_type_filter(record_type)
+        if types is not None:
+            clauses.append(f"type IN ({', '.join('?' * len(types))})")
+            params.extend(sorted(types))
+        sql = "SELECT patient_id, data FROM records"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY id"
+
+        conn = sqlite3.connect(self.path)
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(500)
+                if not rows:
+                    break
+                for pid, data in rows:
+                    yield pid, json.loads(data)
+        finally:
+            conn.close()
+
+    def vital_columns(self, parameters, since: datetime):
+        """Yield (parameter index, patient_id, days after `since`, value) of vital signs since `since`.
+
+        The columns are extracted by SQLite in one pass; readings of other
+        parameters, without a numeric value or with JSON SQLite cannot parse
+        are skipped.
+        """
+        parameters = list(parameters)
+        index = " ".join(f"WHEN ? THEN {i}" for i in range(len(parameters)))
+        self.flush()
+        conn = sqlite3.connect(self.path)
+        try:
+            cursor = conn.execute(f"""
+                SELECT index_, patient_id, julianday(timestamp) - julianday(?), value FROM (
+                    SELECT patient_id, timestamp, json_extract(data, '$.value') AS value,
+                           CASE json_extract(data, '$.parameter') {index} END AS index_
+                    FROM records WHERE type = 'vital_sign' AND timestamp >= ? AND json_valid(data)
+                ) WHERE index_ IS NOT NULL AND typeof(value) IN ('integer', 'real')
+            """, (_iso(since), *parameters, _iso(since)))
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+def create_record_store(backend: str):
+    """Create the record store selected by RECORD_STORE."""
+    if backend == "jsonl":
+        return JsonlRecordStore(DATA_DIR)
+    if backend == "sqlite":
+        return SqliteRecordStore(SQLITE_PATH)
+    raise ValueError(f"Unknown record store backend: {backend!r}")
+
+record_store = create_record_store(RECORD_STORE)
+
+class RecordWriter:
+    """Background task that writes queued records to the store in groups.
+
+    Handlers put records on a bounded asyncio queue and return; the writer
+    drains whatever has accumulated (up to RECORD_BATCH_SIZE records) and
+    writes it with one append_many() and flush() on a dedicated thread, so
+    disk I/O never runs on the event loop. Before start() and after stop()
+    records are written straight through to the store.
+
+    A group commit that still fails after `retries` retries is given up:
+    its records are appended to UNWRITTEN_RECORDS_PATH for recovery and the
+    handlers waiting for them (in "commit" mode) get the error.
+    """
+
+    DURABILITY_MODES = ("buffered", "commit")
+
+    def __init__(self, store, durability: str = RECORD_DURABILITY,
+                 maxsize: int = RECORD_QUEUE_SIZE, batch_size: int = RECORD_BATCH_SIZE,
+                 retries: int = RECORD_WRITE_RETRIES):
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError(f"Unknown record durability mode: {durability!r}")
+        self.store = store
+        self.durability = durability
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.retries = retries
+        self.written = 0       # records written by the background writer
+        self.batches = 0       # group commits
+        self._queue = None
+        self._task = None
+        self._executor = None
+
+    async def start(self):
+        self._queue = asyncio.Queue(self.maxsize)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="record-writer")
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, patient_id: int, record: dict):
+        """Queue a record; in "commit" mode wait until it has been written."""
+        if self._task is None:
+            self.store.append(patient_id, record)
+            return
+        future = asyncio.get_running_loop().create_future() if self.durability == "commit" else None
+        await self._queue.put((patient_id, record, future))
+        if future is not None:
+            await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            items = [(patient_id, record) for patient_id, record, _ in batch]
+            error = None
+            for attempt in range(self.retries + 1):
+                try:
+                    start_time = time.perf_counter()
+                    await loop.run_in_executor(self._executor, self._write, items)
+                    RECORD_WRITE_LATENCY.observe(time.perf_counter() - start_time)
+                    RECORDS_WRITTEN.inc(amount=len(items))
+                    self.written += len(items)
+                    self.batches += 1
+                    error = None
+                    break
+                except Exception as exc:
+                    error = exc
+                    if attempt < self.retries:
+                        logger.warning("Writing %d records failed, retrying: %s", len(items), exc)
+                        await asyncio.sleep(min(2 ** attempt, 30))
+            if error is not None:
+                RECORD_WRITE_FAILURES.inc(amount=len(items))
+                logger.error("Giving up on %d records after %d attempts: %s",
+                             len(items), self.retries + 1, error)
+                await loop.run_in_executor(self._executor, self._set_aside, items)
+            for _, _, future in batch:
+                if future is not None and not future.done():
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+                self._queue.task_done()
+
+    def _write(self, items):
+        self.store.append_many(items)
+        self.store.flush()
+
+    def _set_aside(self, items):
+        try:
+            append_lines(UNWRITTEN_RECORDS_PATH, b"".join(
+                json.dumps({"patient_id": patient_id, "record": record}, ensure_ascii=False).encode('utf-8') + b"\n"
+                for patient_id, record in items))
+        except Exception:
+            logger.exception("Could not set aside %d unwritten records: %s", len(items), items)
+
+    def queued(self) -> int:
+        """Number of records waiting to be written."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def stop(self):
+        """Write everything still queued, then stop the writer."""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._executor.shutdown(wait=True)
+
+record_writer = RecordWriter(record_store)
+RECORD_QUEUE_DEPTH.function = lambda: {(): record_writer.queued()}
+
+# ======================
+# OUTBOUND RATE LIMITING
+# ======================
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.stamp) * self.rate >= self.capacity
+
+class DelayStats:
+    """Count, mean, max and approximate percentiles of queueing delays."""
+
+    BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(self.BOUNDS)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(self.BOUNDS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of samples."""
+        target = fraction * self.count
+        seen = 0
+        for bound, n in zip(self.BOUNDS, self.buckets):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Throttle outbound Bot API requests with global and per-chat token buckets.
+
+    Requests addressed to a chat wait until both the global bucket and the
+    chat's bucket have a token. Waiting requests are served by priority
+    (rate_limit_args={"priority": PRIORITY_...}, PRIORITY_ROUTINE by default)
+    and then in arrival order, so a critical alert overtakes queued menu
+    edits. A chat that is out of tokens never holds up other chats. Requests
+    without a chat_id (answerCallbackQuery, getMe, ...) are not throttled.
+    On RetryAfter all sends pause for the requested time and the request is
+    retried up to RATE_LIMIT_MAX_RETRIES times.
+    """
+
+    def __init__(self, global_rate: float = RATE_LIMIT_GLOBAL,
+                 global_burst: float = RATE_LIMIT_GLOBAL_BURST,
+                 chat_rate: float = RATE_LIMIT_PER_CHAT,
+                 chat_burst: float = RATE_LIMIT_PER_CHAT_BURST,
+                 max_retries: int = RATE_LIMIT_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_burst)
+        self._buckets = {}        # chat id -> TokenBucket
+        self._waiting = {}        # chat id -> heap of (priority, seq, future)
+        self._ready = []          # heap of (priority, seq, chat id) for chats with a token
+        self._timers = {}         # chat id -> TimerHandle until its bucket has a token
+        self._seq = 0
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._task = None
+        self.delays = {}          # priority -> DelayStats
+
+    async def initialize(self):
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+
+    def stats(self) -> dict:
+        """Queueing delay summary per priority."""
+        return {priority: stats.summary() for priority, stats in sorted(self.delays.items())}
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None or self._task is None:
+            return await callback(*args, **kwargs)
+
+        priority = PRIORITY_ROUTINE
+        if isinstance(rate_limit_args, dict):
+            priority = rate_limit_args.get('priority', PRIORITY_ROUTINE)
+
+        for attempt in range(self.max_retries + 1):
+            queued = time.monotonic()
+            await self._acquire(str(chat_id), priority)
+            self.delays.setdefault(priority, DelayStats()).observe(time.monotonic() - queued)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                BOT_API_FLOOD_WAITS.inc()
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_after_seconds(exc)
+                logger.warning("Flood limit hit on %s to %s, pausing sends for %.1fs",
+                               endpoint, chat_id, delay)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self._wakeup.set()
+
+    async def _acquire(self, chat_id: str, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        waiters = self._waiting.setdefault(chat_id, [])
+        heapq.heappush(waiters, (priority, self._seq, future))
+        if waiters[0][2] is future:
+            self._schedule(chat_id)
+        await future
+
+    def _schedule(self, chat_id: str):
+        """Put the head of a chat's queue on the ready heap once it has a token."""
+        waiters = self._waiting.get(chat_id)
+        if not waiters or chat_id in self._timers:
+            return
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        delay = bucket.delay(time.monotonic())
+        if delay:
+            self._timers[chat_id] = asyncio.get_running_loop().call_later(
+                delay, self._timer_fired, chat_id
+            )
+            return
+        priority, seq, _ = waiters[0]
+        heapq.heappush(self._ready, (priority, seq, chat_id))
+        self._wakeup.set()
+
+    def _timer_fired(self, chat_id: str):
+        del self._timers[chat_id]
+        self._schedule(chat_id)
+
+    async def _run(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            delay = max(self._paused_until - now, self._global.delay(now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            waiters = self._waiting.get(chat_id)
+            if not waiters or waiters[0][1] != seq:
+                continue    # stale: a higher-priority request became the head
+            _, _, future = heapq.heappop(waiters)
+            if not future.done():
+                self._global.take()
+                self._buckets[chat_id].take()
+                future.set_result(None)
+            if waiters:
+                self._schedule(chat_id)
+            else:
+                del self._waiting[chat_id]
+                if len(self._buckets) > 10000:
+                    self._prune(now)
+
+    def _prune(self, now: float):
+        """Drop buckets of idle chats; a fresh bucket starts full anyway."""
+        for chat_id in [c for c, b in self._buckets.items()
+                        if c not in self._waiting and b.full(now)]:
+            del self._buckets[chat_id]
+
+
+def retry_after_seconds(exc: Exception):
+    """Seconds to wait from a RetryAfter error, or None for other errors."""
+    retry_after = getattr(exc, 'retry_after', None)
+    if retry_after is None:
+        return None
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+class AlertOutbox:
+    """Persistent outbox for doctor alerts.
+
+    enqueue() appends the alert to a JSON Lines log before returning, and a
+    background dispatcher delivers it to all recipients concurrently. Failed
+    sends are retried with exponential backoff (honouring Telegram's
+    RetryAfter), and every successful delivery is logged. On start() the log
+    is replayed and compacted, so alerts not yet delivered to every recipient
+    survive a restart. Delivery is at-least-once: a crash between a send and
+    its log entry resends that alert. Permanent errors (bot blocked, chat not
+    found) are not retried: the chat is logged as undeliverable and the
+    alert is escalated to DOCTOR1_CHAT_ID and DOCTOR2_CHAT_ID.
+
+    The text of an editable alert can be replaced with update(): recipients
+    still waiting get the new text, and messages already delivered are
+    edited in place (best effort, latest text only) until release().
+    """
+
+    def __init__(self, path: str, retry_base: float = ALERT_RETRY_BASE,
+                 retry_max: float = ALERT_RETRY_MAX):
+        self.path = path
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._pending = {}     # alert id -> alert with the recipients still to deliver
+        self._lock = threading.Lock()
+        self._bot = None
+        self._queue = None
+        self._task = None
+        self._deliveries = set()
+        self._texts = {}       # editable alert id -> (latest text, priority)
+        self._sent = {}        # editable alert id -> {chat_id: [message_id, text shown]}
+        self._edits = {}       # editable alert id -> task editing its messages
+
+    def _append(self, events):
+        data = b"".join(json.dumps(event, ensure_ascii=False).encode('utf-8') + b"\n" for event in events)
+        with self._lock:
+            append_lines(self.path, data)
+
+    def _mark_delivered(self, alert_id: str, chat_id: str, error: str = None):
+        event = {"event": "delivered", "id": alert_id, "chat_id": chat_id}
+        if error is not None:
+            event["error"] = error
+        with self._lock:
+            append_lines(self.path, json.dumps(event).encode('utf-8') + b"\n")
+            if not self._pending and os.path.getsize(self.path) > ALERT_OUTBOX_COMPACT_SIZE:
+                open(self.path, 'wb').close()
+
+    def _load(self):
+        """Rebuild the pending alerts from the log and rewrite it with only those."""
+        pending = {}
+        for event in read_lines(self.path):
+            if event.get('event') == 'queued':
+                pending[event['id']] = dict(event, recipients=list(event['recipients']))
+            elif event.get('event') == 'updated' and event.get('id') in pending:
+                pending[event['id']].update(text=event['text'], priority=event['priority'])
+            elif event.get('event') == 'delivered' and event.get('id') in pending:
+                alert = pending[event['id']]
+                if event['chat_id'] in alert['recipients']:
+                    alert['recipients'].remove(event['chat_id'])
+                if not alert['recipients']:
+                    del pending[event['id']]
+
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as f:
+            for alert in pending.values():
+                f.write(json.dumps(alert, ensure_ascii=False).encode('utf-8') + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return pending
+
+    async def start(self, bot):
+        """Replay undelivered alerts and start the dispatcher."""
+        loop = asyncio.get_running_loop()
+        self._bot = bot
+        self._pending = await loop.run_in_executor(None, self._load)
+        self._queue = asyncio.Queue()
+        for alert_id in self._pending:
+            self._queue.put_nowait(alert_id)
+        if self._pending:
+            logger.info("Replaying %d undelivered doctor alerts", len(self._pending))
+        self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, text: str, recipients, priority: int = PRIORITY_ALERT,
+                      editable: bool = False, escalated: bool = False):
+        """Durably record an alert for delivery to the given chat IDs and return its ID."""
+        recipients = [str(chat_id) for chat_id in recipients if chat_id]
+        if not recipients:
+            logger.warning("Doctor alert has no recipients: %s", text)
+            return None
+        alert = {
+            "event": "queued",
+            "id": uuid.uuid4().hex,
+            "text": text,
+            "recipients": recipients,
+            "priority": priority,
+            "created": datetime.now().isoformat(),
+        }
+        if escalated:
+            alert["escalated"] = True
+        # Pending before it is logged, so a delivery logged meanwhile by
+        # another alert cannot compact the log under it
+        self._pending[alert['id']] = dict(alert, recipients=list(recipients))
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._append, [alert])
+        except BaseException:
+            del self._pending[alert['id']]
+            raise
+        if editable:
+            self._texts[alert['id']] = (text, priority)
+            self._sent[alert['id']] = {}
+        if self._queue is not None:
+            self._queue.put_nowait(alert['id'])
+        return alert['id']
+
+    async def update(self, alert_id: str, text: str, priority: int = PRIORITY_ALERT):
+        """Replace the text of an editable alert for every recipient."""
+        alert = self._pending.get(alert_id)
+        if alert is not None:
+            alert.update(text=text, priority=priority)
+            await asyncio.get_running_loop().run_in_executor(None, self._append, [
+                {"event": "updated", "id": alert_id, "text": text, "priority": priority}
+            ])
+        if alert_id in self._sent:
+            self._texts[alert_id] = (text, priority)
+            self._schedule_edit(alert_id)
+
+    def release(self, alert_id: str):
+        """Stop tracking the delivered messages of an editable alert."""
+        self._texts.pop(alert_id, None)
+        self._sent.pop(alert_id, None)
+
+    def _schedule_edit(self, alert_id: str):
+        if alert_id not in self._edits:
+            task = asyncio.create_task(self._edit(alert_id))
+            self._edits[alert_id] = task
+            task.add_done_callback(lambda _: self._edits.pop(alert_id, None))
+
+    async def _edit(self, alert_id: str):
+        """Bring every delivered message of an alert up to its latest text."""
+        while True:
+            text, priority = self._texts.get(alert_id, (None, None))
+            sent = self._sent.get(alert_id)
+            if text is None or sent is None:
+                return
+            stale = [(chat_id, shown) for chat_id, shown in sent.items() if shown[1] != text]
+            if not stale:
+                return
+            await asyncio.gather(*(
+                self._edit_message(alert_id, chat_id, shown, text, priority) for chat_id, shown in stale
+            ))
+
+    async def _edit_message(self, alert_id: str, chat_id: str, shown: list, text: str, priority: int):
+        try:
+            await self._bot.edit_message_text(
+                text, chat_id=chat_id, message_id=shown[0], rate_limit_args={"priority": priority},
+            )
+        except BadRequest as exc:
+            if "not modified" not in str(exc).lower():
+                logger.warning("Could not update alert %s in %s: %s", alert_id, chat_id, exc)
+        except Exception as exc:
+            logger.warning("Could not update alert %s in %s: %s", alert_id, chat_id, exc)
+        shown[1] = text
+
+    async def _run(self):
+        while True:
+            alert_id = await self._queue.get()
+            alert = self._pending.get(alert_id)
+            if alert is None:
+                continue
+            task = asyncio.create_task(self._deliver(alert))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, alert: dict):
+        await asyncio.gather(*(
+            self._deliver_to(alert, chat_id) for chat_id in list(alert['recipients'])
+        ))
+
+    async def _deliver_to(self, alert: dict, chat_id: str):
+        attempt = 0
+        while True:
+            start_time = time.perf_counter()
+            text = alert['text']
+            try:
+                message = await self._bot.send_message(
+                    chat_id=chat_id, text=text,
+                    rate_limit_args={"priority": alert.get('priority', PRIORITY_ALERT)},
+                )
+                ALERT_SEND_LATENCY.observe(time.perf_counter() - start_time)
+                ALERT_SENDS.inc(("success",))
+                break
+            except (Forbidden, BadRequest) as exc:
+                ALERT_SEND_LATENCY.observe(time.perf_counter() - start_time)
+                ALERT_SENDS.inc(("failure",))
+                logger.error("Alert %s cannot be delivered to %s: %s", alert['id'], chat_id, exc)
+                await self._undeliverable(alert, chat_id, exc)
+                return
+            except Exception as exc:
+                ALERT_SEND_LATENCY.observe(time.perf_counter() - start_time)
+                ALERT_SENDS.inc(("failure",))
+                delay = retry_after_seconds(exc)
+                if delay is None:
+                    delay = min(self.retry_base * 2 ** attempt, self.retry_max)
+                attempt += 1
+                logger.warning("Alert %s to %s failed (attempt %d), retrying in %.0fs: %s",
+                               alert['id'], chat_id, attempt, delay, exc)
+                await asyncio.sleep(delay)
+
+        ALERT_DELIVERY_LATENCY.observe(
+            (datetime.now() - datetime.fromisoformat(alert['created'])).total_seconds())
+        self._done(alert, chat_id)
+        sent = self._sent.get(alert['id'])
+        if sent is not None:
+            sent[chat_id] = [message.message_id, text]
+            if alert['text'] != text:
+                self._schedule_edit(alert['id'])
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._mark_delivered, alert['id'], chat_id
+        )
+
+    def _done(self, alert: dict, chat_id: str):
+        if chat_id in alert['recipients']:
+            alert['recipients'].remove(chat_id)
+        if not alert['recipients']:
+            self._pending.pop(alert['id'], None)
+
+    async def _undeliverable(self, alert: dict, chat_id: str, exc: Exception):
+        """Give up on one recipient of an alert and escalate the alert."""
+        self._done(alert, chat_id)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._mark_delivered, alert['id'], chat_id, str(exc)
+        )
+        if alert.get('escalated'):
+            return
+        escalation = [c for c in (DOCTOR1_CHAT_ID, DOCTOR2_CHAT_ID) if c and str(c) != chat_id]
+        if not escalation:
+            logger.error("Alert %s was not delivered to %s and there is nobody to escalate to",
+                         alert['id'], chat_id)
+            return
+        await self.enqueue(f"⚠️ Undeliverable to chat {chat_id} ({exc}):\n\n{alert['text']}",
+                           escalation, alert.get('priority', PRIORITY_ALERT), escalated=True)
+
+    async def stop(self):
+        """Stop the dispatcher; undelivered alerts are replayed on the next start."""
+        if self._task is None:
+            return
+        tasks = [self._task, *self._deliveries, *self._edits.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+alert_outbox = AlertOutbox(ALERT_OUTBOX_PATH)
+
+class AlertWindow:
+    """Open coalescing window of the alerts about one patient and parameter."""
+
+    __slots__ = ('alert_id', 'opened', 'priority', 'count', 'reports')
+
+    def __init__(self, alert_id: str, priority: int, max_reports: int):
+        self.alert_id = alert_id
+        self.opened = time.monotonic()
+        self.priority = priority
+        self.count = 0
+        self.reports = deque(maxlen=max_reports)   # (time, text) of the latest reports
+
+class AlertCoalescer:
+    """Merge repeated doctor alerts about the same patient and parameter.
+
+    The first alert for a key opens a window of `window` seconds and is sent
+    as usual. Later alerts for the key within the window do not send new
+    messages; they replace the text of the first one with a summary of the
+    latest reports, which the outbox edits in place. A more urgent alert
+    opens a new window, so it still reaches the escalation chats, and a
+    critical alert is never merged: an edit does not notify anyone. At most
+    `max_windows` windows stay open, the oldest are closed first.
+    """
+
+    def __init__(self, outbox: AlertOutbox, window: float = ALERT_COALESCE_WINDOW,
+                 max_windows: int = ALERT_COALESCE_MAX_WINDOWS,
+                 max_reports: int = ALERT_COALESCE_MAX_REPORTS):
+        self.outbox = outbox
+        self.window = window
+        self.max_windows = max_windows
+        self.max_reports = max_reports
+        self._windows = OrderedDict()    # key -> AlertWindow, oldest first
+
+    def _close_windows(self):
+        now = time.monotonic()
+        while self._windows:
+            window = next(iter(self._windows.values()))
+            if now - window.opened < self.window and len(self._windows) < self.max_windows:
+                break
+            self._windows.popitem(last=False)
+            self.outbox.release(window.alert_id)
+
+    def format(self, header: str, window: AlertWindow) -> str:
+        if window.count == 1:
+            return f"🚨 PATIENT ALERT\n{header}\n{window.reports[0][1]}"
+        first = datetime.now() - timedelta(seconds=time.monotonic() - window.opened)
+        lines = [f"🚨 PATIENT ALERT ({window.count} reports since {first:%H:%M})", header]
+        if window.count > len(window.reports):
+            lines.append(f"({window.count - len(window.reports)} earlier reports not shown)")
+        for reported, text in window.reports:
+            lines.append(f"\n{reported:%H:%M}\n{text}")
+        return "\n".join(lines)
+
+    async def submit(self, key, header: str, text: str, recipients, priority: int = PRIORITY_ALERT):
+        """Send an alert, or merge it into the open window of its key."""
+        if self.window <= 0:
+            await self.outbox.enqueue(f"🚨 PATIENT ALERT\n{header}\n{text}", recipients, priority)
+            return
+        self._close_windows()
+        window = self._windows.get(key)
+        if window is not None and priority >= window.priority and priority > PRIORITY_CRITICAL:
+            window.count += 1
+            window.reports.append((datetime.now(), text))
+            ALERTS_COALESCED.inc()
+            if window.alert_id is not None:    # else the opening alert is still being queued
+                await self.outbox.update(window.alert_id, self.format(header, window), window.priority)
+            return
+
+        if window is not None:
+            del self._windows[key]
+            self.outbox.release(window.alert_id)
+        window = AlertWindow(None, priority, self.max_reports)
+        window.count = 1
+        window.reports.append((datetime.now(), text))
+        self._windows[key] = window
+        alert_id = await self.outbox.enqueue(self.format(header, window), recipients, priority, editable=True)
+        if self._windows.get(key) is not window:
+            self.outbox.release(alert_id)
+            return
+        if alert_id is None:
+            del self._windows[key]
+            return
+        window.alert_id = alert_id
+        if window.count > 1:
+            await self.outbox.update(alert_id, self.format(header, window), window.priority)
+
+alert_coalescer = AlertCoalescer(alert_outbox)
+ALERTS_PENDING.function = lambda: {(): len(alert_outbox._pending)}
+
+# ======================
+# DOCTOR DIGEST
+# ======================
+# Findings of rule priority "digest" are not alerted one by one. They are
+# logged to DIGEST_PATH and sent to each care team as one message every
+# DIGEST_INTERVAL hours, grouped by patient.
+
+def next_digest_time(now: datetime, hours: float) -> datetime:
+    """The next multiple of `hours` after midnight, at the latest the next midnight."""
+    midnight = datetime(now.year, now.month, now.day)
+    step = timedelta(hours=hours)
+    return min(midnight + step * (int((now - midnight) / step) + 1), midnight + timedelta(days=1))
+
+class DoctorDigest:
+    """Collect non-urgent findings and send them as periodic digests.
+
+    add() appends the findings of a record to a JSON Lines log, so they
+    survive a restart. At every digest time the findings are grouped by
+    care team (see CareTeams.team_of), formatted into one digest per team,
+    split at Telegram's message size limit, and queued in the alert outbox
+    at PRIORITY_ROUTINE; a "sent" event then marks them done. A crash between
+    the two sends that digest again.
+    """
+
+    def __init__(self, outbox: AlertOutbox, path: str = DIGEST_PATH,
+                 interval_hours: float = DIGEST_INTERVAL,
+                 max_per_patient: int = DIGEST_MAX_FINDINGS_PER_PATIENT):
+        self.outbox = outbox
+        self.path = path
+        self.interval_hours = interval_hours
+        self.max_per_patient = max_per_patient
+        self._entries = []     # {"seq", "patient_id", "time", "findings"} not yet sent
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._task = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval_hours > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _append(self, events):
+        data = b"".join(json.dumps(event, ensure_ascii=False).encode('utf-8') + b"\n" for event in events)
+        with self._lock:
+            append_lines(self.path, data)
+
+    def _mark_sent(self, seq: int):
+        with self._lock:
+            if self._entries:
+                append_lines(self.path, json.dumps({"event": "sent", "seq": seq}).encode('utf-8') + b"\n")
+            else:
+                open(self.path, 'wb').close()
+
+    def _load(self):
+        """Read the findings not yet sent and rewrite the log with only those."""
+        entries = []
+        for event in read_lines(self.path):
+            if event.get('event') == 'finding':
+                entries.append(event)
+            elif event.get('event') == 'sent':
+                entries = [entry for entry in entries if entry['seq'] > event['seq']]
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return entries
+
+    async def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        self._entries = await asyncio.get_running_loop().run_in_executor(None, self._load)
+        self._seq = max((entry['seq'] for entry in self._entries), default=0)
+        if self._entries:
+            logger.info("%d findings waiting for the next doctor digest", len(self._entries))
+        self._task = asyncio.create_task(self._run())
+
+    async def add(self, patient_id: int, findings):
+        """Hold the findings of one record for the next digest."""
+        self._seq += 1
+        entry = {
+            "event": "finding",
+            "seq": self._seq,
+            "patient_id": patient_id,
+            "time": datetime.now().isoformat(),
+            "findings": [[finding.parameter, finding.value, finding.detail] for finding in findings],
+        }
+        self._entries.append(entry)
+        DIGEST_FINDINGS.inc(amount=len(findings))
+        await asyncio.get_running_loop().run_in_executor(None, self._append, [entry])
+
+    def format(self, entries, team: str = None) -> list:
+        """Digest messages for the entries of one team, each within TELEGRAM_MESSAGE_LIMIT."""
+        patients = {}         # patient ID -> {(parameter, value, detail): [count, last time]}
+        for entry in entries:
+            reported = datetime.fromisoformat(entry['time'])
+            findings = patients.setdefault(entry['patient_id'], {})
+            for parameter, value, detail in entry['findings']:
+                seen = findings.setdefault((parameter, str(value), detail), [0, reported])
+                seen[0] += 1
+                seen[1] = max(seen[1], reported)
+
+        sections = []
+        for patient_id, findings in patients.items():
+            lines = [f"Patient ID: {patient_id}"]
+            for (parameter, value, detail), (count, last) in list(findings.items())[:self.max_per_patient]:
+                line = f"{last:%H:%M} {parameter.replace('_', ' ')}: {value}"
+                if detail:
+                    line += f" ({detail})"
+                if count > 1:
+                    line += f" ×{count}"
+                lines.append(line)
+            if len(findings) > self.max_per_patient:
+                lines.append(f"({len(findings) - self.max_per_patient} more findings not shown)")
+            sections.append("\n".join(lines))
+
+        first = min(datetime.fromisoformat(entry['time']) for entry in entries)
+        header = f"📋 DIGEST since {first:%d.%m %H:%M}" + (f" ({team})" if team else "")
+        header += f"\n{sum(len(entry['findings']) for entry in entries)} non-urgent findings, {len(patients)} patients"
+        messages, text = [], header
+        for section in sections:
+            if len(text) + 2 + len(section) > TELEGRAM_MESSAGE_LIMIT:
+                messages.append(text)
+                text = "📋 DIGEST (continued)"
+            text += "\n\n" + section[:TELEGRAM_MESSAGE_LIMIT - len(text) - 2]
+        messages.append(text)
+        return messages
+
+    async def send(self):
+        """Send a digest of the held findings to every care team with any."""
+        # Findings added while the digest is being queued wait for the next one
+        entries = list(self._entries)
+        if not entries:
+            return 0
+        seq = entries[-1]['seq']
+        groups = {}            # team name -> entries of its patients
+        for entry in entries:
+            team = care_teams.team_of(entry['patient_id'])
+            groups.setdefault(team.name if team else None, []).append(entry)
+        sent = 0
+        for team, team_entries in groups.items():
+            recipients = care_teams.recipients(team_entries[0]['patient_id'], PRIORITY_ROUTINE)
+            for text in self.format(team_entries, team):
+                await self.outbox.enqueue(text, recipients, PRIORITY_ROUTINE)
+                sent += 1
+        DIGESTS_SENT.inc(amount=sent)
+        self._entries = [entry for entry in self._entries if entry['seq'] > seq]
+        await asyncio.get_running_loop().run_in_executor(None, self._mark_sent, seq)
+        return sent
+
+    async def _run(self):
+        while True:
+            now = datetime.now()
+            await asyncio.sleep((next_digest_time(now, self.interval_hours) - now).total_seconds())
+            try:
+                await self.send()
+            except Exception:
+                logger.exception("Doctor digest failed")
+
+    async def stop(self):
+        """Stop the timer; held findings are sent with the first digest after a restart."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+doctor_digest = DoctorDigest(alert_outbox)
+
+# ======================
+# VITAL SIGN TRENDS
+# ======================
+# Range checks only look at single readings. The trend check loads the recent
+# vitals of the whole cohort into NumPy arrays and computes, per patient and
+# parameter, the mean and SD of a baseline period, the mean and least-squares
+# slope of the latest window, and the window's z-score against the baseline,
+# using grouped sums (np.bincount) instead of loops over patients.
+
+TrendFinding = namedtuple('TrendFinding', [
+    'patient_id', 'parameter', 'zscore', 'slope', 'slope_percentile',
+    'recent_mean', 'baseline_mean', 'readings',
+])
+
+def load_vital_arrays(store, since: datetime) -> dict:
+    """Load vital signs recorded since `since` as {parameter: (patient_ids, days, values)}.
+
+    `days` is the reading time in days after `since`. A store with
+    vital_columns() (SQLite) extracts the columns itself and they are read
+    straight into arrays with np.fromiter. JSON Lines logs have to be parsed
+    line by line anyway; their timestamps are collected as strings and
+    converted in one vectorised step.
+    """
+    import numpy as np
+
+    if hasattr(store, 'vital_columns'):
+        parameters = list(PARAMETER_RANGES)
+        rows = np.fromiter(itertools.chain.from_iterable(store.vital_columns(parameters, since)),
+                           dtype=np.float64).reshape(-1, 4)
+        rows = rows[np.isfinite(rows[:, 3])]
+        arrays = {}
+        for index, parameter in enumerate(parameters):
+            selected = rows[rows[:, 0] == index]
+            if len(selected):
+                arrays[parameter] = (selected[:, 1].astype(np.int64), selected[:, 2], selected[:, 3])
+        return arrays
+
+    columns = {}
+    for patient_id, record in store.query(record_type='vital_sign', since=since):
+        value = record.get('value')
+        timestamp = record.get('timestamp')
+        if (record.get('parameter') in PARAMETER_RANGES and isinstance(value, (int, float))
+                and isinstance(timestamp, str)):
+            patient_ids, timestamps, values = columns.setdefault(record['parameter'], (array('q'), [], array('d')))
+            patient_ids.append(patient_id)
+            timestamps.append(timestamp)
+            values.append(value)
+    arrays = {}
+    origin = np.datetime64(since.replace(tzinfo=None), 'us')
+    for parameter, (patient_ids, timestamps, values) in columns.items():
+        try:
+            stamps = np.array(timestamps, dtype='datetime64[us]')
+        except ValueError:
+            stamps = np.array([datetime.fromisoformat(t).replace(tzinfo=None) for t in timestamps],
+                              dtype='datetime64[us]')
+        values = np.frombuffer(values, dtype=np.float64)
+        finite = np.isfinite(values)
+        arrays[parameter] = (np.frombuffer(patient_ids, dtype=np.int64)[finite],
+                             ((stamps - origin) / np.timedelta64(1, 'D'))[finite], values[finite])
+    return arrays
+
+def analyze_vital_trends(store, now: datetime = None,
+                         window_days: float = TREND_WINDOW_DAYS,
+                         baseline_days: float = TREND_BASELINE_DAYS,
+                         min_readings: int = TREND_MIN_READINGS,
+                         z_threshold: float = TREND_Z_THRESHOLD):
+    """Find patients whose vital signs are drifting away from their own baseline.
+
+    A patient is flagged when the mean of the last `window_days` deviates from
+    the mean of the `baseline_days` before by at least `z_threshold` baseline
+    SDs and the window's slope points the same way. Parameters with only a
+    maximum in PARAMETER_RANGES are flagged on rises only. Baseline SDs are
+    floored at the cohort median, so a near-constant baseline does not turn
+    every small change into an alert.
+
+    Returns (findings, cohort): the TrendFindings, largest deviation first,
+    and per parameter the number of patients analysed with the 5th/50th/95th
+    cohort percentiles of the window mean and slope.
+    """
+    import numpy as np
+
+    now = now or datetime.now()
+    since = now - timedelta(days=window_days + baseline_days)
+    findings, cohort = [], {}
+    for parameter, (patient_ids, days, values) in load_vital_arrays(store, since).items():
+        patients, group = np.unique(patient_ids, return_inverse=True)
+        count = len(patients)
+        recent = days >= baseline_days
+        baseline = ~recent
+
+        def group_sum(mask, weights=None):
+            return np.bincount(group[mask], None if weights is None else weights[mask], minlength=count)
+
+        baseline_n = group_sum(baseline)
+        baseline_mean = group_sum(baseline, values) / np.maximum(baseline_n, 1)
+        baseline_sd = np.sqrt(group_sum(baseline, (values - baseline_mean[group]) ** 2)
+                              / np.maximum(baseline_n - 1, 1))
+
+        # Least-squares slope of each patient's window, in units per day
+        t = days - baseline_days
+        recent_n = group_sum(recent)
+        sum_t, sum_v = group_sum(recent, t), group_sum(recent, values)
+        sum_tt, sum_tv = group_sum(recent, t * t), group_sum(recent, t * values)
+        recent_mean = sum_v / np.maximum(recent_n, 1)
+        denominator = recent_n * sum_tt - sum_t ** 2
+        slope = np.divide(recent_n * sum_tv - sum_t * sum_v, denominator,
+                          out=np.zeros(count), where=denominator > 1e-12)
+
+        eligible = (baseline_n >= min_readings) & (recent_n >= min_readings)
+        if not eligible.any():
+            continue
+        sd_floor = max(float(np.median(baseline_sd[eligible])), 1e-9)
+        zscore = (recent_mean - baseline_mean) / np.maximum(baseline_sd, sd_floor)
+        ranked_slopes = np.sort(slope[eligible])
+        slope_percentile = 100.0 * np.searchsorted(ranked_slopes, slope, side='right') / len(ranked_slopes)
+
+        value_p = np.percentile(recent_mean[eligible], (5, 50, 95))
+        slope_p = np.percentile(slope[eligible], (5, 50, 95))
+        cohort[parameter] = {
+            "patients": int(eligible.sum()),
+            "mean_p5": float(value_p[0]), "mean_p50": float(value_p[1]), "mean_p95": float(value_p[2]),
+            "slope_p5": float(slope_p[0]), "slope_p50": float(slope_p[1]), "slope_p95": float(slope_p[2]),
+        }
+
+        flagged = (zscore >= z_threshold) & (slope > 0)
+        if 'min' in PARAMETER_RANGES[parameter]:
+            flagged |= (zscore <= -z_threshold) & (slope < 0)
+        for i in np.flatnonzero(eligible & flagged):
+            findings.append(TrendFinding(
+                int(patients[i]), parameter, float(zscore[i]), float(slope[i]),
+                float(slope_percentile[i]), float(recent_mean[i]), float(baseline_mean[i]),
+                int(recent_n[i] + baseline_n[i]),
+            ))
+    findings.sort(key=lambda finding: -abs(finding.zscore))
+    return findings, cohort
+
+def format_trend_alert(finding: TrendFinding, window_days: float = TREND_WINDOW_DAYS) -> str:
+    """Doctor alert text for a trend finding."""
+    unit = PARAMETER_RANGES[finding.parameter].get('unit', '')
+    return (
+        f"📈 TREND ALERT\n"
+        f"Patient ID: {finding.patient_id}\n"
+        f"Parameter: {finding.parameter.replace('_', ' ')}\n"
+        f"Mean of the last {window_days:g} days: {finding.recent_mean:.1f}{unit} "
+        f"(baseline {finding.baseline_mean:.1f}{unit}, z = {finding.zscore:+.1f})\n"
+        f"Trend: {finding.slope:+.2f}{unit} per day "
+        f"({finding.slope_percentile:.0f}th percentile of patients)"
+    )
+
+class TrendMonitor:
+    """Background task running the trend check every TREND_CHECK_INTERVAL hours.
+
+    The analysis runs on a worker thread so report handling is not stalled.
+    A trend already reported is not alerted again within TREND_WINDOW_DAYS.
+    The times of those alerts are kept in `alerts_path` (at most
+    TREND_ALERTS_MAX, older than TREND_WINDOW_DAYS dropped), so a restart
+    does not repeat them.
+    """
+
+    def __init__(self, store, interval_hours: float = TREND_CHECK_INTERVAL,
+                 alerts_path: str = TREND_ALERTS_PATH):
+        self.store = store
+        self.interval_hours = interval_hours
+        self.alerts_path = alerts_path
+        self._alerted = {}     # (patient_id, parameter) -> Unix time of the last alert, oldest first
+        self._task = None
+
+    def _load_alerted(self):
+        try:
+            with open(self.alerts_path, encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            logger.warning("Ignoring %s: %s", self.alerts_path, exc)
+            return {}
+        return {(int(patient_id), parameter): float(at)
+                for patient_id, parameter, at in sorted(entries, key=lambda entry: entry[2])}
+
+    def _save_alerted(self, alerted: dict):
+        tmp = self.alerts_path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump([[patient_id, parameter, at] for (patient_id, parameter), at in alerted.items()], f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.alerts_path)
+
+    async def start(self):
+        if self.interval_hours <= 0 or self._task is not None:
+            return
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            logger.warning("numpy is not installed; vital sign trend checks are disabled")
+            return
+        self._alerted = await asyncio.get_running_loop().run_in_executor(None, self._load_alerted)
+        self._task = asyncio.create_task(self._run())
+
+    async def check(self):
+        """Run one trend check and alert the doctors about new findings."""
+        loop = asyncio.get_running_loop()
+        findings, _ = await loop.run_in_executor(None, analyze_vital_trends, self.store)
+        now = time.time()
+        for key in [key for key, at in self._alerted.items() if now - at >= TREND_WINDOW_DAYS * 86400]:
+            del self._alerted[key]
+        alerted = []
+        for finding in findings:
+            key = (finding.patient_id, finding.parameter)
+            if key in self._alerted:
+                continue
+            self._alerted[key] = now
+            alerted.append(finding)
+        while len(self._alerted) > TREND_ALERTS_MAX:
+            del self._alerted[next(iter(self._alerted))]
+        for finding in alerted:
+            await alert_outbox.enqueue(format_trend_alert(finding), care_teams.recipients(finding.patient_id))
+        await loop.run_in_executor(None, self._save_alerted, dict(self._alerted))
+        return findings
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_hours * 3600)
+            try:
+                await self.check()
+            except Exception:
+                logger.exception("Vital sign trend check failed")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+trend_monitor = TrendMonitor(record_store)
+
+def print_trend_report():
+    """Run the trend check once and print the cohort summary and findings."""
+    findings, cohort = analyze_vital_trends(record_store)
+    for parameter, stats in cohort.items():
+        print(f"{parameter}: {stats['patients']} patients, "
+              f"window mean p5/p50/p95 {stats['mean_p5']:.1f}/{stats['mean_p50']:.1f}/{stats['mean_p95']:.1f}, "
+              f"slope p5/p50/p95 {stats['slope_p5']:+.2f}/{stats['slope_p50']:+.2f}/{stats['slope_p95']:+.2f} per day")
+    for finding in findings:
+        print()
+        print(format_trend_alert(finding))
+
+# ======================
+# CLINICAL RULES
+# ======================
+# Every alert decision about a new record is made here. The rules file is
+# compiled into one tuple of evaluators per record type, so checking a record
+# is a dict lookup and a single pass over the rules that can match it.
+# Patients listed under "patients" get their own compiled tables with their
+# overridden thresholds. The file is polled for changes and a new version is
+# swapped in between two updates; conversations are not touched, and a file
+# that does not compile is logged and the previous rules stay in force.
+
+RuleFinding = namedtuple('RuleFinding', ['rule', 'parameter', 'value', 'detail', 'priority'])
+
+RULE_PRIORITIES = {"critical": PRIORITY_CRITICAL, "alert": PRIORITY_ALERT, "digest": PRIORITY_ROUTINE}
+
+RULE_COMPARISONS = {
+    "<": (operator.lt, "below"),
+    "<=": (operator.le, "at or below"),
+    ">": (operator.gt, "above"),
+    ">=": (operator.ge, "at or above"),
+    "==": (operator.eq, "equal to"),
+    "!=": (operator.ne, "not"),
+}
+
+# "ranges" checks vital_sign records against per-parameter min/max. Each rule
+# matches records of one type, a list of types or "*" (every type) and tests
+# one field with "op": a comparison (<, <=, >, >=, ==, !=), "contains" (any of
+# the listed words, case-insensitive), "in" (one of the listed values),
+# "not_in" (a value, but none of the listed ones) or "always". "parameter"
+# names the finding in the alert (default: the record type) and "priority" is
+# "critical", "alert" or "digest" (held for the next doctor digest unless the
+# record also has a more urgent finding). "patients" maps a patient ID to
+# overrides: {"ranges": {parameter: {...}}, "rules": {rule id: {...}}},
+# where {"enabled": false} switches a rule off for that patient. Sections
+# missing from the rules file keep these defaults.
+DEFAULT_RULES = {
+    "ranges": PARAMETER_RANGES,
+    "rules": [
+        {"id": "consciousness_warning", "type": "consciousness", "field": "description",
+         "op": "contains", "value": ["confused", "disoriented", "unresponsive"]},
+        {"id": "bai_anxiety", "type": "emotional_assessment", "field": "score",
+         "op": ">", "value": 15, "parameter": "emotional_status"},
+        {"id": "wound_warning", "type": "wound_assessment", "field": "description",
+         "op": "contains", "value": ["increased_redness", "color_changed", "fever"], "parameter": "wound_status"},
+        {"id": "qor_poor_recovery", "type": "qor_assessment", "field": "score",
+         "op": "<=", "value": 30, "parameter": "postop_recovery"},
+        # QoR-15 scores are whole numbers, so this is exactly 31 to 80
+        {"id": "qor_moderate_recovery", "type": "qor_assessment", "field": "score",
+         "op": "in", "value": list(range(31, 81)), "parameter": "postop_recovery", "priority": "digest"},
+        {"id": "breathing_problem", "type": ["respiratory", "sleep_position"], "field": "description",
+         "op": "contains", "value": ["superficial_breathing", "orthopnea"]},
+        {"id": "symptom_warning", "type": ["respiratory", "gastrointestinal"], "field": "description",
+         "op": "in", "value": ["more_30_beats", "systolic_blood_pressure", "fever"]},
+        {"id": "reported_problem", "type": [t for t in PROBLEM_RECORD_TYPES if t not in SYMPTOM_RECORD_TYPES],
+         "field": "description", "op": "always"},
+        {"id": "reported_symptom", "type": SYMPTOM_RECORD_TYPES, "field": "description",
+         "op": "not_in", "value": ROUTINE_SYMPTOMS},
+        {"id": "routine_symptom", "type": SYMPTOM_RECORD_TYPES, "field": "description",
+         "op": "in", "value": ROUTINE_SYMPTOMS, "priority": "digest"},
+        {"id": "critical_finding", "type": "*", "field": "description",
+         "op": "contains", "value": CRITICAL_FINDINGS, "priority": "critical"},
+    ],
+    "patients": {},
+}
+
+def rule_priority(name: str, where: str) -> int:
+    try:
+        return RULE_PRIORITIES[name]
+    except KeyError:
+        raise ValueError(f"{where}: unknown priority {name!r}") from None
+
+def compile_ranges(ranges: dict):
+    """Evaluator of vital_sign records against the given parameter ranges."""
+    bounds = {}
+    for parameter, param_info in ranges.items():
+        low, high = param_info.get('min'), param_info.get('max')
+        for bound in (low, high):
+            if bound is not None and not isinstance(bound, (int, float)):
+                raise ValueError(f"range {parameter}: bounds must be numbers")
+        bounds[parameter] = (low, high, param_info.get('unit', ''),
+                             rule_priority(param_info.get('priority', 'alert'), f"range {parameter}"))
+
+    def evaluate(record):
+        parameter = record.get('parameter')
+        bound = bounds.get(parameter)
+        value = record.get('value')
+        if bound is None or not isinstance(value, (int, float)):
+            return None
+        low, high, unit, priority = bound
+        if low is not None and value < low:
+            return RuleFinding('range', parameter, f"{value}{unit}", f"below minimum of {low}{unit}", priority)
+        if high is not None and value > high:
+            return RuleFinding('range', parameter, f"{value}{unit}", f"above maximum of {high}{unit}", priority)
+        return None
+    return evaluate
+
+def compile_rule(rule: dict):
+    """Evaluator returning a RuleFinding for a matching record, else None."""
+    rule_id = rule['id']
+    field = rule.get('field')
+    parameter = rule.get('parameter')
+    priority = rule_priority(rule.get('priority', 'alert'), f"rule {rule_id}")
+    op = rule['op']
+    detail = None
+    if op == 'always':
+        test = None
+    elif op == 'contains':
+        words = [rule['value']] if isinstance(rule['value'], str) else list(rule['value'])
+        pattern = re.compile("|".join(re.escape(word) for word in words), re.IGNORECASE)
+        test = lambda value: isinstance(value, str) and pattern.search(value) is not None
+    elif op in ('in', 'not_in'):
+        choices = frozenset(rule['value'])
+        negate = op == 'not_in'
+        test = lambda value: isinstance(value, (str, int, float)) and (value in choices) != negate
+    elif op in RULE_COMPARISONS:
+        compare, word = RULE_COMPARISONS[op]
+        threshold = rule['value']
+        if not isinstance(threshold, (int, float)):
+            raise ValueError(f"rule {rule_id}: {op} needs a number")
+        test = lambda value: isinstance(value, (int, float)) and compare(value, threshold)
+        detail = f"{field.replace('_', ' ')} {word} {threshold}"
+    else:
+        raise ValueError(f"rule {rule_id}: unknown op {op!r}")
+    if test is not None and not field:
+        raise ValueError(f"rule {rule_id}: {op} needs a field")
+
+    def evaluate(record):
+        value = record.get(field) if field else None
+        if test is not None and not test(value):
+            return None
+        return RuleFinding(rule_id, parameter or record.get('type'), value, detail, priority)
+    return evaluate
+
+def compile_rule_table(ranges: dict, rules) -> dict:
+    """{record type: tuple of evaluators}; the None key holds the rules for every type."""
+    typed, wildcard = {}, []
+    if ranges:
+        typed['vital_sign'] = [compile_ranges(ranges)]
+    for rule in rules:
+        if not rule.get('enabled', True):
+            continue
+        evaluate = compile_rule(rule)
+        types = rule.get('type', '*')
+        if types == '*':
+            wildcard.append(evaluate)
+            continue
+        for record_type in [types] if isinstance(types, str) else types:
+            typed.setdefault(record_type, []).append(evaluate)
+    table = {record_type: tuple(evaluators + wildcard) for record_type, evaluators in typed.items()}
+    table[None] = tuple(wildcard)
+    return table
+
+def patient_rules(config: dict, overrides: dict):
+    """Ranges and rules of `config` with one patient's overrides applied."""
+    ranges = {parameter: dict(param_info) for parameter, param_info in config['ranges'].items()}
+    for parameter, param_info in overrides.get('ranges', {}).items():
+        ranges.setdefault(parameter, {}).update(param_info)
+    rule_overrides = overrides.get('rules', {})
+    unknown = set(rule_overrides) - {rule['id'] for rule in config['rules']}
+    if unknown:
+        raise ValueError(f"overrides of unknown rules: {', '.join(sorted(unknown))}")
+    rules = [{**rule, **rule_overrides.get(rule['id'], {})} for rule in config['rules']]
+    return ranges, rules
+
+class WatchedConfigFile:
+    """JSON config file compiled by load() and reloaded when it changes on disk.
+
+    Subclasses implement compile(config) for the parsed file, or None when
+    there is no file, and swap in the result. A file that fails to compile
+    on reload is logged and the previous version stays in force; one that
+    fails at startup is logged and the defaults are used until it is fixed.
+    """
+
+    description = "config"
+    ERRORS = (OSError, ValueError, TypeError, KeyError, AttributeError)
+
+    def __init__(self, path: str, poll_interval: float):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._signature = None
+        self._task = None
+        try:
+            self.load()
+        except self.ERRORS as exc:
+            self._signature = self._file_signature()
+            logger.error("%s not loaded from %s, using the defaults: %r", self.description, self.path, exc)
+            self.compile(None)
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """Read and compile the file; raises ValueError, TypeError or KeyError if it is invalid."""
+        signature = self._file_signature()
+        config = None
+        if signature is not None:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        self.compile(config)
+        self._signature = signature
+
+    def compile(self, config):
+        raise NotImplementedError
+
+    async def start(self):
+        if self.poll_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            signature = self._file_signature()
+            if signature == self._signature:
+                continue
+            try:
+                self.load()
+            except self.ERRORS as exc:
+                self._signature = signature
+                logger.error("%s not reloaded from %s, keeping the previous version: %r",
+                             self.description, self.path, exc)
+                continue
+            logger.info("Reloaded %s from %s", self.description,
+                        self.path if signature is not None else "the defaults")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+class RuleEngine(WatchedConfigFile):
+    """Compiled clinical rules, reloaded when the rules file changes."""
+
+    description = "Clinical rules"
+
+    def __init__(self, path: str = RULES_PATH, poll_interval: float = RULES_POLL_INTERVAL):
+        self.config = None
+        self._ranges = {}      # effective ranges of patients with overrides, None for the rest
+        self._tables = {}      # compiled tables, keyed the same way
+        super().__init__(path, poll_interval)
+
+    def compile(self, config):
+        config = dict(DEFAULT_RULES, **(config or {}))
+        ids = [rule['id'] for rule in config['rules']]
+        if len(ids) != len(set(ids)):
+            raise ValueError("rule ids must be unique")
+
+        ranges = {None: config['ranges']}
+        tables = {None: compile_rule_table(config['ranges'], config['rules'])}
+        for patient_id, overrides in config['patients'].items():
+            try:
+                patient_ranges, rules = patient_rules(config, overrides)
+                ranges[int(patient_id)] = patient_ranges
+                tables[int(patient_id)] = compile_rule_table(patient_ranges, rules)
+            except ValueError as exc:
+                raise ValueError(f"patient {patient_id}: {exc}") from None
+        self.config, self._ranges, self._tables = config, ranges, tables
+
+    def evaluate(self, patient_id: int, record: dict) -> list:
+        """RuleFindings of a record, in rule order."""
+        table = self._tables.get(patient_id) or self._tables[None]
+        evaluators = table.get(record.get('type'), table[None])
+        return [finding for finding in (evaluate(record) for evaluate in evaluators) if finding]
+
+    def vital_range(self, patient_id: int, parameter: str) -> dict:
+        """Range of a vital sign parameter in force for the patient."""
+        ranges = self._ranges.get(patient_id) or self._ranges[None]
+        return ranges.get(parameter, {})
+
+rule_engine = RuleEngine()
+
+# ======================
+# CARE TEAMS
+# ======================
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+MINUTES_PER_WEEK = 7 * 24 * 60
+
+CareTeam = namedtuple('CareTeam', [
+    'name',
+    'members',      # every chat of the team (may use /summary for its patients)
+    'boundaries',   # sorted minutes of the week where the roster changes
+    'rosters',      # (on_call, escalation) chat ID tuples from each boundary on
+])
+
+def shift_minute(text: str) -> int:
+    """Minutes after midnight of an "HH:MM" time."""
+    hours, _, minutes = text.partition(':')
+    minute = int(hours) * 60 + int(minutes or 0)
+    if not 0 <= minute <= 24 * 60:
+        raise ValueError(f"invalid shift time {text!r}")
+    return minute
+
+def chat_ids(values) -> tuple:
+    return tuple(str(chat_id) for chat_id in values)
+
+def compile_care_team(name: str, team: dict) -> CareTeam:
+    """Turn a team's shifts into a weekly roster looked up by bisection.
+
+    Each shift is {"start": "HH:MM", "end": "HH:MM", "on_call": [...],
+    "escalation": [...], "days": ["mon", ...]}; it may run past midnight,
+    "days" are the days it starts on (default: every day) and overlapping
+    shifts are merged. Minutes not covered by any shift have nobody on call.
+    """
+    team_escalation = chat_ids(team.get('escalation', ()))
+    intervals = []
+    for shift in team.get('shifts', ()):
+        start, end = shift_minute(shift['start']), shift_minute(shift['end'])
+        length = (end - start) % (24 * 60) or 24 * 60
+        on_call = chat_ids(shift['on_call'])
+        escalation = chat_ids(shift['escalation']) if 'escalation' in shift else team_escalation
+        for day in shift.get('days', WEEKDAYS):
+            begin = WEEKDAYS.index(day) * 24 * 60 + start
+            intervals.append((begin, begin + length, on_call, escalation))
+
+    # Split the week at every shift start and end, wrapping at its end
+    cuts = {0}
+    for begin, stop, _, _ in intervals:
+        cuts.update((begin % MINUTES_PER_WEEK, stop % MINUTES_PER_WEEK))
+    boundaries = sorted(cuts)
+    rosters = []
+    for minute in boundaries:
+        on_call, escalation = [], []
+        for begin, stop, shift_on_call, shift_escalation in intervals:
+            if begin <= minute < stop or begin <= minute + MINUTES_PER_WEEK < stop:
+                on_call.extend(chat_id for chat_id in shift_on_call if chat_id not in on_call)
+                escalation.extend(chat_id for chat_id in shift_escalation if chat_id not in escalation)
+        rosters.append((tuple(on_call), tuple(escalation or team_escalation)))
+
+    members = set(chat_ids(team.get('members', ()))) | set(team_escalation)
+    for _, _, on_call, escalation in intervals:
+        members.update(on_call, escalation)
+    return CareTeam(name, frozenset(members), boundaries, rosters)
+
+class CareTeams(WatchedConfigFile):
+    """Routing of each patient's alerts to the chats of their care team.
+
+    The file maps team names to their members, shifts and escalation chats
+    and the patients they look after:
+
+        {"teams": {"cardiac_a": {"patients": [123, ...], "members": [...],
+                                 "escalation": [...], "shifts": [...]}},
+         "default_team": "cardiac_a"}
+
+    Alerts go to the chats on call in the patient's team at the time;
+    critical alerts also go to the shift's escalation chats, which take over
+    every alert when nobody is on call. Patients without a team belong to
+    "default_team", or without one to DOCTOR1_CHAT_ID and DOCTOR2_CHAT_ID,
+    who also get the alerts of a team with neither on call nor escalation chats.
+    Lookups are one dict access plus a bisection over the team's shift changes.
+    """
+
+    description = "Care teams"
+
+    def __init__(self, path: str = CARE_TEAMS_PATH, poll_interval: float = CARE_TEAMS_POLL_INTERVAL):
+        self.teams = {}
+        self._patients = {}    # patient ID -> CareTeam
+        self._default = None
+        super().__init__(path, poll_interval)
+
+    def compile(self, config):
+        config = config or {}
+        teams, patients = {}, {}
+        for name, team in config.get('teams', {}).items():
+            try:
+                teams[name] = compile_care_team(name, team)
+            except ValueError as exc:
+                raise ValueError(f"team {name}: {exc}") from None
+            for patient_id in team.get('patients', ()):
+                if int(patient_id) in patients:
+                    raise ValueError(f"patient {patient_id} is in teams {patients[int(patient_id)].name} and {name}")
+                patients[int(patient_id)] = teams[name]
+        default = config.get('default_team')
+        if default is not None and default not in teams:
+            raise ValueError(f"unknown default team {default!r}")
+        self.teams, self._patients, self._default = teams, patients, teams.get(default)
+
+    def team_of(self, patient_id: int):
+        return self._patients.get(patient_id, self._default)
+
+    def recipients(self, patient_id: int, priority: int = PRIORITY_ALERT, now: datetime = None) -> list:
+        """Chat IDs to alert about a patient now."""
+        team = self.team_of(patient_id)
+        if team is None:
+            return [chat_id for chat_id in (DOCTOR1_CHAT_ID, DOCTOR2_CHAT_ID) if chat_id]
+        now = now or datetime.now()
+        minute = now.weekday() * 24 * 60 + now.hour * 60 + now.minute
+        on_call, escalation = team.rosters[bisect.bisect_right(team.boundaries, minute) - 1]
+        if not on_call and not escalation:
+            logger.warning("Nobody on call or on escalation in team %s, alerting the default doctors", team.name)
+            return [chat_id for chat_id in (DOCTOR1_CHAT_ID, DOCTOR2_CHAT_ID) if chat_id]
+        if not on_call:
+            return list(escalation)
+        if priority <= PRIORITY_CRITICAL:
+            return list(on_call) + [chat_id for chat_id in escalation if chat_id not in on_call]
+        return list(on_call)
+
+    def is_member(self, chat_id, patient_id: int = None) -> bool:
+        """Whether the chat belongs to the care team of the patient (or to any team if None)."""
+        chat_id = str(chat_id)
+        if patient_id is None:
+            teams = list(self.teams.values())
+            return chat_id in (DOCTOR1_CHAT_ID, DOCTOR2_CHAT_ID) or any(chat_id in team.members for team in teams)
+        team = self.team_of(patient_id)
+        if team is None:
+            return chat_id in (DOCTOR1_CHAT_ID, DOCTOR2_CHAT_ID)
+        return chat_id in team.members
+
+care_teams = CareTeams()
+
+# ======================
+# REMINDERS
+# ======================
+# Recurring patient reminders are rows of the reminders table with the time
+# of their next occurrence. Only those due within REMINDER_HORIZON are held
+# in memory, in one timer heap; a single dispatcher pops what is due and
+# hands it to the rate limiter REMINDER_BATCH_SIZE at a time at
+# PRIORITY_BULK, so replies to patients and doctor alerts always go first.
+
+# Message and default days per reminder kind; {text} is the reminder's own text
+REMINDER_KINDS = {
+    "medication": ("💊 Time for your medication. {text}", WEEKDAYS),
+    "vitals": ("🩺 Time for your daily vital signs check-in. {text}\n"
+               "Send /start and choose 1. Vital Signs.", WEEKDAYS),
+    "qor": ("📋 Time for your weekly Quality of Recovery questionnaire. {text}\n"
+            "Send /start and choose 20. Postoperative Quality of Recovery.", ("mon",)),
+}
+
+Reminder = namedtuple('Reminder', ['id', 'patient_id', 'kind', 'text', 'times', 'days', 'next_due'])
+
+def reminder_minutes(times, days) -> list:
+    """Sorted minutes of the week at which a reminder is due."""
+    minutes = set()
+    for day in days:
+        if day not in WEEKDAYS:
+            raise ValueError(f"invalid day {day!r}")
+        for text in times:
+            minute = shift_minute(text)
+            if minute == 24 * 60:
+                raise ValueError(f"invalid reminder time {text!r}")
+            minutes.add(WEEKDAYS.index(day) * 24 * 60 + minute)
+    if not minutes:
+        raise ValueError("a reminder needs at least one time")
+    return sorted(minutes)
+
+def next_occurrence(minutes, after: datetime) -> datetime:
+    """First of the weekly `minutes` strictly after the minute of `after`."""
+    week_start = datetime(after.year, after.month, after.day) - timedelta(days=after.weekday())
+    minute = after.weekday() * 24 * 60 + after.hour * 60 + after.minute
+    i = bisect.bisect_right(minutes, minute)
+    if i == len(minutes):
+        return week_start + timedelta(days=7, minutes=minutes[0])
+    return week_start + timedelta(minutes=minutes[i])
+
+def format_reminder(reminder: Reminder) -> str:
+    template, _ = REMINDER_KINDS[reminder.kind]
+    return template.format(text=reminder.text).replace(" \n", "\n").strip()
+
+class ReminderStore:
+    """Reminder schedules in SQLite, indexed by the time they are next due.
+
+    Times are "HH:MM" local time and days are WEEKDAYS names, both stored
+    comma separated; next_due is a Unix timestamp.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY,
+            patient_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            text TEXT NOT NULL,
+            times TEXT NOT NULL,
+            days TEXT NOT NULL,
+            next_due REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS reminders_next_due ON reminders (next_due);
+        CREATE INDEX IF NOT EXISTS reminders_patient ON reminders (patient_id);
+    """
+
+    COLUMNS = "id, patient_id, kind, text, times, days, next_due"
+
+    def __init__(self, path: str = REMINDER_DB_PATH):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def _row(self, row) -> Reminder:
+        id_, patient_id, kind, text, times, days, next_due = row
+        return Reminder(id_, patient_id, kind, text, times.split(','), days.split(','), next_due)
+
+    def add(self, patient_id: int, kind: str, times, days=None, text: str = "", first_due: float = None) -> int:
+        """Schedule a reminder and return its ID; it is first due at `first_due` if given."""
+        return self.add_many([(patient_id, kind, times, days, text)], first_due)[0]
+
+    def add_many(self, reminders, first_due: float = None) -> list:
+        """Schedule (patient_id, kind, times, days, text) reminders in one transaction."""
+        rows = []
+        now = datetime.now()
+        for patient_id, kind, times, days, text in reminders:
+            if kind not in REMINDER_KINDS:
+                raise ValueError(f"unknown reminder kind {kind!r}")
+            days = list(days or REMINDER_KINDS[kind][1])
+            due = first_due
+            if due is None:
+                due = next_occurrence(reminder_minutes(times, days), now).timestamp()
+            else:
+                reminder_minutes(times, days)
+            rows.append((int(patient_id), kind, text, ",".join(times), ",".join(days), due))
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                return [conn.execute(
+                    "INSERT INTO reminders (patient_id, kind, text, times, days, next_due) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", row).lastrowid for row in rows]
+
+    def remove(self, reminder_ids) -> int:
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                return conn.executemany("DELETE FROM reminders WHERE id = ?",
+                                        [(int(id_),) for id_ in reminder_ids]).rowcount
+
+    def schedules(self, patient_id: int = None) -> list:
+        query, params = f"SELECT {self.COLUMNS} FROM reminders", ()
+        if patient_id is not None:
+            query, params = query + " WHERE patient_id = ?", (int(patient_id),)
+        with self._lock:
+            return [self._row(row) for row in self._connect().execute(query + " ORDER BY id", params)]
+
+    def due_before(self, until: float) -> list:
+        """Reminders whose next occurrence is before `until`."""
+        with self._lock:
+            return [self._row(row) for row in self._connect().execute(
+                f"SELECT {self.COLUMNS} FROM reminders WHERE next_due < ?", (until,))]
+
+    def advance(self, reminders, now: datetime) -> list:
+        """Move the given occurrences on to the next one, in one transaction.
+
+        Returns the reminders that were still due as given; ones removed or
+        rescheduled since they were loaded are left alone.
+        """
+        advanced = []
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                for reminder in reminders:
+                    next_due = next_occurrence(reminder_minutes(reminder.times, reminder.days), now).timestamp()
+                    cursor = conn.execute("UPDATE reminders SET next_due = ? WHERE id = ? AND next_due = ?",
+                                          (next_due, reminder.id, reminder.next_due))
+                    if cursor.rowcount:
+                        advanced.append(reminder)
+        return advanced
+
+    def restore(self, reminders):
+        """Make the given occurrences due again (they were advanced but not sent)."""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany("UPDATE reminders SET next_due = ? WHERE id = ?",
+                                 [(reminder.next_due, reminder.id) for reminder in reminders])
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class ReminderScheduler:
+    """Send due reminders from a timer heap loaded lazily from a ReminderStore.
+
+    Every `load_interval` seconds the reminders due within `horizon` seconds
+    are loaded (on a worker thread) into the heap. Due reminders are popped
+    `batch_size` at a time, advanced to their next occurrence in one
+    transaction and then sent, at PRIORITY_BULK; the next batch is popped
+    once this one is sent. An occurrence is advanced before it is sent, so a
+    crash can lose a reminder but never repeat a medication reminder; on a
+    clean stop the unsent part of the batch is made due again.
+    Occurrences more than `max_late` seconds overdue (e.g. after downtime)
+    are skipped.
+    """
+
+    def __init__(self, store: ReminderStore, horizon: float = REMINDER_HORIZON,
+                 load_interval: float = REMINDER_LOAD_INTERVAL, batch_size: int = REMINDER_BATCH_SIZE,
+                 max_late: float = REMINDER_MAX_LATE):
+        self.store = store
+        self.horizon = horizon
+        self.load_interval = load_interval
+        self.batch_size = batch_size
+        self.max_late = max_late
+        self._heap = []           # (next_due, reminder ID)
+        self._loaded = {}         # reminder ID -> Reminder in the heap
+        self._next_load = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reminder-store")
+        self._bot = None
+        self._send_args = {}
+        self._task = None
+        self._in_flight = None    # (advance future, time, due reminders or None, IDs sent) of the batch being sent
+
+    def __len__(self):
+        return len(self._loaded)
+
+    async def start(self, bot):
+        if self._task is not None:
+            return
+        self._bot = bot
+        # Without a rate limiter (local load tests) the bot rejects rate_limit_args
+        self._send_args = {"rate_limit_args": {"priority": PRIORITY_BULK}} if bot.rate_limiter else {}
+        self._next_load = 0.0
+        self._task = asyncio.create_task(self._run())
+
+    async def load(self, now: float):
+        """Add the reminders due within the horizon to the heap."""
+        reminders = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self.store.due_before, now + self.horizon)
+        for reminder in reminders:
+            loaded = self._loaded.get(reminder.id)
+            if loaded is None or loaded.next_due != reminder.next_due:
+                self._loaded[reminder.id] = reminder
+                heapq.heappush(self._heap, (reminder.next_due, reminder.id))
+        self._next_load = now + self.load_interval
+
+    def pop_due(self, now: float) -> list:
+        batch = []
+        while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+            due, reminder_id = heapq.heappop(self._heap)
+            reminder = self._loaded.get(reminder_id)
+            if reminder is not None and reminder.next_due == due:
+                del self._loaded[reminder_id]
+                batch.append(reminder)
+        return batch
+
+    async def _run(self):
+        while True:
+            try:
+                now = time.time()
+                if now >= self._next_load:
+                    await self.load(now)
+                batch = self.pop_due(now)
+                if batch:
+                    await self.send(batch, now)
+                    continue
+                wake = self._next_load if not self._heap else min(self._heap[0][0], self._next_load)
+                await asyncio.sleep(max(0.0, wake - time.time()))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Reminder dispatch failed")
+                await asyncio.sleep(self.load_interval)
+
+    def _due(self, batch, now: float) -> list:
+        """The reminders of an advanced batch that are not too late to send."""
+        due = []
+        for reminder in batch:
+            if now - reminder.next_due > self.max_late:
+                REMINDERS_SENT.inc((reminder.kind, "skipped"))
+            else:
+                due.append(reminder)
+        return due
+
+    async def send(self, batch, now: float):
+        advance = asyncio.get_running_loop().run_in_executor(
+            self._executor, self.store.advance, batch, datetime.fromtimestamp(now))
+        sent = set()
+        # Stopped mid-batch, stop() waits for the advance and makes the unsent occurrences due again
+        self._in_flight = (advance, now, None, sent)
+        try:
+            due = self._due(await asyncio.shield(advance), now)
+            self._in_flight = (advance, now, due, sent)
+            await asyncio.gather(*(self._send(reminder, sent) for reminder in due))
+        except Exception:
+            self._in_flight = None
+            raise
+        self._in_flight = None
+
+    async def _send(self, reminder: Reminder, sent: set):
+        try:
+            await self._bot.send_message(chat_id=reminder.patient_id, text=format_reminder(reminder),
+                                         **self._send_args)
+            sent.add(reminder.id)
+            REMINDERS_SENT.inc((reminder.kind, "sent"))
+        except Exception as exc:
+            REMINDERS_SENT.inc((reminder.kind, "failed"))
+            logger.warning("Reminder %s to patient %s failed: %s", reminder.id, reminder.patient_id, exc)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._heap.clear()
+        self._loaded.clear()
+        if self._in_flight is None:
+            return
+        advance, now, due, sent = self._in_flight
+        self._in_flight = None
+        try:
+            batch = await advance
+        except Exception:
+            return    # nothing was advanced
+        if due is None:
+            due = self._due(batch, now)
+        unsent = [reminder for reminder in due if reminder.id not in sent]
+        if unsent:
+            # The unsent occurrences go out after the restart
+            await asyncio.get_running_loop().run_in_executor(self._executor, self.store.restore, unsent)
+
+reminder_store = ReminderStore()
+reminder_scheduler = ReminderScheduler(reminder_store)
+
+# ======================
+# PATIENT SESSIONS
+# ======================
+# context.user_data is a PatientSession (see CONTEXT_TYPES) rather than a
+# dict: a fixed set of slots, callback data interned so all sessions share
+# the strings, and questionnaire answers in a byte array. Fields belonging to
+# an assessment are cleared when it is completed.
+
+class Questionnaire:
+    """Answers of a BAI or QoR-15 in progress, one byte per answer."""
+
+    __slots__ = ('answers', 'started')
+
+    def __init__(self, answers=(), started: float = None):
+        self.answers = array('b', answers)
+        self.started = time.time() if started is None else started
+
+    @property
+    def current_question(self) -> int:
+        return len(self.answers)
+
+    @property
+    def start_time(self) -> datetime:
+        return datetime.fromtimestamp(self.started)
+
+    def to_dict(self) -> dict:
+        return {"answers": self.answers.tolist(), "started": self.started}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        if 'started' in data:
+            return cls(data['answers'], data['started'])
+        # Sessions saved before questionnaires had their own type
+        return cls(data.get('answers', ()), datetime.fromisoformat(data['start_time']).timestamp())
+
+class PatientSession:
+    """Conversation data of one patient (context.user_data)."""
+
+    __slots__ = ('patient_id', 'current_vital', 'current_parameter', 'pain_score',
+                 'pain_location', 'pain_type', 'bai', 'qor', 'last_active', 'loaded')
+
+    # Persisted fields holding callback data, interned on assignment
+    CHOICES = ('current_vital', 'current_parameter', 'pain_location', 'pain_type')
+    QUESTIONNAIRES = ('bai', 'qor')
+
+    def __init__(self):
+        self.patient_id = None
+        self.current_vital = None
+        self.current_parameter = None
+        self.pain_score = None
+        self.pain_location = None
+        self.pain_type = None
+        self.bai = None
+        self.qor = None
+        self.last_active = time.monotonic()
+        self.loaded = False    # restored from the session store (see load_session)
+
+    def __setattr__(self, name, value):
+        if name in PatientSession.CHOICES and value is not None:
+            value = sys.intern(value)
+        object.__setattr__(self, name, value)
+
+    def clear_pain(self):
+        self.pain_score = self.pain_location = self.pain_type = None
+
+    def to_dict(self) -> dict:
+        """JSON-serialisable form for the session store, without empty fields."""
+        data = {}
+        for name in ('patient_id', 'pain_score') + PatientSession.CHOICES:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        for name in PatientSession.QUESTIONNAIRES:
+            questionnaire = getattr(self, name)
+            if questionnaire is not None:
+                data[name] = questionnaire.to_dict()
+        return data
+
+    def restore(self, data: dict):
+        """Fill the fields not set yet from a stored session."""
+        data = dict(data)
+        # Sessions saved as plain user_data dicts
+        if 'emotional_assessment' in data:
+            data.setdefault('bai', data['emotional_assessment'])
+        if 'qor_assessment' in data:
+            data.setdefault('qor', data['qor_assessment'])
+        for name in ('patient_id', 'pain_score') + PatientSession.CHOICES:
+            if getattr(self, name) is None and data.get(name) is not None:
+                setattr(self, name, data[name])
+        for name in PatientSession.QUESTIONNAIRES:
+            if getattr(self, name) is None and data.get(name):
+                setattr(self, name, Questionnaire.from_dict(data[name]))
+
+CONTEXT_TYPES = ContextTypes(user_data=PatientSession)
+
+# ======================
+# SESSION PERSISTENCE
+# ======================
+# ConversationHandler has no public API to read or seed one conversation.
+# The helpers below use its internals, but only on the python-telegram-bot
+# major versions they were checked against; on any other version the
+# conversations are loaded eagerly through get_conversations() and are not
+# evicted.
+
+PTB_INTERNALS_VERSIONS = (21, 22)
+
+def conversation_internals(handler: ConversationHandler) -> bool:
+    """Whether the handler's conversations can be read and seeded one by one."""
+    return (PTB_VERSION[0] in PTB_INTERNALS_VERSIONS
+            and callable(getattr(handler, '_get_key', None))
+            and isinstance(getattr(handler, '_conversations', None), MutableMapping))
+
+def conversation_states(handler: ConversationHandler) -> dict:
+    """The handler's conversations in memory, {key: state} ({} if not accessible)."""
+    return handler._conversations if conversation_internals(handler) else {}
+
+def conversation_key(handler: ConversationHandler, update: Update):
+    """The handler's conversation key of an update, or None if it has none."""
+    try:
+        return handler._get_key(update)
+    except RuntimeError:
+        return None
+
+def seed_conversation(handler: ConversationHandler, key, state):
+    """Set a conversation's state without reporting it back to the persistence."""
+    if key not in handler._conversations:
+        handler._conversations.update_no_track({key: state})
+
+def drop_conversations(handler: ConversationHandler, user_ids) -> None:
+    conversations = handler._conversations
+    for key in [key for key in conversations if key[-1] in user_ids]:
+        conversations.pop(key)
+
+class SessionPersistence(BasePersistence):
+    """Keep user_data and conversation states in SQLite across restarts.
+
+    Nothing is loaded at startup: load_session() runs ahead of the
+    conversation handler (group -1) and restores a patient's user_data and
+    conversation state on their first update after a restart. The
+    application reports only the sessions that changed since the last run of
+    update_persistence(), every SESSION_FLUSH_INTERVAL seconds; those are
+    collected and written in one transaction. Startup and flush cost
+    therefore depend on the number of active patients, not on all patients
+    ever enrolled. Sessions idle for longer than `idle_timeout` are evicted
+    together with their conversation (see evict_idle()).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, key)
+        );
+    """
+
+    def __init__(self, path: str, update_interval: float = SESSION_FLUSH_INTERVAL,
+                 idle_timeout: float = SESSION_IDLE_TIMEOUT):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-store")
+        self._handlers = []
+        self.lazy = True                   # False if conversations must be loaded eagerly
+        self._pending_users = {}           # user id -> user_data, None to delete
+        self._pending_conversations = {}   # (name, key) -> state, None to delete
+        self._write_task = None
+        self._evict_task = None
+
+    def track(self, handler: ConversationHandler):
+        """Restore this conversation handler's states in load_session()."""
+        self._handlers.append(handler)
+        if not conversation_internals(handler):
+            logger.warning("python-telegram-bot %s: loading all conversations at startup",
+                           ".".join(map(str, PTB_VERSION[:3])))
+            self.lazy = False
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def _read_session(self, user_id: int, keys):
+        conn = self._connect()
+        row = conn.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        states = []
+        for name, key in keys:
+            state = conn.execute(
+                "SELECT state FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key))
+            ).fetchone()
+            states.append(json.loads(state[0]) if state else None)
+        return (json.loads(row[0]) if row else None), states
+
+    async def load_session(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Restore the session of the update's user the first time they are seen."""
+        user = update.effective_user
+        if user is None:
+            return
+        session = context.user_data
+        session.last_active = time.monotonic()
+        if session.patient_id is None:
+            session.patient_id = user.id
+        if session.loaded:
+            return
+        session.loaded = True
+
+        keys = []
+        if self.lazy:
+            for handler in self._handlers:
+                key = conversation_key(handler, update)
+                if key is not None:
+                    keys.append((handler, key))
+        data, states = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._read_session, user.id, [(h.name, list(k)) for h, k in keys]
+        )
+        if data:
+            session.restore(data)
+        for (handler, key), state in zip(keys, states):
+            if state is not None:
+                seed_conversation(handler, key, state)
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        if self.lazy:
+            return {}
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._read_conversations, name
+        )
+
+    def _read_conversations(self, name: str) -> dict:
+        rows = self._connect().execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_user_data(self, user_id, data):
+        self._pending_users[user_id] = data.to_dict()
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def _schedule_write(self):
+        # The application reports all changed sessions in one gather(); the
+        # write task starts after them and commits the whole set at once.
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.get_running_loop().create_task(self._write_soon())
+
+    async def _write_soon(self):
+        await asyncio.sleep(0)
+        # Changes reported while a write is in flight go out with the next round
+        while self._pending_users or self._pending_conversations:
+            users, conversations = self._take_pending()
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._write, users, conversations
+            )
+
+    def _take_pending(self):
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        return users, conversations
+
+    def _write(self, users, conversations):
+        if not users and not conversations:
+            return
+        now = datetime.now().isoformat()
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sessions (user_id, data, updated) VALUES (?, ?, ?)",
+                [(user_id, json.dumps(data), now) for user_id, data in users.items() if data is not None],
+            )
+            conn.executemany(
+                "DELETE FROM sessions WHERE user_id = ?",
+                [(user_id,) for user_id, data in users.items() if data is None],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                [(name, key, json.dumps(state)) for (name, key), state in conversations.items()
+                 if state is not None],
+            )
+            conn.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [(name, key) for (name, key), state in conversations.items() if state is None],
+            )
+
+    async def start(self, application: Application):
+        """Start evicting idle sessions of the application."""
+        if self.idle_timeout > 0 and self._evict_task is None:
+            self._evict_task = asyncio.create_task(self._evict_loop(application))
+
+    async def _evict_loop(self, application: Application):
+        while True:
+            await asyncio.sleep(min(SESSION_EVICT_INTERVAL, self.idle_timeout))
+            evicted = self.evict_idle(application)
+            if evicted:
+                logger.info("Evicted %d idle sessions", evicted)
+
+    def evict_idle(self, application: Application, now: float = None) -> int:
+        """Drop the sessions and conversations of users idle for longer than idle_timeout.
+
+        The deletions reach the store with the next update_persistence(); a
+        patient coming back starts over with /start.
+        """
+        cutoff = (time.monotonic() if now is None else now) - self.idle_timeout
+        idle = {user_id for user_id, session in application.user_data.items()
+                if session.last_active < cutoff}
+        for user_id in idle:
+            application.drop_user_data(user_id)
+        if self.lazy:
+            for handler in self._handlers:
+                drop_conversations(handler, idle)
+        return len(idle)
+
+    async def stop(self):
+        if self._evict_task is None:
+            return
+        self._evict_task.cancel()
+        await asyncio.gather(self._evict_task, return_exceptions=True)
+        self._evict_task = None
+
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        users, conversations = self._take_pending()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._write, users, conversations)
+        if self._conn is not None:
+            await loop.run_in_executor(self._executor, self._conn.close)
+            self._conn = None
+
+session_persistence = SessionPersistence(SESSION_DB_PATH)
+
+# ======================
+# UPDATE PROCESSING
+# ======================
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates of different chats concurrently and each chat's in order.
+
+    An update first waits until the previous update of its chat has been
+    processed and then for one of `workers` slots, so a slow handler only
+    holds up its own chat and a chat with a backlog does not occupy slots.
+    The base class's limit is applied before that ordering and could let a
+    later update of a chat overtake an earlier one, so it is set too high to
+    ever block.
+    """
+
+    def __init__(self, workers: int = UPDATE_WORKERS):
+        super().__init__(sys.maxsize)
+        self.workers = workers
+        self._slots = asyncio.Semaphore(workers)
+        self._tails = {}       # chat ID -> future set once the chat's latest update is done
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        arrived = time.perf_counter()
+        chat = getattr(update, 'effective_chat', None) or getattr(update, 'effective_user', None)
+        previous = done = None
+        if chat is not None:
+            previous = self._tails.get(chat.id)
+            done = self._tails[chat.id] = asyncio.get_running_loop().create_future()
+        try:
+            if previous is not None:
+                await asyncio.shield(previous)
+            async with self._slots:
+                UPDATE_WAIT.observe(time.perf_counter() - arrived)
+                await coroutine
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        finally:
+            if done is not None:
+                done.set_result(None)
+                if self._tails.get(chat.id) is done:
+                    del self._tails[chat.id]
+
+# ======================
+# DUPLICATE UPDATES
+# ======================
+
+class RecentKeys:
+    """The last `capacity` keys seen, in a ring buffer indexed by a dict.
+
+    Memory stays fixed: adding a key to a full ring forgets the oldest one.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._ring = [None] * capacity
+        self._next = 0
+        self._seen = {}        # key -> time.monotonic() when it was added
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, key, max_age: float = None) -> bool:
+        """Whether the key is among the recent keys (and, with max_age, added within max_age seconds)."""
+        added = self._seen.get(key)
+        if added is None:
+            return False
+        return max_age is None or time.monotonic() - added <= max_age
+
+    def add(self, key):
+        if key in self._seen:
+            self._seen[key] = time.monotonic()
+            return
+        oldest = self._ring[self._next]
+        if oldest is not None:
+            del self._seen[oldest]
+        self._ring[self._next] = key
+        self._next = (self._next + 1) % self.capacity
+        self._seen[key] = time.monotonic()
+
+class UpdateDeduplicator:
+    """Drop redelivered updates and double-tapped buttons before any handler runs.
+
+    check() runs in handler group -2, ahead of the session loading and the
+    conversation. An update is a duplicate if its update_id, or the chat and
+    message ID of an incoming message, is among the recent keys, or if the
+    same button was tapped on the same message within `tap_window` seconds.
+    The button key includes a hash of the message text: the questionnaires
+    edit one message per question, so the same answer to the next question
+    is a new key, while a second tap on the same question is not.
+
+    Update IDs are also appended to `path` and read back by start(), so an
+    update Telegram redelivers after a restart is still recognised. The file
+    is compacted to the last `capacity` IDs when it has grown to twice that.
+    """
+
+    def __init__(self, capacity: int = UPDATE_DEDUP_SIZE, tap_window: float = UPDATE_DEDUP_TAP_WINDOW,
+                 path: str = UPDATE_IDS_PATH):
+        self.tap_window = tap_window
+        self.path = path
+        self._recent = RecentKeys(capacity)
+        self._update_ids = deque(maxlen=capacity)
+        self._file = None
+        self._lines = 0         # lines in the file
+
+    async def start(self):
+        update_ids = [update_id for update_id in read_lines(self.path) if isinstance(update_id, int)]
+        for update_id in update_ids[-self._update_ids.maxlen:]:
+            self._recent.add(("u", update_id))
+            self._update_ids.append(update_id)
+        self._compact()
+
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(b"".join(b"%d\n" % update_id for update_id in self._update_ids))
+        os.replace(tmp, self.path)
+        self._file = open(self.path, 'ab')
+        self._lines = len(self._update_ids)
+
+    def _save(self, update_id: int):
+        if self._file is None:
+            return
+        # Flushed to the OS at once (a crash of the bot loses nothing) but not fsync'd
+        self._file.write(b"%d\n" % update_id)
+        self._file.flush()
+        self._lines += 1
+        if self._lines >= 2 * self._update_ids.maxlen:
+            self._compact()
+
+    async def stop(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def update_keys(update: Update):
+        """(kind, key, max_age) of the keys identifying an update."""
+        keys = [("update", ("u", update.update_id), None)]
+        if update.message is not None:
+            keys.append(("message", ("m", update.message.chat_id, update.message.message_id), None))
+        query = update.callback_query
+        if query is not None and query.message is not None:
+            text = getattr(query.message, 'text', None) or ""
+            digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+            keys.append(("callback", ("c", query.message.chat.id, query.message.message_id, query.data, digest), True))
+        return keys
+
+    async def check(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        keys = self.update_keys(update)
+        for kind, key, is_tap in keys:
+            if self._recent.seen(key, self.tap_window if is_tap else None):
+                DUPLICATE_UPDATES.inc((kind,))
+                if kind == "callback":
+                    # A double tap is a new callback query; answer it so the button stops loading
+                    try:
+                        await update.callback_query.answer()
+                    except Exception:
+                        logger.warning("Could not answer duplicate callback query of update %s",
+                                       update.update_id, exc_info=True)
+                raise ApplicationHandlerStop
+        for _, key, _ in keys:
+            self._recent.add(key)
+        self._update_ids.append(update.update_id)
+        self._save(update.update_id)
+
+update_deduplicator = UpdateDeduplicator()
+
+# ======================
+# KEYBOARD DEFINITIONS
+# ======================
+# Keyboards are built once at import time. InlineKeyboardMarkup objects are
+# immutable, so the same instances are reused for every message.
+
+def back_only_keyboard(target):
+    return InlineKeyboardMarkup([[InlineKeyboardButton("◀ Back", callback_data=f'back_to_{target}')]])
+
+BACK_TO_MAIN_MARKUP = back_only_keyboard('main')
+BACK_TO_VITAL_SIGNS_MARKUP = back_only_keyboard('vital_signs')
+BACK_TO_PAIN_MENU_MARKUP = back_only_keyboard('pain_menu')
+BACK_TO_MENU_MARKUP = back_only_keyboard('menu')
+
+PROBLEM_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("No problem", callback_data='no_problem')],
+    [InlineKeyboardButton("There is a problem", callback_data='problem')],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
+])
+
+# 1. Vital signs
+VITAL_SIGNS_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Heart Rate/ Cadiac Rhythm", callback_data='heart_rate')],
+    [InlineKeyboardButton("Systolic Blood Pressure", callback_data='systolic_blood_pressure')],
+    [InlineKeyboardButton("Diastolic Blood Pressure", callback_data='diastolic_blood_pressure')],
+    [InlineKeyboardButton("Temperature/Fever", callback_data='temperature')],
+    [InlineKeyboardButton("Respiration Rate", callback_data='respiration_rate')],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
+])
+
+# 2. Pain
+PAIN_LOCATION_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Surgery Site", callback_data='surgery_site')],
+    [InlineKeyboardButton("Outside Surgery site", callback_data='outside_surgery_site')],
+    [InlineKeyboardButton("Chest", callback_data='chest')],
+    [InlineKeyboardButton("Leg", callback_data='leg')],
+    [InlineKeyboardButton("Anterior Chest", callback_data='anterior_chest')],
+    [InlineKeyboardButton("Arm", callback_data='arm')],
+    [InlineKeyboardButton("Back", callback_data='back')],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
+])
+
+ANTERIOR_CHEST_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Fixed/Continuous", callback_data='fixed_continuous')],
+    [InlineKeyboardButton("Stabbing", callback_data='stabbing')],
+    [InlineKeyboardButton("Pulsating", callback_data='pulsating')],
+    [InlineKeyboardButton("Unlike the previous ones", callback_data='unlike_previous_ones')],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
+])
+
+PAIN_BACK_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Fixed/Continuous", callback_data='fixed_continuous')],
+    [InlineKeyboardButton("Stabbing", callback_data='stabbing')],
+    [InlineKeyboardButton("Related to movement", callback_data='related_to_movement')],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
+])
+
+PAIN_TYPE_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Enter pain type", callback_data='enter_pain_type')],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
+])
+
+# 3. Respiratory System
+RESPIRATORY_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Superficial breathing", callback_data='superficial_breathing')],
+    [InlineKeyboardButton("More than 30 beats/1 min", callback_data='more_30_beats')],
+    [InlineKeyboardButton("Can't breadthe", callback_data='no_breadthe')],
+    [InlineKeyboardButton("Accompanied by impaired consciousness", callback_data='impaired_consciousness')],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
+])
+
+# 4. Gastrointestinal
+GASTROINTESTINAL_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Constipation", callback_data='constipation')],
+    [InlineKeyboardButton("Diarrhea", callback_data='diarrhea')],
+    [InlineKeyboardButton("Accompanied by (< 70) systolic blood pressure", callback_data='systolic_blood_pressure')],
+    [InlineKeyboardButton("Fever (>37.5)", callback_data='fever')],
+    [InlineKeyboardButton("No appetite", callback_data='no_appetite')],
+    [InlineKeyboardButton("Too weak", callback_data='too_weak')],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
+])
+
+# 6. Emotional Status (Beck Anxiety Inventory) response options
+EMOTIONAL_STATUS_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Not at all (0)", callback_data='0'),
+        InlineKeyboardButton("Mildly (1)", callback_data='1')
+    ],
+    [
+        InlineKeyboardButton("Moderately (2)", callback_data='2'),
+        InlineKeyboardButton("Severely (3)", callback_data='3')
+    ],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')]
+])
+
+# 8. Wound Healing
+WOUND_HEALING_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Wound dranaige", callback_data='wound_dranaige')],
+    [InlineKeyboardButton("Increased redness at the wound site", callback_data='increased_redness')],
+    [InlineKeyboardButton("Color changed at the wound site", callback_data='color_changed')],
+    [InlineKeyboardButton("Fever", callback_data='fever')],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
+])
+
+# 18. & 19. Sleep Pattern and Position
+SLEEP_PATTERN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Falling asleep", callback_data='falling_asleep')],
+    [InlineKeyboardButton("Shorter sleep time", callback_data='short_time')],
+    [InlineKeyboardButton("Feeling tired when waking up", callback_data='feeling_tired')],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
+])
+
+SLEEP_POSITION_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("On the back", callback_data='back')],
+    [InlineKeyboardButton("Side sleeping", callback_data='side')],
+    [InlineKeyboardButton("Use of two pillows", callback_data='two_pillows')],
+    [InlineKeyboardButton("Orthopnea", callback_data='orthopnea')],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
+])
+
+# 20. Postoperative Quality of Recovery (QoR-15) response options (0-10 scale)
+QOR_RESPONSE_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("0 = none of the time (Poor)", callback_data='0')
+    ],
+    [
+        InlineKeyboardButton("1", callback_data='1'),
+        InlineKeyboardButton("2", callback_data='2'),
+        InlineKeyboardButton("3", callback_data='3')
+    ],
+    [
+        InlineKeyboardButton("4", callback_data='4'),
+        InlineKeyboardButton("5", callback_data='5'),
+        InlineKeyboardButton("6", callback_data='6'),
+    ],
+    [
+        InlineKeyboardButton("7", callback_data='7'),
+        InlineKeyboardButton("8", callback_data='8'),
+        InlineKeyboardButton("9", callback_data='9')
+    ],
+    [
+        InlineKeyboardButton("10 = all of the time (Excellent)", callback_data='10')
+    ],
+    [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')]
+])
+
+def callback_pattern(*markups):
+    """Compile a pattern matching exactly the callback data of the given keyboards."""
+    callbacks = []
+    for markup in markups:
+        for row in markup.inline_keyboard:
+            for button in row:
+                if button.callback_data not in callbacks:
+                    callbacks.append(button.callback_data)
+    return re.compile('^(' + '|'.join(re.escape(c) for c in callbacks) + ')$')
+
+# ======================
+# MENU REGISTRY
+# ======================
+# Every main menu option is declared once here. The main menu keyboard, the
+# main_menu dispatch table and the MAIN_MENU callback pattern are all built
+# from this list, so a new assessment only needs a new entry.
+
+MenuItem = namedtuple('MenuItem', [
+    'callback',          # callback data of the main menu button
+    'label',             # button text
+    'prompt',            # message shown when the option is chosen
+    'reply_markup',      # keyboard shown with the prompt
+    'state',             # conversation state to enter
+    'tracks_parameter',  # remember the option as context.user_data.current_parameter
+])
+
+MAIN_MENU_ITEMS = [
+    MenuItem('vital_signs', "1. Vital Signs",
+             "Select vital sign to report:",
+             VITAL_SIGNS_MENU_MARKUP, VITAL_SIGNS_MENU, False),
+    MenuItem('pain', "2. Pain Assessment",
+             "What is your pain score numerical rating (0 - 10)?\n"
+             "(0 = No pain, 5 = Moderate pain, 10 = Worst possible pain)",
+             BACK_TO_MAIN_MARKUP, ENTER_PAIN_SCORE, False),
+    MenuItem('respiratory', "3. Respiratory System",
+             "Do you breathe well or there is a problem?\n",
+             RESPIRATORY_MENU_MARKUP, RESPIRATORY_SYSTEM, True),
+    MenuItem('gastrointestinal', "4. Gastrointestinal",
+             "Do you eat well or there is a problem?\n",
+             GASTROINTESTINAL_MENU_MARKUP, GASTROINTESTINAL_SYSTEM, True),
+    MenuItem('consciousness', "5. Consciousness",
+             "Describe your alertness level:\n"
+             "(e.g., fully alert, drowsy, confused)\n"
+             "OR are you oriented to time, place, and person?\n"
+             "(e.g., 'I know who/where/when I am')\n"
+             "Reply with Okay(Open conscious), confused or unresposive",
+             BACK_TO_MAIN_MARKUP, CONSCIOUSNESS, False),
+    MenuItem('emotional_status', "6. Emotional Status",
+             "How would you describe your emotional state today?\n"
+             "(e.g., anxious, calm, depressed, happy)",
+             BACK_TO_MAIN_MARKUP, EMOTIONAL_STATUS_MENU, False),
+    MenuItem('medication_compliance', "7. Medication Compliance",
+             "Have you taken all medications as prescribed today?\n",
+             PROBLEM_MENU_MARKUP, PROBLEM_MENU, True),
+    MenuItem('wound_healing', "8. Wound Healing",
+             "Choose any of the following issues related to wound healing.?\n",
+             WOUND_HEALING_MENU_MARKUP, WOUND_HEALING_MENU, False),
+    MenuItem('postop_adaptation', "9. Post-op Adaptation",
+             "How are you adapting to post-operative requirements?\n"
+             "(Please describe if there are any problems)",
+             PROBLEM_MENU_MARKUP, PROBLEM_MENU, True),
+    MenuItem('stocking_socks', "10. Stocking Socks Use",
+             "Have you been using your compression stockings as recommended?\n"
+             "(Please describe usage duration if there are any problems)",
+             PROBLEM_MENU_MARKUP, PROBLEM_MENU, True),
+    MenuItem('diet_compliance', "11. Diet Compliance",
+             "How is your diet compliance?\n"
+             "(Please describe what you've eaten and any issues)",
+             PROBLEM_MENU_MARKUP, PROBLEM_MENU, True),
+    MenuItem('activity_adaptation', "12. Activity Adaptation",
+             "How are you adapting to recommended activity levels?\n"
+             "(Describe your activities and any difficulties)",
+             PROBLEM_MENU_MARKUP, PROBLEM_MENU, True),
+    MenuItem('daily_mobilization', "13. Daily Mobilization",
+             "Describe your daily mobility:\n"
+             "(How often do you get up and move around?)",
+             PROBLEM_MENU_MARKUP, PROBLEM_MENU, True),
+    MenuItem('social_adaptation', "14. Social Life Adaptation",
+             "How are you adapting socially since your procedure?\n"
+             "(Describe any social activities or isolation)",
+             PROBLEM_MENU_MARKUP, PROBLEM_MENU, True),
+    MenuItem('shower', "15. Shower",
+             "Have you been able to shower independently?\n"
+             "(Describe any difficulties)",
+             PROBLEM_MENU_MARKUP, PROBLEM_MENU, True),
+    MenuItem('return_to_work', "16. Return to Work",
+             "What is your status regarding returning to work?\n"
+             "(Describe any plans or limitations)",
+             PROBLEM_MENU_MARKUP, PROBLEM_MENU, True),
+    MenuItem('driving', "17. Driving",
+             "Have you been driving your car normally?\n"
+             "(Please describe if there are any problems)",
+             PROBLEM_MENU_MARKUP, PROBLEM_MENU, True),
+    MenuItem('sleep_pattern', "18. Sleep Pattern",
+             "Do you sleep normally or there is a problem?\n",
+             SLEEP_PATTERN_MENU_MARKUP, SLEEP_PATTERN, True),
+    MenuItem('sleep_position', "19. Sleeping Position",
+             "What position do you typically sleep in?\n"
+             "(e.g., on back, side sleeping, with pillows)",
+             SLEEP_POSITION_MENU_MARKUP, SLEEP_POSITION, True),
+    MenuItem('postoperative_quality_of_recovery', "20. Postoperative Quality of Recovery",
+             "How have you been feeling in the last 24 hours?\n"
+             "(e.g., 0 = worth, 10 = happy)",
+             BACK_TO_MAIN_MARKUP, QOR_ASSESSMENT_MENU, False),
+]
+
+MAIN_MENU_ACTIONS = {item.callback: item for item in MAIN_MENU_ITEMS}
+
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(item.label, callback_data=item.callback)] for item in MAIN_MENU_ITEMS
+])
+
+# ======================
+# HANDLER FUNCTIONS
+# ======================
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Start the conversation and show main menu."""
+    user = update.message.from_user
+    context.user_data.patient_id = user.id
+    
+    await update.message.reply_text(
+        "🏥 Home Care Monitoring\nPlease select a parameter to report:",
+        reply_markup=MAIN_MENU_MARKUP
+    )
+    return MAIN_MENU
 
-    elif query.data == 'sleep_pattern':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(sleep_pattern_menu_keyboard())
-        await query.edit_message_text(
-            "Do you sleep normally or there is a problem?\n",
-            reply_markup=reply_markup
-        )
-        return SLEEP_PATTERN
-        
-    elif query.data == 'sleep_position':
-        context.user_data['current_parameter'] = query.data
-        reply_markup = InlineKeyboardMarkup(sleep_position_menu_keyboard())
-        await query.edit_message_text(
-            "What position do you typically sleep in?\n"
-            "(e.g., on back, side sleeping, with pillows)",
-            reply_markup=reply_markup
-        )
-        return SLEEP_POSITION
+async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handle all main menu options from the Word doc"""
+    query = update.callback_query
+    await query.answer()
     
-    elif query.data == 'postoperative_quality_of_recovery':
-        await query.edit_message_text(
-            "How have you been feeling in the last 24 hours?\n"
-            "(e.g., 0 = worth, 10 = happy)",
-            reply_markup=InlineKeyboardMarkup(back_only_keyboard('main'))
-        )
-        return QOR_ASSESSMENT_MENU
+    item = MAIN_MENU_ACTIONS.get(query.data)
+    if item is None:
+        return MAIN_MENU
     
-    return MAIN_MENU
+    if item.tracks_parameter:
+        context.user_data.current_parameter = query.data
+    await query.edit_message_text(item.prompt, reply_markup=item.reply_markup)
+    return item.state
 
 # ======================
 # COMPLETE HANDLER IMPLEMENTATIONS
 # ======================
 # 1. Vital signs
-def vital_signs_menu_keyboard():
-    return [
-        [InlineKeyboardButton("Heart Rate/ Cadiac Rhythm", callback_data='heart_rate')],
-        [InlineKeyboardButton("Systolic Blood Pressure", callback_data='systolic_blood_pressure')],
-        [InlineKeyboardButton("Diastolic Blood Pressure", callback_data='diastolic_blood_pressure')],
-        [InlineKeyboardButton("Temperature/Fever", callback_data='temperature')],
-        [InlineKeyboardButton("Respiration Rate", callback_data='respiration_rate')],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
-    ]
-
 async def vital_signs_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle vital signs menu navigation."""
     query = update.callback_query
@@ -335,13 +4132,13 @@ async def vital_signs_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if query.data == 'back_to_main':
         await query.edit_message_text(
             "Main Menu:",
-            reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+            reply_markup=MAIN_MENU_MARKUP
         )
         return MAIN_MENU
     
     # Store selected vital sign
-    context.user_data['current_vital'] = query.data
-    param_info = PARAMETER_RANGES.get(query.data, {})
+    context.user_data.current_vital = query.data
+    param_info = rule_engine.vital_range(context.user_data.patient_id, query.data)
     
     # Prepare range info
     range_text = ""
@@ -351,93 +4148,52 @@ async def vital_signs_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         range_text = f" (max: {param_info['max']}{param_info['unit']})"
     await query.edit_message_text(
         f"Please enter your {query.data.replace('_', ' ')}{range_text}:",
-        reply_markup=InlineKeyboardMarkup(back_only_keyboard('vital_signs'))
+        reply_markup=BACK_TO_VITAL_SIGNS_MARKUP
     )
     return ENTER_VITAL_SIGN_VALUE
 
 async def enter_vital_sign_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Process entered vital sign value."""
-    user_id = context.user_data['patient_id']
-    vital_sign = context.user_data['current_vital']
+    user_id = context.user_data.patient_id
+    vital_sign = context.user_data.current_vital
     
     try:
         value = float(update.message.text)
     except ValueError:
+        value = math.nan
+    if not math.isfinite(value):
         await update.message.reply_text("Please enter a valid number. Try again:")
         return ENTER_VITAL_SIGN_VALUE
     
-    # Check ranges
-    param_info = PARAMETER_RANGES.get(vital_sign, {})
-    out_of_range = False
-    warning = ""
-    
-    if 'min' in param_info and value < param_info['min']:
-        out_of_range = True
-        warning = f"⚠️ Below minimum ({param_info['min']}{param_info['unit']})"
-    elif 'max' in param_info and value > param_info['max']:
-        out_of_range = True
-        warning = f"⚠️ Above maximum ({param_info['max']}{param_info['unit']})"
-    
-    # Save record
+    unit = PARAMETER_RANGES.get(vital_sign, {}).get('unit', '')
     record = {
         "type": "vital_sign",
         "parameter": vital_sign,
         "value": value,
-        "unit": param_info.get('unit', ''),
+        "unit": unit,
         "timestamp": datetime.now().isoformat(),
-        "out_of_range": out_of_range
     }
-    save_patient_record(user_id, record)
+    findings = rule_engine.evaluate(user_id, record)
+    record["out_of_range"] = any(finding.rule == 'range' for finding in findings)
+    await save_patient_record(user_id, record)
     
     # Respond to patient
-    response = f"✅ Recorded {vital_sign.replace('_', ' ')}: {value}{param_info.get('unit', '')}"
-    if out_of_range:
-        response += f"\n{warning}\nA doctor has been notified."
-        await alert_doctor(context, user_id, vital_sign, value, param_info)
+    response = f"✅ Recorded {vital_sign.replace('_', ' ')}: {value}{unit}"
+    if findings:
+        for finding in findings:
+            if finding.detail:
+                response += f"\n⚠️ {finding.detail[0].upper()}{finding.detail[1:]}"
+        response += findings_notice(findings)
+        await alert_doctor(context, user_id, findings)
     
     await update.message.reply_text(
         response,
-        reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+        reply_markup=MAIN_MENU_MARKUP
     )
     return MAIN_MENU
 
 # ======================
 # 2. pain
-def pain_location_menu_keyboard():
-    return [
-        [InlineKeyboardButton("Surgery Site", callback_data='surgery_site')],
-        [InlineKeyboardButton("Outside Surgery site", callback_data='outside_surgery_site')],
-        [InlineKeyboardButton("Chest", callback_data='chest')],
-        [InlineKeyboardButton("Leg", callback_data='leg')],
-        [InlineKeyboardButton("Anterior Chest", callback_data='anterior_chest')],
-        [InlineKeyboardButton("Arm", callback_data='arm')],
-        [InlineKeyboardButton("Back", callback_data='back')],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
-    ]
-
-def anterior_chest_menu_keyboard():
-    return [
-        [InlineKeyboardButton("Fixed/Continuous", callback_data='fixed_continuous')],
-        [InlineKeyboardButton("Stabbing", callback_data='stabbing')],
-        [InlineKeyboardButton("Pulsating", callback_data='pulsating')],
-        [InlineKeyboardButton("Unlike the previous ones", callback_data='unlike_previous_ones')],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
-    ]
-
-def pain_back_menu_keyboard():
-    return [
-        [InlineKeyboardButton("Fixed/Continuous", callback_data='fixed_continuous')],
-        [InlineKeyboardButton("Stabbing", callback_data='stabbing')],
-        [InlineKeyboardButton("Related to movement", callback_data='related_to_movement')],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
-    ]
-
-def pain_type_menu_keyboard():
-    return [
-        [InlineKeyboardButton("Enter pain type", callback_data='enter_pain_type')],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
-    ]
-
 async def enter_pain_score(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Process pain score ( 0 - 10 )."""
     try:
@@ -450,15 +4206,15 @@ async def enter_pain_score(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         # Invalid input (not a number or out of range)
         await update.message.reply_text(
             "⚠️ Please enter a valid pain score between 0 and 10:",
-            reply_markup=InlineKeyboardMarkup(back_only_keyboard('main'))
+            reply_markup=BACK_TO_MAIN_MARKUP
         )
         return ENTER_PAIN_SCORE  # Stay in same state to retry
-    context.user_data['pain_score'] = score
+    context.user_data.pain_score = score
     # Sub-menu for each location
     await update.message.reply_text(
         f"Recorded pain location: {score}\n"
             "Now, Where is your pain located in your body?",
-            reply_markup=InlineKeyboardMarkup(pain_location_menu_keyboard())
+            reply_markup=PAIN_LOCATION_MENU_MARKUP
         )
     return ENTER_PAIN_LOCATION
 
@@ -467,31 +4223,31 @@ async def enter_pain_location(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     pain_location = query.data
-    context.user_data['pain_location'] = pain_location
+    context.user_data.pain_location = pain_location
     if query.data == 'back_to_main':
         await query.edit_message_text(
             "Main Menu:",
-            reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+            reply_markup=MAIN_MENU_MARKUP
         )
         return MAIN_MENU
     elif query.data == 'anterior_chest':
         await query.edit_message_text(
             f"Recorded pain location: {pain_location}\n"
             "Now please describe the type of pain:",
-            reply_markup=InlineKeyboardMarkup(anterior_chest_menu_keyboard())
+            reply_markup=ANTERIOR_CHEST_MENU_MARKUP
         )
         return ENTER_PAIN_TYPE
     elif query.data == 'back':
         await query.edit_message_text(
             f"Recorded pain location: {pain_location}\n"
             "Now please describe the type of pain:",
-            reply_markup=InlineKeyboardMarkup(pain_back_menu_keyboard())
+            reply_markup=PAIN_BACK_MENU_MARKUP
         )
         return ENTER_PAIN_TYPE
     else:
         await query.edit_message_text(
             f"Recorded pain location: {pain_location}\n",
-            reply_markup=InlineKeyboardMarkup(pain_type_menu_keyboard())
+            reply_markup=PAIN_TYPE_MENU_MARKUP
         )
         return ENTER_PAIN_TYPE
 
@@ -500,7 +4256,7 @@ async def enter_pain_type(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     await query.answer()
     pain_type = query.data
-    context.user_data['pain_type'] = pain_type
+    context.user_data.pain_type = pain_type
     
     await query.edit_message_text(
         f"Recorded pain type: {pain_type}\n"
@@ -510,62 +4266,39 @@ async def enter_pain_type(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         "- Numbness\n"
         "- Example: 'some shortness of breath'\n"
         "Example: 'when I walk'",
-        reply_markup=InlineKeyboardMarkup(back_only_keyboard('pain_menu'))
+        reply_markup=BACK_TO_PAIN_MENU_MARKUP
     )
     return ENTER_PAIN_SYMPTOMS
 
 async def enter_pain_symptoms(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Complete pain assessment and save data."""
     symptoms = update.message.text
-    user_id = context.user_data['patient_id']
+    user_id = context.user_data.patient_id
     
     record = {
         "type": "pain_assessment",
-        "location": context.user_data['pain_location'],
-        "pain_type": context.user_data['pain_type'],
+        "location": context.user_data.pain_location,
+        "pain_type": context.user_data.pain_type,
         "symptoms": symptoms,
         "timestamp": datetime.now().isoformat()
     }
-    save_patient_record(user_id, record)
+    context.user_data.clear_pain()
+    await save_patient_record(user_id, record)
     
     await update.message.reply_text(
         "✅ Pain assessment completed:\n"
         f"Location: {record['location']}\n"
         f"Type: {record['pain_type']}\n"
         f"Symptoms: {record['symptoms']}",
-        reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+        reply_markup=MAIN_MENU_MARKUP
     )
     return MAIN_MENU
 
-# 3. Respiratory System Handlers
-def respiratory_menu_keyboard():
-    return [
-        [InlineKeyboardButton("Superficial breathing", callback_data='superficial_breathing')],
-        [InlineKeyboardButton("More than 30 beats/1 min", callback_data='more_30_beats')],
-        [InlineKeyboardButton("Can't breadthe", callback_data='no_breadthe')],
-        [InlineKeyboardButton("Accompanied by impaired consciousness", callback_data='impaired_consciousness')],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
-    ]
-# 4. Gastrointestinal Handlers
-def gastrointestinal_menu_keyboard():
-    return [
-        [InlineKeyboardButton("Constipation", callback_data='constipation')],
-        [InlineKeyboardButton("Diarrhea", callback_data='diarrhea')],
-        [InlineKeyboardButton("Accompanied by (< 70) systolic blood pressure", callback_data='systolic_blood_pressure')],
-        [InlineKeyboardButton("Fever (>37.5)", callback_data='fever')],
-        [InlineKeyboardButton("No appetite", callback_data='no_appetite')],
-        [InlineKeyboardButton("Too weak", callback_data='too_weak')],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
-    ]
-
 # 5. Consciousness Handlers
 async def handle_consciousness(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Process consciousness information."""
-    consciousness_level = update.message.text
-    context.user_data['consciousness_level'] = consciousness_level
-
-    user_id = context.user_data['patient_id']
-    text = consciousness_level.lower()
+    user_id = context.user_data.patient_id
+    text = update.message.text.lower()
     
     record = {
         "type": "consciousness",
@@ -573,17 +4306,12 @@ async def handle_consciousness(update: Update, context: ContextTypes.DEFAULT_TYP
         "timestamp": datetime.now().isoformat()
     }
     
-    # Check for warning signs from your doc
-    warning_signs = ["confused", "disoriented", "unresponsive"]
-    if any(sign in text for sign in warning_signs):
-        record["needs_attention"] = True
-        await alert_doctor(context, user_id, "consciousness", text, {})
-    
-    save_patient_record(user_id, record)
+    findings = await check_record(context, user_id, record)
+    await save_patient_record(user_id, record)
     
     await update.message.reply_text(
-        "✅ Consciousness assessment recorded",
-        reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+        "✅ Consciousness assessment recorded" + findings_notice(findings),
+        reply_markup=MAIN_MENU_MARKUP
     )
     return MAIN_MENU
 
@@ -613,36 +4341,60 @@ EMOTIONAL_QUESTIONS = [
     "21. Hot/cold sweats"
 ]
 
-def emotional_status_keyboard():
-    """Create response keyboard for each question"""
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("Not at all (0)", callback_data='0'),
-            InlineKeyboardButton("Mildly (1)", callback_data='1')
-        ],
-        [
-            InlineKeyboardButton("Moderately (2)", callback_data='2'),
-            InlineKeyboardButton("Severely (3)", callback_data='3')
-        ],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')]
-    ])
+BAI_MAX_ANSWER = 3
+QOR_MAX_ANSWER = 10
+
+# ASCII digits only: str.isdigit() also accepts e.g. '²', which int() rejects
+ANSWER_PATTERN = re.compile(r'[0-9]+')
+
+def looks_like_answers(text: str) -> bool:
+    """Whether a message is a list of numbers rather than a free-text reply."""
+    values = text.replace(',', ' ').split()
+    return len(values) > 1 and all(ANSWER_PATTERN.fullmatch(value) for value in values)
+
+def parse_answers(text: str, count: int, max_value: int):
+    """Parse `count` answers from 0 to max_value separated by spaces or commas."""
+    values = text.replace(',', ' ').split()
+    if len(values) != count:
+        raise ValueError(f"Please send exactly {count} answers (you sent {len(values)}).")
+    answers = []
+    for number, value in enumerate(values, 1):
+        if not ANSWER_PATTERN.fullmatch(value) or int(value) > max_value:
+            raise ValueError(f"Answer {number} ('{value}') must be a number from 0 to {max_value}.")
+        answers.append(int(value))
+    return answers
+
+def score_bai(answers):
+    """Total score and interpretation of Beck Anxiety Inventory answers."""
+    total_score = sum(answers)
+    if total_score <= 7:
+        interpretation = "Minimal anxiety"
+    elif total_score <= 15:
+        interpretation = "Mild anxiety"
+    elif total_score <= 25:
+        interpretation = "Moderate anxiety"
+    else:
+        interpretation = "Severe anxiety"
+    return total_score, interpretation
 
 async def start_emotional_assessment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start emotional status assessment"""
     
+    # All 21 answers sent at once
+    if looks_like_answers(update.message.text):
+        return await score_emotional_batch(update, context, EMOTIONAL_STATUS_MENU)
+    
     # Initialize assessment data
-    context.user_data['emotional_assessment'] = {
-        'current_question': 0,
-        'answers': [],
-        'start_time': datetime.now().isoformat()
-    }
+    context.user_data.bai = Questionnaire()
     
     # Ask first question
     await update.message.reply_text(
-        text="Emotional Status Assessment (Beck Anxiety Inventory)\n\n"
+        text="Emotional Status Assessment (Beck Anxiety Inventory)\n"
+             f"Tip: you can also send all {len(EMOTIONAL_QUESTIONS)} answers (0-3) in one message, "
+             "e.g. '0 1 0 2 ...'\n\n"
              f"{EMOTIONAL_QUESTIONS[0]}\n"
              "How much has this bothered you in the past week?",
-        reply_markup=emotional_status_keyboard()
+        reply_markup=EMOTIONAL_STATUS_MARKUP
     )
     return ENTER_EMOTIONAL_STATUS
 
@@ -654,71 +4406,79 @@ async def handle_emotional_response(update: Update, context: ContextTypes.DEFAUL
     if query.data == 'back_to_main':
         await query.edit_message_text(
             "Main Menu:",
-            reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+            reply_markup=MAIN_MENU_MARKUP
         )
         return MAIN_MENU
     
     # Store the answer
-    assessment = context.user_data['emotional_assessment']
-    assessment['answers'].append(int(query.data))
-    current_q = assessment['current_question'] + 1
+    assessment = context.user_data.bai
+    assessment.answers.append(int(query.data))
+    current_q = assessment.current_question
     
     if current_q < len(EMOTIONAL_QUESTIONS):
         # Ask next question
-        assessment['current_question'] = current_q
         await query.edit_message_text(
             text=f"{EMOTIONAL_QUESTIONS[current_q]}\n"
                  "How much has this bothered you in the past week?",
-            reply_markup=emotional_status_keyboard()
+            reply_markup=EMOTIONAL_STATUS_MARKUP
         )
         return ENTER_EMOTIONAL_STATUS
     else:
         # Assessment complete
-        total_score = sum(assessment['answers'])
-        assessment['total_score'] = total_score
-        assessment['end_time'] = datetime.now().isoformat()
-        
-        # Interpret score
-        if total_score <= 7:
-            interpretation = "Minimal anxiety"
-        elif total_score <= 15:
-            interpretation = "Mild anxiety"
-        elif total_score <= 25:
-            interpretation = "Moderate anxiety"
-        else:
-            interpretation = "Severe anxiety"
-        
-        # Save results
-        user_id = context.user_data['patient_id']
-        record = {
-            "type": "emotional_assessment",
-            "assessment": "Beck Anxiety Inventory",
-            "score": total_score,
-            "interpretation": interpretation,
-            "answers": assessment['answers'],
-            "timestamp": assessment['start_time'],
-            "duration_seconds": (datetime.now() - datetime.fromisoformat(assessment['start_time'])).total_seconds()
-        }
-        save_patient_record(user_id, record)
-        
-        # Alert doctor if score is concerning
-        if total_score > 15:
-            await alert_doctor(
-                context,
-                user_id,
-                "emotional_status",
-                f"Score: {total_score} ({interpretation})",
-                {}
-            )
-        
         await query.edit_message_text(
-            text=f"✅ Emotional assessment completed\n\n"
-                 f"Total score: {total_score}\n"
-                 f"Interpretation: {interpretation}",
-            reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+            text=await complete_emotional_assessment(context, assessment),
+            reply_markup=MAIN_MENU_MARKUP
             
         )
         return MAIN_MENU
+
+async def enter_emotional_batch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Process all emotional status answers sent in one message"""
+    return await score_emotional_batch(update, context, ENTER_EMOTIONAL_STATUS)
+
+async def score_emotional_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, retry_state: int) -> int:
+    """Validate and score a one-message BAI; stay in retry_state if invalid."""
+    try:
+        answers = parse_answers(update.message.text, len(EMOTIONAL_QUESTIONS), BAI_MAX_ANSWER)
+    except ValueError as e:
+        await update.message.reply_text(f"⚠️ {e}\nPlease try again:", reply_markup=BACK_TO_MAIN_MARKUP)
+        return retry_state
+    
+    assessment = context.user_data.bai
+    if retry_state == EMOTIONAL_STATUS_MENU or assessment is None:
+        assessment = context.user_data.bai = Questionnaire()
+    assessment.answers = array('b', answers)
+    
+    await update.message.reply_text(
+        await complete_emotional_assessment(context, assessment, entry_mode='batch'),
+        reply_markup=MAIN_MENU_MARKUP
+    )
+    return MAIN_MENU
+
+async def complete_emotional_assessment(context: ContextTypes.DEFAULT_TYPE, assessment: Questionnaire,
+                                        entry_mode: str = 'interactive') -> str:
+    """Score a finished BAI, save it, alert the doctor if needed and return the summary."""
+    total_score, interpretation = score_bai(assessment.answers)
+    context.user_data.bai = None
+    
+    # Save results
+    user_id = context.user_data.patient_id
+    record = {
+        "type": "emotional_assessment",
+        "assessment": "Beck Anxiety Inventory",
+        "score": total_score,
+        "interpretation": interpretation,
+        "answers": assessment.answers.tolist(),
+        "entry_mode": entry_mode,
+        "timestamp": assessment.start_time.isoformat(),
+        "duration_seconds": time.time() - assessment.started
+    }
+    findings = await check_record(context, user_id, record)
+    await save_patient_record(user_id, record)
+    
+    return (f"✅ Emotional assessment completed\n\n"
+            f"Total score: {total_score}\n"
+            f"Interpretation: {interpretation}" + findings_notice(findings))
     
 # 7. Compliance with medications
 # 9. Adaptation to post operation rehabilitation
@@ -739,30 +4499,28 @@ async def handle_problem_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     if query.data == 'back_to_main':
         await query.edit_message_text(
             "Main Menu:",
-            reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+            reply_markup=MAIN_MENU_MARKUP
         )
         return MAIN_MENU
     
     if query.data == 'no_problem':
         await query.edit_message_text(
-            f"✅ No problem with {context.user_data['current_parameter']}, Main Menu:",
-            reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+            f"✅ No problem with {context.user_data.current_parameter}, Main Menu:",
+            reply_markup=MAIN_MENU_MARKUP
         )
         return MAIN_MENU
     elif query.data == 'problem':
         await query.edit_message_text(
         "Now, Please describe any difficulties or the problem.\n",
-        reply_markup=InlineKeyboardMarkup(back_only_keyboard('menu'))
+        reply_markup=BACK_TO_MENU_MARKUP
         )
         return ENTER_PROBLEM_DESCRIPTION
     
 async def enter_problem_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Process problem information."""
-    user_id = context.user_data['patient_id']
+    user_id = context.user_data.patient_id
     text = update.message.text
-    current_parameter = context.user_data['current_parameter']
-    print(current_parameter)
-    await alert_doctor(context, user_id, current_parameter, text, {})
+    current_parameter = context.user_data.current_parameter
     
     record = {
         "type": current_parameter,
@@ -770,34 +4528,29 @@ async def enter_problem_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "timestamp": datetime.now().isoformat()
     }
     
-    save_patient_record(user_id, record)
+    findings = await check_record(context, user_id, record)
+    await save_patient_record(user_id, record)
     
     await update.message.reply_text(
-        "✅ Problem recorded",
-        reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+        "✅ Problem recorded" + findings_notice(findings),
+        reply_markup=MAIN_MENU_MARKUP
     )
     return MAIN_MENU
 
 # 8. Wound Healing Handlers
-def wound_healing_menu_keyboard():
-    return [
-        [InlineKeyboardButton("Wound dranaige", callback_data='wound_dranaige')],
-        [InlineKeyboardButton("Increased redness at the wound site", callback_data='increased_redness')],
-        [InlineKeyboardButton("Color changed at the wound site", callback_data='color_changed')],
-        [InlineKeyboardButton("Fever", callback_data='fever')],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
-    ]
-
 async def enter_wound_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle wound healing assessment."""
     query = update.callback_query
     await query.answer()
     
     if query.data == 'back_to_main':
-        await main_menu(query)
+        await query.edit_message_text(
+            "Main Menu:",
+            reply_markup=MAIN_MENU_MARKUP
+        )
         return MAIN_MENU
     
-    user_id = context.user_data['patient_id']
+    user_id = context.user_data.patient_id
     text = query.data.lower()
     
     record = {
@@ -805,39 +4558,16 @@ async def enter_wound_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         "description": text,
         "timestamp": datetime.now().isoformat()
     }
-    save_patient_record(user_id, record)
 
-    # Check for warning signs from your doc
-    warning_signs = ["increased_redness", "color_changed", "fever"]
-    if any(sign in text for sign in warning_signs):
-        record["needs_attention"] = True
-        await alert_doctor(context, user_id, "wound_status", text, {})
-    
+    findings = await check_record(context, user_id, record)
+    await save_patient_record(user_id, record)
     
     await query.edit_message_text(
-        "✅ Wound assessment recorded",
-        reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+        "✅ Wound assessment recorded" + findings_notice(findings),
+        reply_markup=MAIN_MENU_MARKUP
     )
     return MAIN_MENU
     
-# 18. & 19. Sleep Pattern and Position Handlers
-def sleep_pattern_menu_keyboard():
-    return [
-        [InlineKeyboardButton("Falling asleep", callback_data='falling_asleep')],
-        [InlineKeyboardButton("Shorter sleep time", callback_data='short_time')],
-        [InlineKeyboardButton("Feeling tired when waking up", callback_data='feeling_tired')],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
-    ]
-
-def sleep_position_menu_keyboard():
-    return [
-        [InlineKeyboardButton("On the back", callback_data='back')],
-        [InlineKeyboardButton("Side sleeping", callback_data='side')],
-        [InlineKeyboardButton("Use of two pillows", callback_data='two_pillows')],
-        [InlineKeyboardButton("Orthopnea", callback_data='orthopnea')],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')],
-    ]
-
 # 20. Postoperative quality of recovery
 
 # Quality of Recovery (QoR-15) Questionnaire
@@ -859,50 +4589,40 @@ QOR_QUESTIONS = [
     "15. Feeling sad or depressed"
 ]
 
-# QoR response options (0-10 scale)
-def qor_response_keyboard():
-    """Create response keyboard for QoR questions"""
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("0 = none of the time (Poor)", callback_data='0')
-        ],
-        [
-            InlineKeyboardButton("1", callback_data='1'),
-            InlineKeyboardButton("2", callback_data='2'),
-            InlineKeyboardButton("3", callback_data='3')
-        ],
-        [
-            InlineKeyboardButton("4", callback_data='4'),
-            InlineKeyboardButton("5", callback_data='5'),
-            InlineKeyboardButton("6", callback_data='6'),
-        ],
-        [
-            InlineKeyboardButton("7", callback_data='7'),
-            InlineKeyboardButton("8", callback_data='8'),
-            InlineKeyboardButton("9", callback_data='9')
-        ],
-        [
-            InlineKeyboardButton("10 = all of the time (Excellent)", callback_data='10')
-        ],
-        [InlineKeyboardButton("◀ Back to Main Menu", callback_data='back_to_main')]
-    ])
+def score_qor(answers):
+    """Total score and interpretation of QoR-15 answers.
+
+    Questions 11-15 are about symptoms, so their scores are inverted.
+    """
+    total_score = sum(answers[:10]) +(20 - sum(answers[10:13])) +(20 - sum(answers[13:15]))
+    
+    # Interpretation (QoR-15 ranges: 0-30 poor, 31-80 moderate, 81-150 good)
+    if total_score <= 30:
+        interpretation = "Poor recovery"
+    elif total_score <= 80:
+        interpretation = "Moderate recovery"
+    else:
+        interpretation = "Good recovery"
+    return total_score, interpretation
 
 async def start_qor_assessment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start Postoperative Quality of Recovery assessment"""
     
+    # All 15 answers sent at once
+    if looks_like_answers(update.message.text):
+        return await score_qor_batch(update, context, QOR_ASSESSMENT_MENU)
+    
     # Initialize assessment data
-    context.user_data['qor_assessment'] = {
-        'current_question': 0,
-        'answers': [],
-        'start_time': datetime.now().isoformat()
-    }
+    context.user_data.qor = Questionnaire()
     
     # Ask first question
     await update.message.reply_text(
-        text="Postoperative Quality of Recovery (QoR-15)\n\n"
+        text="Postoperative Quality of Recovery (QoR-15)\n"
+             f"Tip: you can also send all {len(QOR_QUESTIONS)} answers (0-10) in one message, "
+             "e.g. '8 7 9 ...'\n\n"
              "Please rate your recovery experience (0 = worst, 10 = best)\n\n"
              f"{QOR_QUESTIONS[0]}",
-        reply_markup=qor_response_keyboard()
+        reply_markup=QOR_RESPONSE_MARKUP
     )
     return ENTER_QOR_RESPONSE
 
@@ -914,18 +4634,17 @@ async def handle_qor_response(update: Update, context: ContextTypes.DEFAULT_TYPE
     if query.data == 'back_to_main':
         await query.edit_message_text(
             "Main Menu:",
-            reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+            reply_markup=MAIN_MENU_MARKUP
         )
         return MAIN_MENU
     
     # Store the answer (0-10 scale)
-    assessment = context.user_data['qor_assessment']
-    assessment['answers'].append(int(query.data))
-    current_q = assessment['current_question'] + 1
+    assessment = context.user_data.qor
+    assessment.answers.append(int(query.data))
+    current_q = assessment.current_question
     
     if current_q < len(QOR_QUESTIONS):
         # Ask next question
-        assessment['current_question'] = current_q
         question_text = QOR_QUESTIONS[current_q]
         
         # Adjust instructions for pain questions (11-12)
@@ -936,60 +4655,70 @@ async def handle_qor_response(update: Update, context: ContextTypes.DEFAULT_TYPE
             text=f"Postoperative Quality of Recovery (QoR-15)\n\n"
                  f"{instructions}\n\n"
                  f"{question_text}",
-            reply_markup=qor_response_keyboard()
+            reply_markup=QOR_RESPONSE_MARKUP
         )
         return ENTER_QOR_RESPONSE
     else:
-        # Assessment complete - calculate scores
-        total_score = sum(assessment['answers'][:10]) +(20 - sum(assessment['answers'][10:13])) +(20 - sum(assessment['answers'][13:15]))
-        
-        assessment['total_score'] = total_score
-        assessment['end_time'] = datetime.now().isoformat()
-        
-        # Interpretation (QoR-15 ranges: 0-30 poor, 31-80 moderate, 81-150 good)
-        if total_score <= 30:
-            interpretation = "Poor recovery"
-        elif total_score <= 80:
-            interpretation = "Moderate recovery"
-        else:
-            interpretation = "Good recovery"
-        
-        # Save results
-        user_id = context.user_data['patient_id']
-        record = {
-            "type": "qor_assessment",
-            "assessment": "QoR-15",
-            "score": total_score,
-            "interpretation": interpretation,
-            "answers": assessment['answers'],
-            "timestamp": assessment['start_time'],
-            "duration_seconds": (datetime.now() - datetime.fromisoformat(assessment['start_time'])).total_seconds()
-        }
-        save_patient_record(user_id, record)
-        
-        # Alert doctor if poor recovery
-        if total_score <= 80:
-            await alert_doctor(
-                context,
-                user_id,
-                "postop_recovery",
-                f"QoR-15 Score: {total_score} ({interpretation})",
-                {}
-            )
-        
+        # Assessment complete
         await query.edit_message_text(
-            text=f"✅ Postoperative Recovery Assessment Completed\n\n"
-                 f"Total QoR-15 score: {total_score}/150\n"
-                 f"Interpretation: {interpretation}\n\n"
-                 "Scores:\n"
-                 f"- Physical comfort: {sum(assessment['answers'][:5])/5.0:.1f}/10\n"
-                 f"- Emotional state: {sum(assessment['answers'][13:15])/2.0:.1f}/10\n"
-                 f"- Pain control: {sum(assessment['answers'][10:12])/2.0:.1f}/10",
-            reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+            text=await complete_qor_assessment(context, assessment),
+            reply_markup=MAIN_MENU_MARKUP
             
         )
         return MAIN_MENU
 
+async def enter_qor_batch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Process all QoR answers sent in one message"""
+    return await score_qor_batch(update, context, ENTER_QOR_RESPONSE)
+
+async def score_qor_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, retry_state: int) -> int:
+    """Validate and score a one-message QoR-15; stay in retry_state if invalid."""
+    try:
+        answers = parse_answers(update.message.text, len(QOR_QUESTIONS), QOR_MAX_ANSWER)
+    except ValueError as e:
+        await update.message.reply_text(f"⚠️ {e}\nPlease try again:", reply_markup=BACK_TO_MAIN_MARKUP)
+        return retry_state
+    
+    assessment = context.user_data.qor
+    if retry_state == QOR_ASSESSMENT_MENU or assessment is None:
+        assessment = context.user_data.qor = Questionnaire()
+    assessment.answers = array('b', answers)
+    
+    await update.message.reply_text(
+        await complete_qor_assessment(context, assessment, entry_mode='batch'),
+        reply_markup=MAIN_MENU_MARKUP
+    )
+    return MAIN_MENU
+
+async def complete_qor_assessment(context: ContextTypes.DEFAULT_TYPE, assessment: Questionnaire,
+                                  entry_mode: str = 'interactive') -> str:
+    """Score a finished QoR-15, save it, alert the doctor if needed and return the summary."""
+    total_score, interpretation = score_qor(assessment.answers)
+    context.user_data.qor = None
+    
+    # Save results
+    user_id = context.user_data.patient_id
+    record = {
+        "type": "qor_assessment",
+        "assessment": "QoR-15",
+        "score": total_score,
+        "interpretation": interpretation,
+        "answers": assessment.answers.tolist(),
+        "entry_mode": entry_mode,
+        "timestamp": assessment.start_time.isoformat(),
+        "duration_seconds": time.time() - assessment.started
+    }
+    findings = await check_record(context, user_id, record)
+    await save_patient_record(user_id, record)
+    
+    return (f"✅ Postoperative Recovery Assessment Completed\n\n"
+            f"Total QoR-15 score: {total_score}/150\n"
+            f"Interpretation: {interpretation}\n\n"
+            "Scores:\n"
+            f"- Physical comfort: {sum(assessment.answers[:5])/5.0:.1f}/10\n"
+            f"- Emotional state: {sum(assessment.answers[13:15])/2.0:.1f}/10\n"
+            f"- Pain control: {sum(assessment.answers[10:12])/2.0:.1f}/10" + findings_notice(findings))
+
 # ======================
 # HELPER FUNCTIONS
 # ======================
@@ -1001,15 +4730,13 @@ async def handle_submenu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if query.data == 'back_to_main':
         await query.edit_message_text(
             "Main Menu:",
-            reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+            reply_markup=MAIN_MENU_MARKUP
         )
         return MAIN_MENU
     else:
-        user_id = context.user_data['patient_id']
+        user_id = context.user_data.patient_id
         text = query.data
-        current_parameter = context.user_data['current_parameter']
-        print(current_parameter)
-        await alert_doctor(context, user_id, current_parameter, text, {})
+        current_parameter = context.user_data.current_parameter
         
         record = {
             "type": current_parameter,
@@ -1017,53 +4744,167 @@ async def handle_submenu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "timestamp": datetime.now().isoformat()
         }
         
-        save_patient_record(user_id, record)
+        findings = await check_record(context, user_id, record)
+        await save_patient_record(user_id, record)
         
         await query.edit_message_text(
-            "✅ Problem recorded",
-            reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+            "✅ Problem recorded" + findings_notice(findings),
+            reply_markup=MAIN_MENU_MARKUP
         )
         return MAIN_MENU
 
-def save_patient_record(user_id: int, record: dict):
-    """Save patient record to JSON file."""
-    filename = os.path.join(DATA_DIR, f"patient_{user_id}.json")
-    
-    if os.path.exists(filename):
-        with open(filename, 'r') as f:
-            data = json.load(f)
-    else:
-        data = {"records": []}
-    
-    data['records'].append(record)
-    
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=2)
-
-async def alert_doctor(context: ContextTypes.DEFAULT_TYPE, patient_id: int, 
-                     parameter: str, value: float, param_info: dict):
-    """Send alert to doctor about out-of-range value."""
-    message = (
-        f"🚨 PATIENT ALERT\n"
-        f"Patient ID: {patient_id}\n"
-        f"Parameter: {parameter.replace('_', ' ')}\n"
-        f"Value: {value}{param_info.get('unit', '')} "
-    )
-    #print(param_info)
-    if param_info:
-        if 'min' in param_info and value < param_info['min']:
-            message += f"(below minimum of {param_info['min']}{param_info['unit']})"
+async def save_patient_record(user_id: int, record: dict):
+    """Queue patient record for the record store."""
+    await record_writer.submit(user_id, record)
+
+def load_patient_records(user_id: int):
+    """Yield all records of a patient, oldest first."""
+    return record_store.records(user_id)
+
+def query_patient_records(user_id: int, record_type=None, since=None, until=None):
+    """Stream a patient's records of the given type(s) within [since, until)."""
+    for _, record in record_store.query(user_id, record_type, since, until):
+        yield record
+
+async def load_vital_summary(user_id: int) -> dict:
+    """Running vital sign aggregates of a patient, keyed by parameter."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, record_store.vital_summary, user_id)
+
+def format_vital_summary(patient_id: int, summary: dict) -> str:
+    """Doctor-facing text of a patient's vital sign aggregates."""
+    lines = [f"📊 Vital signs of patient {patient_id}"]
+    for parameter, param_info in PARAMETER_RANGES.items():
+        aggregate = summary.get(parameter)
+        if aggregate is None:
+            continue
+        unit = param_info.get('unit', '')
+        line = (
+            f"\n{parameter.replace('_', ' ')}: last {aggregate['last_value']:g}{unit} "
+            f"({aggregate['last_time'][:16].replace('T', ' ')})\n"
+            f"  mean {aggregate['mean']:.1f}, trend {aggregate['ewma']:.1f}, "
+            f"range {aggregate['min']:g}-{aggregate['max']:g}, {aggregate['count']} readings"
+        )
+        if aggregate['out_of_range_streak']:
+            line += f"\n  ⚠️ out of range {aggregate['out_of_range_streak']} times in a row"
+        lines.append(line)
+    if len(lines) == 1:
+        lines.append("No vital signs recorded yet.")
+    return "\n".join(lines)
+
+async def vital_summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send a care team member the vital sign summary of a patient: /summary <patient_id>."""
+    try:
+        patient_id = int(context.args[0])
+    except (IndexError, ValueError):
+        patient_id = None
+    if not care_teams.is_member(update.effective_chat.id, patient_id):
+        return
+    if patient_id is None:
+        await update.message.reply_text("Usage: /summary <patient_id>")
+        return
+    summary = await load_vital_summary(patient_id)
+    await update.message.reply_text(format_vital_summary(patient_id, summary))
+
+PROFILE_USAGE = (
+    "/profile sample <N> [pstats|collapsed] - profile 1 update in N\n"
+    "/profile window <seconds> [pstats|collapsed] - profile everything for a while\n"
+    "/profile stop - write the results\n"
+    "/profile - show the status"
+)
+
+def profile_report(path) -> str:
+    """Reply text for a finished profile written to `path` (None if nothing was profiled)."""
+    if path is None:
+        return "Nothing was profiled."
+    return f"Profile written to {path}\n\n{update_profiler.summary()}"[:4000]
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Control the handler profiler from an admin chat (see PROFILE_USAGE)."""
+    if str(update.effective_chat.id) not in ADMIN_CHAT_IDS:
+        return
+    args = context.args
+    if not args:
+        if update_profiler.enabled:
+            running = time.monotonic() - update_profiler.started
+            text = (f"Profiling in {update_profiler.mode} mode ({update_profiler.format}) for {running:.0f}s, "
+                    f"{update_profiler.calls} handler calls profiled")
         else:
-            message += f"(above maximum of {param_info['max']}{param_info['unit']})"
-        
-    await context.bot.send_message(chat_id=DOCTOR1_CHAT_ID, text=message)
-    await context.bot.send_message(chat_id=DOCTOR2_CHAT_ID, text=message)
+            text = "Profiling is off."
+        await update.message.reply_text(text)
+        return
+
+    if args[0] == "stop":
+        await update.message.reply_text(profile_report(update_profiler.stop()))
+        return
+
+    chat_id = update.effective_chat.id
+
+    async def report_window(path):
+        try:
+            await context.bot.send_message(chat_id=chat_id, text=profile_report(path))
+        except Exception:
+            logger.exception("Could not send the profile report to %s", chat_id)
+
+    try:
+        update_profiler.start(args[0], float(args[1]), args[2] if len(args) > 2 else "pstats",
+                              on_window_end=report_window)
+    except IndexError:
+        await update.message.reply_text(PROFILE_USAGE)
+        return
+    except ValueError as exc:
+        await update.message.reply_text(f"{exc}\n\n{PROFILE_USAGE}")
+        return
+    await update.message.reply_text(f"Profiling started: {' '.join(args)}")
+
+async def check_record(context: ContextTypes.DEFAULT_TYPE, patient_id: int, record: dict) -> list:
+    """Run the clinical rules on a new record, flag it and alert the doctors if any match."""
+    findings = rule_engine.evaluate(patient_id, record)
+    if findings:
+        record["needs_attention"] = True
+        await alert_doctor(context, patient_id, findings)
+    return findings
+
+def held_for_digest(findings) -> bool:
+    """Whether alert_doctor() holds the findings for the doctor digest."""
+    return min(finding.priority for finding in findings) >= PRIORITY_ROUTINE and doctor_digest.enabled
+
+def findings_notice(findings) -> str:
+    """Line added to the patient's reply about a record with findings."""
+    if not findings:
+        return ""
+    if held_for_digest(findings):
+        return "\nYour care team will review this."
+    return "\nA doctor has been notified."
+
+async def alert_doctor(context: ContextTypes.DEFAULT_TYPE, patient_id: int, findings):
+    """Alert the care team about the rule findings of a record.
+
+    Repeated findings about the same parameter are merged into one message
+    (see AlertCoalescer). Records with only "digest" findings are held for
+    the next doctor digest instead.
+    """
+    if held_for_digest(findings):
+        await doctor_digest.add(patient_id, findings)
+        return
+    priority = min(finding.priority for finding in findings)
+    lines = []
+    for finding in findings:
+        line = f"Parameter: {finding.parameter.replace('_', ' ')}\nValue: {finding.value}"
+        if finding.detail:
+            line += f" ({finding.detail})"
+        if line not in lines:
+            lines.append(line)
+    await alert_coalescer.submit(
+        (patient_id, findings[0].parameter), f"Patient ID: {patient_id}", "\n".join(lines),
+        care_teams.recipients(patient_id, priority), priority,
+    )
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the conversation."""
     await update.message.reply_text(
         "Operation cancelled.",
-        reply_markup=InlineKeyboardMarkup(main_menu_keyboard())
+        reply_markup=MAIN_MENU_MARKUP
     )
     return MAIN_MENU
 
@@ -1071,24 +4912,103 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 # BOT SETUP
 # ======================
 
-def main():
-    """Run the bot."""
-    # Create the application and pass it your bot's token
-    # and the chat ID of the doctor
-    # Set up the application with the bot token and chat ID
-    # Replace with your bot token and doctor chat IDs
-    Bot_token = "" # Your bot token here
-    application = Application.builder().token(Bot_token).build()
+async def post_init(application: Application):
+    """Start the background workers once the application is initialized."""
+    await record_writer.start()
+    await rule_engine.start()
+    await care_teams.start()
+    await alert_outbox.start(application.bot)
+    await doctor_digest.start()
+    await trend_monitor.start()
+    await reminder_scheduler.start(application.bot)
+    await metrics_server.start()
+    await session_persistence.start(application)
+    await update_deduplicator.start()
+
+async def post_shutdown(application: Application):
+    """Stop the alert dispatcher and flush queued records when the bot stops."""
+    await update_deduplicator.stop()
+    await session_persistence.stop()
+    await metrics_server.stop()
+    await reminder_scheduler.stop()
+    await trend_monitor.stop()
+    await doctor_digest.stop()
+    await alert_outbox.stop()
+    await care_teams.stop()
+    await rule_engine.stop()
+    await record_writer.stop()
+    record_store.close()
+    reminder_store.close()
+
+class CountingRequest(BaseRequest):
+    """Pass Bot API calls through to `request`, counting them per method in BOT_API_CALLS.
+
+    Counting at the transport sees every call, with or without the rate
+    limiter, including the retries after a flood wait.
+    """
+
+    def __init__(self, request: BaseRequest):
+        self.request = request
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    @property
+    def read_timeout(self):
+        return self.request.read_timeout
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        BOT_API_CALLS.inc((url.rsplit('/', 1)[-1],))
+        return await self.request.do_request(url, method, request_data, read_timeout=read_timeout,
+                                             write_timeout=write_timeout, connect_timeout=connect_timeout,
+                                             pool_timeout=pool_timeout)
+
+def build_application(token: str = BOT_TOKEN, request: BaseRequest = None,
+                      rate_limit: bool = True, update_workers: int = UPDATE_WORKERS) -> Application:
+    """Create the application with all handlers registered.
+
+    `request` replaces the HTTP transport to the Bot API, e.g. with a
+    LocalBotApiRequest to run without network access. `rate_limit=False`
+    leaves outbound calls unthrottled (for load tests against a local API).
+    `update_workers` is the number of updates handled concurrently (see
+    ChatOrderedUpdateProcessor).
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .context_types(CONTEXT_TYPES)
+        .persistence(session_persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if rate_limit:
+        builder = builder.rate_limiter(PriorityRateLimiter())
+    if update_workers > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(update_workers))
+    if request is None:
+        # The transports ApplicationBuilder would create, so they can be wrapped
+        request, updates_request = HTTPXRequest(connection_pool_size=256), HTTPXRequest(connection_pool_size=1)
+    else:
+        updates_request = request
+    builder = builder.request(CountingRequest(request)).get_updates_request(CountingRequest(updates_request))
+    application = builder.build()
     
     conv_handler = ConversationHandler(
+        name="homecare",
+        persistent=True,
         entry_points=[CommandHandler('start', start)],
         states={
             MAIN_MENU: [
-                CallbackQueryHandler(main_menu, pattern='^(vital_signs|pain|respiratory|gastrointestinal|consciousness|emotional_status|medication_compliance|wound_healing|postop_adaptation|stocking_socks|diet_compliance|activity_adaptation|daily_mobilization|social_adaptation|shower|return_to_work|driving|sleep_pattern|sleep_position|postoperative_quality_of_recovery)$')
+                CallbackQueryHandler(main_menu, pattern=callback_pattern(MAIN_MENU_MARKUP))
             ],
             
             VITAL_SIGNS_MENU: [
-                CallbackQueryHandler(vital_signs_menu, pattern='^(heart_rate|systolic_blood_pressure|diastolic_blood_pressure|respiration_rate|temperature|back_to_main)$')
+                CallbackQueryHandler(vital_signs_menu, pattern=callback_pattern(VITAL_SIGNS_MENU_MARKUP))
             ],
             ENTER_VITAL_SIGN_VALUE: [
                 MessageHandler(TEXT & ~COMMAND, enter_vital_sign_value)
@@ -1097,21 +5017,22 @@ def main():
                 MessageHandler(TEXT & ~COMMAND, enter_pain_score)
             ],
             ENTER_PAIN_LOCATION: [
-                CallbackQueryHandler(enter_pain_location, pattern='^(surgery_site|outside_surgery_site|chest|leg|anterior_chest|arm|back|back_to_main)$')
+                CallbackQueryHandler(enter_pain_location, pattern=callback_pattern(PAIN_LOCATION_MENU_MARKUP))
             ],
             ENTER_PAIN_TYPE: [
-                CallbackQueryHandler(enter_pain_type, pattern='^(fixed_continuous|stabbing|pulsating|related_to_movement|unlike_previous_ones|enter_pain_type|back_to_main)$')
+                CallbackQueryHandler(enter_pain_type, pattern=callback_pattern(
+                    ANTERIOR_CHEST_MENU_MARKUP, PAIN_BACK_MENU_MARKUP, PAIN_TYPE_MENU_MARKUP))
             ],
             ENTER_PAIN_SYMPTOMS: [
                 MessageHandler(TEXT & ~COMMAND, enter_pain_symptoms)
             ],
             
             RESPIRATORY_SYSTEM: [
-                CallbackQueryHandler(handle_submenu, pattern='^(superficial_breathing|more_30_beats|no_breadthe|impaired_consciousness|back_to_main)$')
+                CallbackQueryHandler(handle_submenu, pattern=callback_pattern(RESPIRATORY_MENU_MARKUP))
             ],
             
             GASTROINTESTINAL_SYSTEM: [
-                CallbackQueryHandler(handle_submenu, pattern='^(constipation|diarrhea|systolic_blood_pressure|fever|no_appetite|too_weak|back_to_main)$')
+                CallbackQueryHandler(handle_submenu, pattern=callback_pattern(GASTROINTESTINAL_MENU_MARKUP))
             ],
 
             CONSCIOUSNESS: [
@@ -1122,11 +5043,12 @@ def main():
                 MessageHandler(TEXT & ~COMMAND, start_emotional_assessment)
             ],
             ENTER_EMOTIONAL_STATUS: [
-                CallbackQueryHandler(handle_emotional_response)
+                CallbackQueryHandler(handle_emotional_response),
+                MessageHandler(TEXT & ~COMMAND, enter_emotional_batch)
             ],
             
             PROBLEM_MENU: [
-                CallbackQueryHandler(handle_problem_menu, pattern='^(no_problem|problem|back_to_main)$')
+                CallbackQueryHandler(handle_problem_menu, pattern=callback_pattern(PROBLEM_MENU_MARKUP))
             ],
 
             ENTER_PROBLEM_DESCRIPTION: [
@@ -1134,22 +5056,23 @@ def main():
             ],
 
             WOUND_HEALING_MENU: [
-                CallbackQueryHandler(enter_wound_info, pattern='^(wound_dranaige|increased_redness|color_changed|fever|back_to_main)$')
+                CallbackQueryHandler(enter_wound_info, pattern=callback_pattern(WOUND_HEALING_MENU_MARKUP))
             ],
             
             SLEEP_PATTERN: [
-                CallbackQueryHandler(handle_submenu, pattern='^(falling_asleep|short_time|feeling_tired|back_to_main)$')
+                CallbackQueryHandler(handle_submenu, pattern=callback_pattern(SLEEP_PATTERN_MENU_MARKUP))
             ],
 
             SLEEP_POSITION: [
-                CallbackQueryHandler(handle_submenu, pattern='^(back|side|two_pillows|orthopnea|back_to_main)$')
+                CallbackQueryHandler(handle_submenu, pattern=callback_pattern(SLEEP_POSITION_MENU_MARKUP))
             ],
 
             QOR_ASSESSMENT_MENU: [
                 MessageHandler(TEXT & ~COMMAND, start_qor_assessment)
             ],
             ENTER_QOR_RESPONSE: [
-                CallbackQueryHandler(handle_qor_response)
+                CallbackQueryHandler(handle_qor_response),
+                MessageHandler(TEXT & ~COMMAND, enter_qor_batch)
             ],
             
             DOCTOR_ALERT: [
@@ -1160,10 +5083,912 @@ def main():
     )
     
     
+    session_persistence.track(conv_handler)
+    application.add_handler(TypeHandler(Update, update_deduplicator.check), group=-2)
+    application.add_handler(TypeHandler(Update, session_persistence.load_session), group=-1)
     application.add_handler(conv_handler)
     # Handle the case when a user sends /start but they're not in a conversation
     application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('summary', vital_summary_command))
+    application.add_handler(CommandHandler('profile', profile_command))
+
+    for handlers in application.handlers.values():
+        instrument_handlers(handlers)
+    ACTIVE_CONVERSATIONS.function = functools.partial(conversations_per_state, conv_handler)
+    REMINDERS_LOADED.function = lambda: {(): len(reminder_scheduler)}
+    return application
+
+def setup_logging():
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+
+def main():
+    """Run the bot with long polling."""
+    setup_logging()
+    application = build_application()
     application.run_polling()
 
+# ======================
+# WEBHOOK MODE
+# ======================
+
+class LocalBotApiRequest(BaseRequest):
+    """Answer Bot API calls locally instead of sending them to Telegram.
+
+    Used by the local webhook test mode: getMe returns a placeholder bot,
+    sendMessage and editMessageText return a message echoing the request,
+    and every other method returns True. Calls are counted per method, and
+    an optional latency simulates the round trip to the API.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self.messages = {}     # chat ID -> last message sent or edited there
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data is not None else {}
+
+        if endpoint == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "HomecareBot", "username": "homecare_local_bot"}
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            chat_id = params.get('chat_id')
+            result = {
+                "message_id": params.get('message_id') or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, "type": "private"},
+                "text": params.get('text', ''),
+            }
+            self.messages[result["chat"]["id"]] = result
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode('utf-8')
+
+def create_webhook_app(application: Application, secret: str):
+    """aiohttp app that queues updates POSTed to WEBHOOK_PATH.
+
+    Requests must carry the secret in X-Telegram-Bot-Api-Secret-Token. The
+    update is put on the application's update queue and acknowledged at once;
+    handlers run in the background.
+    """
+    from aiohttp import web
+
+    async def receive_update(request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), secret.encode('utf-8')):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception:
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def health(request):
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive_update)
+    app.router.add_get("/healthz", health)
+    return app
+
+async def run_webhook(application: Application, listen: str, port: int, secret: str,
+                      webhook_url: str = None):
+    """Serve updates over HTTP until SIGINT/SIGTERM.
+
+    If webhook_url is given it is registered with Telegram together with the
+    secret; otherwise (local test mode) nothing is registered.
+    """
+    from aiohttp import web
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=webhook_url, secret_token=secret, allowed_updates=Update.ALL_TYPES
+            )
+
+        runner = web.AppRunner(create_webhook_app(application, secret))
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+        logger.info("Listening for updates on http://%s:%d%s", listen, port, WEBHOOK_PATH)
+        try:
+            await stop.wait()
+        finally:
+            await runner.cleanup()
+            await application.stop()
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def main_webhook(local: bool = False):
+    """Run the bot behind an embedded webhook server.
+
+    In local mode no webhook is registered and Bot API calls are answered by
+    LocalBotApiRequest, so updates can be replayed without network access;
+    the server then only listens on 127.0.0.1. Otherwise HOMECARE_WEBHOOK_SECRET
+    is required, so every replica checks the same secret.
+    """
+    setup_logging()
+    if local:
+        application = build_application(BOT_TOKEN or "0:local", request=LocalBotApiRequest())
+        asyncio.run(run_webhook(application, "127.0.0.1", WEBHOOK_PORT, WEBHOOK_SECRET or "local"))
+        return
+
+    if not WEBHOOK_URL:
+        raise SystemExit("Set HOMECARE_WEBHOOK_URL to the public URL of the webhook")
+    if not WEBHOOK_SECRET:
+        raise SystemExit("Set HOMECARE_WEBHOOK_SECRET; every replica must use the same secret")
+    secret = WEBHOOK_SECRET
+    application = build_application()
+    asyncio.run(run_webhook(application, WEBHOOK_LISTEN, WEBHOOK_PORT, secret,
+                            webhook_url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH))
+
+def load_fixture(path: str):
+    """Read updates from a JSON array or a JSON Lines file."""
+    with open(path, 'r') as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+async def replay_updates(path: str, url: str, secret: str, concurrency: int = 10):
+    """POST the updates of a fixture file to a webhook and report throughput.
+
+    Updates of the same chat are sent one after another in file order; up to
+    `concurrency` chats are replayed in parallel.
+    """
+    import aiohttp
+
+    by_chat = {}
+    for update in load_fixture(path):
+        body = update.get('message') or update.get('callback_query', {}).get('message') or {}
+        chat_id = body.get('chat', {}).get('id')
+        by_chat.setdefault(chat_id, []).append(update)
+
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret}
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def replay_chat(session, updates):
+        nonlocal failures
+        async with semaphore:
+            for update in updates:
+                async with session.post(url, json=update, headers=headers) as response:
+                    if response.status != 200:
+                        failures += 1
+
+    start_time = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(replay_chat(session, updates) for updates in by_chat.values()))
+    elapsed = time.perf_counter() - start_time
+    total = sum(len(updates) for updates in by_chat.values())
+    print(f"Posted {total} updates from {len(by_chat)} chats in {elapsed:.2f}s "
+          f"({total / elapsed:.0f} updates/s, {failures} rejected)")
+
+# ======================
+# LOAD TEST
+# ======================
+# Simulated patients are driven through the real application (conversation
+# handler, session persistence, record writer and alert outbox) while Bot API
+# calls are answered by LocalBotApiRequest. Each journey step names the handler
+# that processes it, so latencies are reported per handler. Point
+# HOMECARE_DATA_DIR at a scratch directory so no real patient data is touched.
+
+LOAD_TEST_FIRST_CHAT_ID = 900000000
+
+# Journeys from the main menu back to it, as (kind, data, handler) steps
+LOAD_TEST_JOURNEYS = {
+    "vital_signs": [
+        ("callback", "vital_signs", "main_menu"),
+        ("callback", "heart_rate", "vital_signs_menu"),
+        ("message", "88", "enter_vital_sign_value"),
+    ],
+    "pain": [
+        ("callback", "pain", "main_menu"),
+        ("message", "4", "enter_pain_score"),
+        ("callback", "anterior_chest", "enter_pain_location"),
+        ("callback", "stabbing", "enter_pain_type"),
+        ("message", "when I walk", "enter_pain_symptoms"),
+    ],
+    "bai": [
+        ("callback", "emotional_status", "main_menu"),
+        ("message", "a little nervous", "start_emotional_assessment"),
+    ] + [("callback", "0", "handle_emotional_response")] * len(EMOTIONAL_QUESTIONS),
+    "qor": [
+        ("callback", "postoperative_quality_of_recovery", "main_menu"),
+        ("message", "getting better", "start_qor_assessment"),
+    ] + [("callback", "9", "handle_qor_response")] * 10 + [("callback", "1", "handle_qor_response")] * 5,
+    "problem": [
+        ("callback", "medication_compliance", "main_menu"),
+        ("callback", "problem", "handle_problem_menu"),
+        ("message", "I forgot my evening pills", "enter_problem_info"),
+    ],
+}
+
+class LoadTestUpdates:
+    """Builds Telegram updates for simulated patients."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, chat_id: int) -> dict:
+        return {"id": chat_id, "is_bot": False, "first_name": f"Patient {chat_id}"}
+
+    def message(self, chat_id: int, text: str) -> dict:
+        message = {
+            "message_id": next(self._ids), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "from": self._user(chat_id), "text": text,
+        }
+        if text.startswith('/'):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._ids), "message": message}
+
+    def callback(self, chat_id: int, data: str, message: dict = None) -> dict:
+        """Tap on a button of `message` (the last message the bot sent to the chat)."""
+        message = message or {"message_id": 1, "text": "Main Menu:"}
+        return {"update_id": next(self._ids), "callback_query": {
+            "id": str(next(self._ids)), "chat_instance": str(chat_id), "data": data,
+            "from": self._user(chat_id),
+            "message": {"message_id": message["message_id"], "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"}, "text": message["text"]},
+        }}
+
+def percentile(sorted_values, q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q / 100 * len(sorted_values)))]
+
+async def run_load_test(users: int = 50, rounds: int = 1, journeys=None,
+                        api_latency: float = 0.0, think_time: float = 0.0,
+                        rate_limit: bool = False, workers: int = UPDATE_WORKERS,
+                        reminders: int = 0) -> dict:
+    """Run every journey `rounds` times for `users` concurrent patients.
+
+    Updates go through the application's update processor with `workers`
+    workers, as they would from the update queue. `reminders` reminders to
+    other chats fall due as the test starts and are sent alongside.
+
+    Returns the latencies per handler (seconds), the number of updates and
+    the elapsed time, the records written (and in how many group commits)
+    and the Bot API calls made.
+    """
+    journeys = journeys or list(LOAD_TEST_JOURNEYS)
+    request = LocalBotApiRequest(api_latency)
+    application = build_application("1:LOADTEST", request=request, rate_limit=rate_limit,
+                                    update_workers=workers)
+    builder = LoadTestUpdates()
+    latencies = {}
+
+    async def process(update: dict, handler: str):
+        update = Update.de_json(update, application.bot)
+        start_time = time.perf_counter()
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies.setdefault(handler, []).append(time.perf_counter() - start_time)
+        # Yield even without think time; a local API never does, so one
+        # patient would otherwise run its whole journey before the others
+        await asyncio.sleep(think_time)
+
+    async def patient(chat_id: int):
+        await process(builder.message(chat_id, "/start"), "start")
+        for _ in range(rounds):
+            for name in journeys:
+                for kind, data, handler in LOAD_TEST_JOURNEYS[name]:
+                    if kind == "callback":
+                        update = builder.callback(chat_id, data, request.messages.get(chat_id))
+                    else:
+                        update = builder.message(chat_id, data)
+                    await process(update, handler)
+
+    reminder_ids = reminder_store.add_many(
+        [(LOAD_TEST_FIRST_CHAT_ID + users + i, "vitals", ["09:00"], None, "") for i in range(reminders)],
+        first_due=time.time())
+    sent_before = sum(count for (_, result), count in REMINDERS_SENT.values.items() if result == "sent")
+    async with application:
+        await application.post_init(application)
+        start_time = time.perf_counter()
+        await asyncio.gather(*(patient(LOAD_TEST_FIRST_CHAT_ID + i) for i in range(users)))
+        handled = time.perf_counter() - start_time
+        sent = sum(count for (_, result), count in REMINDERS_SENT.values.items() if result == "sent")
+        await application.post_shutdown(application)
+        drained = time.perf_counter() - start_time
+    reminder_store.remove(reminder_ids)
+    reminder_store.close()
+
+    return {
+        "latencies": latencies,
+        "updates": sum(len(values) for values in latencies.values()),
+        "seconds": handled,
+        "records": record_writer.written,
+        "commits": record_writer.batches,
+        "write_seconds": drained,
+        "api_calls": dict(request.calls),
+        "reminders": sent - sent_before,
+    }
+
+def print_load_test_report(result: dict):
+    print(f"{'handler':<28} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for handler, values in sorted(result['latencies'].items()):
+        values = sorted(values)
+        print(f"{handler:<28} {len(values):>7} " + " ".join(
+            f"{percentile(values, q) * 1000:>8.2f}" for q in (50, 95, 99)))
+    print()
+    print(f"{result['updates']} updates in {result['seconds']:.2f}s "
+          f"({result['updates'] / result['seconds']:.0f} updates/s)")
+    print(f"{result['records']} records written in {result['commits']} group commits "
+          f"in {result['write_seconds']:.2f}s ({result['records'] / result['write_seconds']:.0f} records/s)")
+    if result['reminders']:
+        print(f"{result['reminders']} reminders sent while handling updates")
+    print("Bot API calls: " + ", ".join(f"{method} {count}" for method, count in sorted(result['api_calls'].items())))
+
+def legacy_session(patient_id: int) -> dict:
+    """user_data of a patient halfway through a BAI, as kept before PatientSession."""
+    return {
+        'patient_id': patient_id,
+        'current_vital': "".join(["heart", "_rate"]),
+        'current_parameter': "".join(["medication", "_compliance"]),
+        'pain_score': 4,
+        'pain_location': "".join(["anterior", "_chest"]),
+        'pain_type': "".join(["stab", "bing"]),
+        'consciousness_level': "".join(["Okay", ""]),
+        'emotional_assessment': {
+            'current_question': 10,
+            'answers': [int(answer) for answer in "0102100120"],
+            'start_time': datetime.now().isoformat(),
+        },
+        'qor_assessment': {
+            'current_question': 14,
+            'answers': [int(answer) for answer in "989998878899899"],
+            'start_time': datetime.now().isoformat(),
+            'total_score': 126,
+            'end_time': datetime.now().isoformat(),
+        },
+    }
+
+def compact_session(patient_id: int) -> PatientSession:
+    """The same patient as a PatientSession (finished assessments are cleared)."""
+    session = PatientSession()
+    session.patient_id = patient_id
+    session.current_vital = "".join(["heart", "_rate"])
+    session.current_parameter = "".join(["medication", "_compliance"])
+    session.pain_score = 4
+    session.pain_location = "".join(["anterior", "_chest"])
+    session.pain_type = "".join(["stab", "bing"])
+    session.bai = Questionnaire(int(answer) for answer in "0102100120")
+    return session
+
+def session_memory(factory, count: int) -> float:
+    """Bytes allocated per session when building `count` sessions with `factory`."""
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        sessions = {LOAD_TEST_FIRST_CHAT_ID + i: factory(LOAD_TEST_FIRST_CHAT_ID + i) for i in range(count)}
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del sessions
+    return allocated / count
+
+def print_session_benchmark(count: int = 10000):
+    legacy = session_memory(legacy_session, count)
+    compact = session_memory(compact_session, count)
+    print(f"{count} sessions halfway through a BAI, with a finished QoR-15 and pain assessment")
+    print(f"dict user_data:  {legacy:8.0f} bytes per session")
+    print(f"PatientSession:  {compact:8.0f} bytes per session ({compact / legacy:.0%})")
+
+# ======================
+# BULK EXPORT
+# ======================
+# Records are exported to one table per record type. Patients are split into
+# chunks exported by a process pool; each worker streams its patients' records
+# from the store and writes every table in batches of EXPORT_BATCH_ROWS rows to
+# its own part file, so memory stays bounded however large the cohort is.
+
+# Columns of each table after patient_id and timestamp, as (name, kind) with
+# kind one of "int", "float", "bool", "str"; other types use EXPORT_DEFAULT_COLUMNS
+EXPORT_COLUMNS = {
+    "vital_sign": [("parameter", "str"), ("value", "float"), ("unit", "str"), ("out_of_range", "bool")],
+    "pain_assessment": [("location", "str"), ("pain_type", "str"), ("symptoms", "str")],
+    "emotional_assessment": [
+        ("assessment", "str"), ("score", "int"), ("interpretation", "str"),
+        ("entry_mode", "str"), ("duration_seconds", "float"),
+    ] + [(f"q{i}", "int") for i in range(1, len(EMOTIONAL_QUESTIONS) + 1)],
+    "qor_assessment": [
+        ("assessment", "str"), ("score", "int"), ("interpretation", "str"),
+        ("entry_mode", "str"), ("duration_seconds", "float"),
+    ] + [(f"q{i}", "int") for i in range(1, len(QOR_QUESTIONS) + 1)],
+}
+EXPORT_DEFAULT_COLUMNS = [("description", "str"), ("needs_attention", "bool")]
+
+def export_table_name(record_type: str) -> str:
+    return re.sub(r'\W', '_', record_type) or "unknown"
+
+def export_row(patient_id: int, record: dict, columns) -> list:
+    """Flatten a record into a row of the table columns; answers become q1..qN."""
+    values = dict(record)
+    for i, answer in enumerate(record.get('answers') or [], 1):
+        values[f"q{i}"] = answer
+    row = [patient_id, record.get('timestamp')]
+    for name, kind in columns:
+        value = values.get(name)
+        row.append(bool(value) if kind == "bool" else value)
+    return row
+
+class ExportTableWriter:
+    """Writes the rows of one table to one CSV or Parquet part file."""
+
+    def __init__(self, path: str, columns, fmt: str):
+        self.path = path
+        self.columns = [("patient_id", "int"), ("timestamp", "time")] + list(columns)
+        self.fmt = fmt
+        self._file = None
+        self._writer = None
+
+    def write(self, rows):
+        if self.fmt == "csv":
+            import csv
+            if self._writer is None:
+                self._file = open(self.path, 'w', newline='', encoding='utf-8')
+                self._writer = csv.writer(self._file)
+                self._writer.writerow([name for name, _ in self.columns])
+            self._writer.writerows(rows)
+            return
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        types = {"int": pa.int64(), "float": pa.float64(), "bool": pa.bool_(),
+                 "str": pa.string(), "time": pa.timestamp('us')}
+        schema = pa.schema([(name, types[kind]) for name, kind in self.columns])
+        arrays = []
+        for i, (name, kind) in enumerate(self.columns):
+            column = [row[i] for row in rows]
+            if kind == "time":
+                column = [datetime.fromisoformat(value) if value else None for value in column]
+            elif kind == "float":
+                column = [None if value is None else float(value) for value in column]
+            elif kind == "str":
+                column = [None if value is None else str(value) for value in column]
+            arrays.append(pa.array(column, type=types[kind]))
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, schema)
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    def close(self):
+        if self._writer is not None and self.fmt == "parquet":
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+
+def export_patients(out_dir: str, fmt: str, part: int, patient_ids) -> dict:
+    """Export the records of some patients to part files; return rows per table.
+
+    Runs in a worker process with its own connection to the record store.
+    """
+    store = create_record_store(RECORD_STORE)
+    buffers, writers, counts, columns_of = {}, {}, {}, {}
+
+    def flush(table):
+        if table not in writers:
+            os.makedirs(os.path.join(out_dir, table), exist_ok=True)
+            path = os.path.join(out_dir, table, f"part-{part:05d}.{fmt}")
+            writers[table] = ExportTableWriter(path, columns_of[table], fmt)
+        writers[table].write(buffers[table])
+        buffers[table] = []
+
+    try:
+        for patient_id in patient_ids:
+            for _, record in store.query(patient_id):
+                table = export_table_name(str(record.get('type', '')))
+                if table not in columns_of:
+                    columns_of[table] = EXPORT_COLUMNS.get(record.get('type'), EXPORT_DEFAULT_COLUMNS)
+                buffers.setdefault(table, []).append(export_row(patient_id, record, columns_of[table]))
+                counts[table] = counts.get(table, 0) + 1
+                if len(buffers[table]) >= EXPORT_BATCH_ROWS:
+                    flush(table)
+        for table, rows in buffers.items():
+            if rows:
+                flush(table)
+    finally:
+        for writer in writers.values():
+            writer.close()
+        store.close()
+    return counts
+
+def merge_csv_parts(out_dir: str, table: str):
+    """Concatenate a table's CSV part files into <table>.csv with one header."""
+    part_dir = os.path.join(out_dir, table)
+    with open(os.path.join(out_dir, f"{table}.csv"), 'wb') as out:
+        for i, name in enumerate(sorted(os.listdir(part_dir))):
+            with open(os.path.join(part_dir, name), 'rb') as part:
+                header = part.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(part, out)
+    shutil.rmtree(part_dir)
+
+def export_records(out_dir: str, fmt: str = "csv", workers: int = None) -> dict:
+    """Export every record in the store to one table per record type.
+
+    CSV tables are written as <out_dir>/<type>.csv; Parquet tables as
+    datasets of part files in <out_dir>/<type>/ (requires pyarrow).
+    Returns the number of rows per table.
+    """
+    if fmt not in ("csv", "parquet"):
+        raise ValueError(f"Unknown export format: {fmt!r}")
+    if fmt == "parquet":
+        import pyarrow  # noqa: F401  (fail before starting the workers)
+    if os.path.isdir(out_dir) and os.listdir(out_dir):
+        raise ValueError(f"Export directory {out_dir!r} is not empty")
+    os.makedirs(out_dir, exist_ok=True)
+    patient_ids = record_store.patient_ids()
+    chunks = [patient_ids[i:i + EXPORT_CHUNK_PATIENTS]
+              for i in range(0, len(patient_ids), EXPORT_CHUNK_PATIENTS)]
+
+    start_time = time.perf_counter()
+    totals = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(export_patients, out_dir, fmt, part, chunk)
+                   for part, chunk in enumerate(chunks)]
+        for done, future in enumerate(as_completed(futures), 1):
+            for table, count in future.result().items():
+                totals[table] = totals.get(table, 0) + count
+            logger.info("Exported %d/%d patient chunks", done, len(chunks))
+    if fmt == "csv":
+        for table in totals:
+            merge_csv_parts(out_dir, table)
+
+    elapsed = time.perf_counter() - start_time
+    rows = sum(totals.values())
+    logger.info("Exported %d records of %d patients in %.1fs (%.0f records/s)",
+                rows, len(patient_ids), elapsed, rows / elapsed if elapsed else 0)
+    return totals
+
+# ======================
+# LEGACY MIGRATION
+# ======================
+# Moves the records of legacy patient_<id>.json files into the configured
+# record store, ahead of any records the patient already has there. Run it
+# while the bot is stopped. Each patient is migrated atomically and can be
+# migrated again safely after a crash; the original file is kept as
+# patient_<id>.json.migrated once the migrated records have been verified.
+
+LEGACY_FILE_PATTERN = re.compile(r'^patient_(-?\d+)\.json$')
+
+def iter_legacy_records(path: str):
+    """Stream the records of a legacy patient file.
+
+    With ijson installed the file is parsed incrementally, so memory does not
+    grow with its size; otherwise it is loaded whole.
+    """
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+    with open(path, 'rb') as f:
+        if ijson is None:
+            yield from json.load(f).get('records', [])
+        else:
+            yield from ijson.items(f, 'records.item', use_float=True)
+
+def record_checksum(records, limit: int = None):
+    """(count, sha256) over the canonical JSON of up to `limit` records."""
+    digest = hashlib.sha256()
+    count = 0
+    for record in records:
+        if limit is not None and count >= limit:
+            break
+        digest.update(json.dumps(record, sort_keys=True, ensure_ascii=False).encode('utf-8') + b"\n")
+        count += 1
+    return count, digest.hexdigest()
+
+def migrate_patient_jsonl(directory: str, patient_id: int) -> dict:
+    """Prepend a patient's legacy records to their JSONL log."""
+    store = JsonlRecordStore(directory)
+    legacy, log = store.legacy_path(patient_id), store.log_path(patient_id)
+    tmp = log + ".migrating"
+    digest = hashlib.sha256()
+    count = 0
+    try:
+        with open(tmp, 'wb') as out:
+            for record in iter_legacy_records(legacy):
+                digest.update(json.dumps(record, sort_keys=True, ensure_ascii=False).encode('utf-8') + b"\n")
+                out.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b"\n")
+                count += 1
+            checksum = digest.hexdigest()
+            # A run interrupted after replacing the log already left the records there
+            done = record_checksum(read_lines(log), count) == (count, checksum)
+            if not done and os.path.exists(log):
+                with open(log, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+            out.flush()
+            os.fsync(out.fileno())
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+    if done:
+        os.remove(tmp)
+    else:
+        for sidecar in (store.stats_path(patient_id), store.index_path(patient_id)):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+        os.replace(tmp, log)
+    if record_checksum(read_lines(log), count) != (count, checksum):
+        raise RuntimeError(f"Checksum mismatch after migrating patient {patient_id}")
+    os.replace(legacy, legacy + ".migrated")
+    # Rebuild the sidecars now that the whole history is in the log
+    store.vital_summary(patient_id)
+    store.load_index(patient_id)
+    return {"patient_id": patient_id, "records": count, "sha256": checksum,
+            "status": "verified" if done else "migrated"}
+
+def prepare_sqlite_migration(path: str):
+    """Create the SQLite store and its migrations table before the workers start."""
+    SqliteRecordStore(path).close()
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("""CREATE TABLE IF NOT EXISTS migrations (
+            patient_id INTEGER PRIMARY KEY, records INTEGER NOT NULL, sha256 TEXT NOT NULL)""")
+        conn.commit()
+    finally:
+        conn.close()
+
+def begin_immediate(conn, retries: int = MIGRATION_LOCK_RETRIES):
+    """Take the write lock of `conn`'s database, retrying while other writers hold it."""
+    for attempt in range(retries + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as exc:
+            if "locked" not in str(exc) or attempt == retries:
+                raise
+            logger.warning("Database is locked, retrying (%d/%d)", attempt + 1, retries)
+            time.sleep(min(2 ** attempt, 30))
+
+def migrate_patient_sqlite(path: str, directory: str, patient_id: int) -> dict:
+    """Insert a patient's legacy records into the SQLite store before their other records."""
+    legacy = os.path.join(directory, f"patient_{patient_id}.json")
+    # Parse outside the write lock so workers only serialize on the inserts
+    tmp = f"{legacy}.migrating"
+    digest = hashlib.sha256()
+    count = 0
+    try:
+        with open(tmp, 'wb') as out:
+            for record in iter_legacy_records(legacy):
+                digest.update(json.dumps(record, sort_keys=True, ensure_ascii=False).encode('utf-8') + b"\n")
+                row = [record.get('type', ''), record.get('timestamp', ''), json.dumps(record, ensure_ascii=False)]
+                out.write(json.dumps(row, ensure_ascii=False).encode('utf-8') + b"\n")
+                count += 1
+    except BaseException:
+        os.remove(tmp)
+        raise
+    checksum = digest.hexdigest()
+
+    # The schema is created by prepare_sqlite_migration(), so the only write is the transaction below
+    conn = sqlite3.connect(path, timeout=MIGRATION_LOCK_TIMEOUT, isolation_level=None)
+    try:
+        begin_immediate(conn)
+        try:
+            done = conn.execute("SELECT records, sha256 FROM migrations WHERE patient_id = ?",
+                                (patient_id,)).fetchone()
+            if done and tuple(done) != (count, checksum):
+                raise RuntimeError(f"Patient {patient_id} was migrated from a different file")
+            if not done:
+                existing = conn.execute(
+                    "SELECT type, timestamp, data FROM records WHERE patient_id = ? ORDER BY id",
+                    (patient_id,)).fetchall()
+                conn.execute("DELETE FROM records WHERE patient_id = ?", (patient_id,))
+                insert = "INSERT INTO records (patient_id, type, timestamp, data) VALUES (?, ?, ?, ?)"
+                batch = []
+                for row in read_lines(tmp):
+                    batch.append((patient_id, *row))
+                    if len(batch) >= 1000:
+                        conn.executemany(insert, batch)
+                        batch = []
+                conn.executemany(insert, batch)
+                conn.executemany(insert, [(patient_id, *row) for row in existing])
+
+                aggregates = fold_vital_records({}, (json.loads(data) for (data,) in conn.execute(
+                    "SELECT data FROM records WHERE patient_id = ? AND type = 'vital_sign' ORDER BY id",
+                    (patient_id,))))
+                conn.execute("DELETE FROM vital_stats WHERE patient_id = ?", (patient_id,))
+                conn.executemany(
+                    "INSERT INTO vital_stats (patient_id, parameter, data) VALUES (?, ?, ?)",
+                    [(patient_id, parameter, json.dumps(aggregate)) for parameter, aggregate in aggregates.items()])
+                conn.execute("INSERT INTO migrations (patient_id, records, sha256) VALUES (?, ?, ?)",
+                             (patient_id, count, checksum))
+
+            migrated = (json.loads(data) for (data,) in conn.execute(
+                "SELECT data FROM records WHERE patient_id = ? ORDER BY id LIMIT ?", (patient_id, count)))
+            if record_checksum(migrated) != (count, checksum):
+                raise RuntimeError(f"Checksum mismatch after migrating patient {patient_id}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+        os.remove(tmp)
+    os.replace(legacy, legacy + ".migrated")
+    return {"patient_id": patient_id, "records": count, "sha256": checksum,
+            "status": "verified" if done else "migrated"}
+
+def migrate_patient(backend: str, patient_id: int) -> dict:
+    """Migrate one patient's legacy file into the given record store backend."""
+    source_bytes = os.path.getsize(os.path.join(DATA_DIR, f"patient_{patient_id}.json"))
+    if backend == "jsonl":
+        result = migrate_patient_jsonl(DATA_DIR, patient_id)
+    elif backend == "sqlite":
+        result = migrate_patient_sqlite(SQLITE_PATH, DATA_DIR, patient_id)
+    else:
+        raise ValueError(f"Unknown record store backend: {backend!r}")
+    result['bytes'] = source_bytes
+    return result
+
+def migrate_legacy_records(workers: int = None, checkpoint_path: str = MIGRATION_CHECKPOINT_PATH) -> dict:
+    """Migrate every legacy patient file into the configured record store.
+
+    Patients are migrated in parallel by a process pool. Each finished
+    patient is appended to the checkpoint with its record count and
+    checksum, and patients already in the checkpoint are skipped, so an
+    interrupted migration resumes where it stopped.
+    """
+    done = {entry.get('patient_id') for entry in read_lines(checkpoint_path)}
+    pending = []
+    for name in os.listdir(DATA_DIR):
+        match = LEGACY_FILE_PATTERN.match(name)
+        if match and int(match.group(1)) not in done:
+            pending.append(int(match.group(1)))
+    pending.sort()
+    if RECORD_STORE == "sqlite":
+        prepare_sqlite_migration(SQLITE_PATH)
+    logger.info("Migrating %d legacy patient files (%d already done) into the %s store",
+                len(pending), len(done), RECORD_STORE)
+
+    start_time = last_report = time.perf_counter()
+    patients = records = source_bytes = failures = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(migrate_patient, RECORD_STORE, pid): pid for pid in pending}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception:
+                failures += 1
+                logger.exception("Migrating patient %s failed", futures[future])
+                continue
+            append_lines(checkpoint_path, json.dumps(result).encode('utf-8') + b"\n")
+            patients += 1
+            records += result['records']
+            source_bytes += result['bytes']
+            now = time.perf_counter()
+            if now - last_report >= 2 or patients + failures == len(pending):
+                last_report = now
+                elapsed = now - start_time
+                logger.info("Migrated %d/%d patients, %d records (%.0f records/s, %.1f MB/s)",
+                            patients, len(pending), records, records / elapsed,
+                            source_bytes / elapsed / 1e6)
+    return {"patients": patients, "records": records, "failed": failures,
+            "seconds": time.perf_counter() - start_time}
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Home care monitoring bot")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('polling', help="run with long polling (default)")
+    webhook_parser = commands.add_parser('webhook', help="run behind the embedded webhook server")
+    webhook_parser.add_argument('--local', action='store_true',
+                                help="don't register the webhook and answer Bot API calls locally")
+    replay_parser = commands.add_parser('replay', help="POST fixture updates to a running webhook")
+    replay_parser.add_argument('fixture', help="JSON array or JSON Lines file of updates")
+    replay_parser.add_argument('--url', default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    replay_parser.add_argument('--secret', default=WEBHOOK_SECRET or "local")
+    replay_parser.add_argument('--concurrency', type=int, default=10)
+    commands.add_parser('trends', help="run the vital sign trend check once and print the report")
+    commands.add_parser('rules', help="check the rules file and print the rules in force")
+    export_parser = commands.add_parser('export', help="export all records to one table per record type")
+    export_parser.add_argument('out_dir')
+    export_parser.add_argument('--format', choices=("csv", "parquet"), default="csv")
+    export_parser.add_argument('--workers', type=int, default=None,
+                               help="worker processes (default: one per CPU)")
+    load_parser = commands.add_parser('loadtest', help="drive simulated patients through the bot with a local Bot API")
+    load_parser.add_argument('--users', type=int, default=50, help="concurrent patients")
+    load_parser.add_argument('--rounds', type=int, default=1, help="times each patient runs every journey")
+    load_parser.add_argument('--journey', action='append', choices=sorted(LOAD_TEST_JOURNEYS),
+                             help="journey to run (repeatable; default: all)")
+    load_parser.add_argument('--api-latency', type=float, default=0.0, help="simulated Bot API round trip in seconds")
+    load_parser.add_argument('--think-time', type=float, default=0.0, help="seconds each patient waits between steps")
+    load_parser.add_argument('--rate-limit', action='store_true', help="keep the outbound rate limiter enabled")
+    load_parser.add_argument('--workers', type=int, default=UPDATE_WORKERS, help="updates handled concurrently")
+    load_parser.add_argument('--reminders', type=int, default=0, help="reminders due to other chats during the test")
+    reminder_parser = commands.add_parser('reminders', help="manage patient reminders")
+    reminder_commands = reminder_parser.add_subparsers(dest='action', required=True)
+    remind_add = reminder_commands.add_parser('add', help="schedule a reminder")
+    remind_add.add_argument('patient_id', type=int)
+    remind_add.add_argument('kind', choices=sorted(REMINDER_KINDS))
+    remind_add.add_argument('--at', action='append', required=True, help="HH:MM (repeatable)")
+    remind_add.add_argument('--days', help="comma separated, e.g. mon,thu (default depends on the kind)")
+    remind_add.add_argument('--text', default="", help="e.g. the medication and dose")
+    remind_list = reminder_commands.add_parser('list', help="list reminders")
+    remind_list.add_argument('--patient', type=int)
+    remind_remove = reminder_commands.add_parser('remove', help="delete reminders")
+    remind_remove.add_argument('ids', type=int, nargs='+')
+    bench_parser = commands.add_parser('sessionbench', help="measure the memory held per patient session")
+    bench_parser.add_argument('--sessions', type=int, default=10000, help="sessions to create")
+    migrate_parser = commands.add_parser('migrate', help="move legacy patient_<id>.json files into the record store")
+    migrate_parser.add_argument('--workers', type=int, default=None,
+                                help="worker processes (default: one per CPU)")
+    args = parser.parse_args()
+
+    if args.command == 'webhook':
+        main_webhook(local=args.local)
+    elif args.command == 'replay':
+        asyncio.run(replay_updates(args.fixture, args.url, args.secret, args.concurrency))
+    elif args.command == 'trends':
+        print_trend_report()
+    elif args.command == 'rules':
+        print(json.dumps(rule_engine.config, indent=2, ensure_ascii=False))
+    elif args.command == 'export':
+        setup_logging()
+        for table, rows in sorted(export_records(args.out_dir, args.format, args.workers).items()):
+            print(f"{table}: {rows} rows")
+    elif args.command == 'loadtest':
+        logging.basicConfig(level=logging.ERROR)
+        print_load_test_report(asyncio.run(run_load_test(
+            args.users, args.rounds, args.journey, args.api_latency, args.think_time, args.rate_limit,
+            args.workers, args.reminders)))
+    elif args.command == 'reminders':
+        if args.action == 'add':
+            days = args.days.split(',') if args.days else None
+            print(reminder_store.add(args.patient_id, args.kind, args.at, days, args.text))
+        elif args.action == 'list':
+            for reminder in reminder_store.schedules(args.patient):
+                print(f"{reminder.id}\t{reminder.patient_id}\t{reminder.kind}\t{','.join(reminder.times)}\t"
+                      f"{','.join(reminder.days)}\t{datetime.fromtimestamp(reminder.next_due):%Y-%m-%d %H:%M}\t"
+                      f"{reminder.text}")
+        else:
+            print(f"Removed {reminder_store.remove(args.ids)} reminders")
+    elif args.command == 'sessionbench':
+        print_session_benchmark(args.sessions)
+    elif args.command == 'migrate':
+        setup_logging()
+        summary = migrate_legacy_records(args.workers)
+        print(f"Migrated {summary['patients']} patients ({summary['records']} records) "
+              f"in {summary['seconds']:.1f}s, {summary['failed']} failed")
+        if summary['failed']:
+            raise SystemExit(1)
+    else:
+        main()
\ No newline at end of file
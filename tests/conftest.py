@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# HomeCare creates its data directory and opens its stores at import time,
+# relative to the working directory
+os.chdir(tempfile.mkdtemp(prefix="homecare-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
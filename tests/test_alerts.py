@@ -0,0 +1,380 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import Forbidden, RetryAfter
+
+import HomeCare as H
+
+
+class FakeBot:
+    """Records the messages sent; chats in `blocked` have blocked the bot."""
+
+    def __init__(self, blocked=()):
+        self.sent = []
+        self.blocked = set(blocked)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.blocked:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(message_id=len(self.sent))
+
+
+class FakeOutbox:
+    """Records what the coalescer and the digest queue instead of sending it."""
+
+    def __init__(self):
+        self.enqueued = []     # (alert ID, text, recipients, priority)
+        self.updates = []      # (alert ID, text, priority)
+        self.released = []
+        self.on_enqueue = None
+
+    async def enqueue(self, text, recipients, priority, editable=False):
+        alert_id = f"a{len(self.enqueued) + 1}"
+        self.enqueued.append((alert_id, text, list(recipients), priority))
+        if self.on_enqueue is not None:
+            await self.on_enqueue()
+        return alert_id
+
+    async def update(self, alert_id, text, priority):
+        self.updates.append((alert_id, text, priority))
+
+    def release(self, alert_id):
+        self.released.append(alert_id)
+
+
+async def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def logged_events(path, event):
+    return [entry for entry in H.read_lines(path) if entry.get('event') == event]
+
+
+# Alert outbox
+
+def test_outbox_replays_undelivered_alerts(tmp_path):
+    path = str(tmp_path / "outbox.jsonl")
+    bot = FakeBot()
+
+    async def run():
+        # Queued while the bot was down; one recipient got the first alert before a crash
+        outbox = H.AlertOutbox(path)
+        await outbox.enqueue("first", ["1", "2"])
+        await outbox.enqueue("second", ["1"])
+        first = logged_events(path, "queued")[0]['id']
+        H.append_lines(path, json.dumps({"event": "delivered", "id": first, "chat_id": "1"}).encode() + b"\n")
+
+        replayed = H.AlertOutbox(path)
+        await replayed.start(bot)
+        await wait_for(lambda: len(logged_events(path, "delivered")) == 2)
+        await replayed.stop()
+
+        restarted = H.AlertOutbox(path)
+        await restarted.start(bot)
+        await asyncio.sleep(0.05)
+        await restarted.stop()
+
+    asyncio.run(run())
+    assert sorted(bot.sent) == [("1", "second"), ("2", "first")]
+
+
+def test_outbox_compacts_the_drained_log(tmp_path, monkeypatch):
+    monkeypatch.setattr(H, 'ALERT_OUTBOX_COMPACT_SIZE', 0)
+    path = tmp_path / "outbox.jsonl"
+    bot = FakeBot()
+
+    async def run():
+        outbox = H.AlertOutbox(str(path))
+        await outbox.start(bot)
+        await outbox.enqueue("alert", ["1", "2"])
+        await wait_for(lambda: len(bot.sent) == 2 and path.stat().st_size == 0)
+        await outbox.stop()
+
+    asyncio.run(run())
+
+
+def test_outbox_keeps_an_alert_queued_during_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(H, 'ALERT_OUTBOX_COMPACT_SIZE', 0)
+    path = str(tmp_path / "outbox.jsonl")
+    outbox = H.AlertOutbox(path)
+    append = outbox._append
+
+    def append_then_deliver(events):
+        append(events)
+        # The last delivery of another alert is logged right after this append
+        outbox._mark_delivered("earlier", "1")
+
+    outbox._append = append_then_deliver
+    alert_id = asyncio.run(outbox.enqueue("alert", ["1"]))
+    assert [event['id'] for event in logged_events(path, "queued")] == [alert_id]
+
+
+def test_outbox_escalates_undeliverable_alerts(tmp_path, monkeypatch):
+    monkeypatch.setattr(H, 'DOCTOR1_CHAT_ID', "d1")
+    monkeypatch.setattr(H, 'DOCTOR2_CHAT_ID', "d2")
+    path = str(tmp_path / "outbox.jsonl")
+    bot = FakeBot(blocked={"3", "d2"})
+
+    async def run():
+        outbox = H.AlertOutbox(path, retry_base=0.01)
+        await outbox.start(bot)
+        await outbox.enqueue("alert", ["3"])
+        await wait_for(lambda: len(logged_events(path, "delivered")) == 3)
+        await outbox.stop()
+
+    asyncio.run(run())
+    # Permanent errors are not retried, and an escalation is not escalated again
+    assert [(chat_id, text.splitlines()[0]) for chat_id, text in bot.sent] == [
+        ("d1", "⚠️ Undeliverable to chat 3 (Forbidden: bot was blocked by the user):")]
+    assert sorted(event.get('error', "") for event in logged_events(path, "delivered")) == [
+        "", "Forbidden: bot was blocked by the user", "Forbidden: bot was blocked by the user"]
+
+
+# Outbound rate limiting
+
+def limited_send(limiter, log, name, chat_id, priority=H.PRIORITY_ROUTINE):
+    async def send():
+        log.append(name)
+    return asyncio.create_task(limiter.process_request(
+        send, (), {}, "sendMessage", {"chat_id": chat_id}, {"priority": priority}))
+
+
+def test_rate_limiter_serves_urgent_requests_first():
+    limiter = H.PriorityRateLimiter(chat_rate=20, chat_burst=1)
+    sent = []
+
+    async def run():
+        await limiter.initialize()
+        tasks = []
+        for name, priority in (("menu1", H.PRIORITY_ROUTINE), ("menu2", H.PRIORITY_ROUTINE),
+                               ("menu3", H.PRIORITY_ROUTINE), ("alert", H.PRIORITY_CRITICAL)):
+            tasks.append(limited_send(limiter, sent, name, 1, priority))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        await limiter.shutdown()
+
+    asyncio.run(run())
+    assert sent == ["menu1", "alert", "menu2", "menu3"]
+
+
+def test_rate_limiter_does_not_hold_up_other_chats():
+    limiter = H.PriorityRateLimiter(chat_rate=1, chat_burst=1)
+    sent = []
+
+    async def run():
+        await limiter.initialize()
+        busy = [limited_send(limiter, sent, f"busy{i}", 1) for i in range(3)]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(limited_send(limiter, sent, "other", 2), 0.5)
+        await limiter.shutdown()
+        for task in busy:
+            task.cancel()
+        await asyncio.gather(*busy, return_exceptions=True)
+
+    asyncio.run(run())
+    assert sent == ["busy0", "other"]
+
+
+def test_rate_limiter_retries_after_a_flood_wait():
+    limiter = H.PriorityRateLimiter()
+    attempts = []
+
+    async def send():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RetryAfter(0)
+        return "sent"
+
+    async def run():
+        await limiter.initialize()
+        try:
+            return await limiter.process_request(send, (), {}, "sendMessage", {"chat_id": 1}, None)
+        finally:
+            await limiter.shutdown()
+
+    assert asyncio.run(run()) == "sent"
+    assert len(attempts) == 2
+
+
+# Clinical rules
+
+def test_rules_file_overrides_per_patient(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({
+        "rules": H.DEFAULT_RULES["rules"] + [
+            {"id": "low_spirits", "type": "emotional_assessment", "field": "score", "op": ">=", "value": 10}],
+        "patients": {"7": {"ranges": {"heart_rate": {"max": 160}}, "rules": {"low_spirits": {"enabled": False}}}},
+    }))
+    engine = H.RuleEngine(str(path), poll_interval=0)
+    fast_pulse = {"type": "vital_sign", "parameter": "heart_rate", "value": 150}
+    assert [finding.rule for finding in engine.evaluate(1, fast_pulse)] == ["range"]
+    assert engine.evaluate(7, fast_pulse) == []
+    anxious = {"type": "emotional_assessment", "score": 12}
+    assert [finding.rule for finding in engine.evaluate(1, anxious)] == ["low_spirits"]
+    assert engine.evaluate(7, anxious) == []
+
+
+def test_invalid_rules_file_keeps_the_rules_in_force(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"patients": {"7": {"ranges": {"heart_rate": {"max": 160}}}}}))
+    engine = H.RuleEngine(str(path), poll_interval=0)
+    path.write_text(json.dumps({"rules": [{"id": "broken", "type": "*", "field": "x", "op": "~"}]}))
+    with pytest.raises(ValueError):
+        engine.load()
+    assert engine.vital_range(7, "heart_rate")["max"] == 160
+
+
+def test_invalid_rules_file_at_startup_uses_the_defaults(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text("{not json")
+    engine = H.RuleEngine(str(path), poll_interval=0)
+    assert engine.config["rules"] == H.DEFAULT_RULES["rules"]
+
+
+@pytest.mark.parametrize("record_type,fields,priority", [
+    ("gastrointestinal", {"description": "constipation"}, H.PRIORITY_ROUTINE),
+    ("sleep_position", {"description": "side"}, H.PRIORITY_ROUTINE),
+    ("gastrointestinal", {"description": "fever"}, H.PRIORITY_ALERT),
+    ("respiratory", {"description": "more_30_beats"}, H.PRIORITY_ALERT),
+    ("sleep_position", {"description": "two_pillows"}, H.PRIORITY_ALERT),
+    ("diet_compliance", {"description": "side"}, H.PRIORITY_ALERT),
+    ("respiratory", {"description": "no_breadthe"}, H.PRIORITY_CRITICAL),
+    ("qor_assessment", {"score": 20}, H.PRIORITY_ALERT),
+    ("qor_assessment", {"score": 31}, H.PRIORITY_ROUTINE),
+    ("qor_assessment", {"score": 80}, H.PRIORITY_ROUTINE),
+])
+def test_default_rule_priorities(record_type, fields, priority):
+    findings = H.rule_engine.evaluate(1, dict(fields, type=record_type))
+    assert min(finding.priority for finding in findings) == priority
+
+
+# Care teams
+
+def care_teams(tmp_path, config):
+    path = tmp_path / "care_teams.json"
+    path.write_text(json.dumps(config))
+    return H.CareTeams(str(path), poll_interval=0)
+
+
+def test_recipients_follow_the_shifts(tmp_path):
+    teams = care_teams(tmp_path, {"teams": {"a": {
+        "patients": [5], "escalation": ["head"],
+        "shifts": [{"start": "08:00", "end": "20:00", "on_call": ["day"]},
+                   {"start": "20:00", "end": "08:00", "on_call": ["night"], "days": ["mon"]}],
+    }}})
+    monday = datetime(2026, 10, 19)
+    assert teams.recipients(5, now=monday.replace(hour=9)) == ["day"]
+    assert teams.recipients(5, H.PRIORITY_CRITICAL, now=monday.replace(hour=9)) == ["day", "head"]
+    assert teams.recipients(5, now=monday.replace(hour=23)) == ["night"]
+    assert teams.recipients(5, now=datetime(2026, 10, 21, 3)) == ["head"]
+
+
+def test_recipients_fall_back_to_the_doctors(tmp_path, monkeypatch):
+    monkeypatch.setattr(H, 'DOCTOR1_CHAT_ID', "doctor1")
+    monkeypatch.setattr(H, 'DOCTOR2_CHAT_ID', "doctor2")
+    teams = care_teams(tmp_path, {"teams": {"a": {
+        "patients": [5], "shifts": [{"start": "08:00", "end": "20:00", "on_call": ["day"]}],
+    }}})
+    assert teams.recipients(5, now=datetime(2026, 10, 19, 23)) == ["doctor1", "doctor2"]
+    assert teams.recipients(6) == ["doctor1", "doctor2"]
+
+
+def test_invalid_care_teams_file_at_startup_uses_the_defaults(tmp_path):
+    teams = care_teams(tmp_path, {"teams": {"a": {"shifts": [{"start": "25:00", "end": "08:00", "on_call": []}]}}})
+    assert teams.teams == {}
+
+
+# Alert coalescing
+
+def submit_all(coalescer, priorities):
+    async def run():
+        for priority in priorities:
+            await coalescer.submit((1, "heart_rate"), "Patient ID: 1", "Value: 150", ["doctor"], priority)
+    asyncio.run(run())
+
+
+def test_coalescer_merges_repeats():
+    outbox = FakeOutbox()
+    submit_all(H.AlertCoalescer(outbox, window=60), [H.PRIORITY_ALERT] * 3)
+    assert len(outbox.enqueued) == 1
+    assert [alert_id for alert_id, _, _ in outbox.updates] == ["a1", "a1"]
+    assert "3 reports" in outbox.updates[-1][1]
+
+
+def test_coalescer_never_merges_critical():
+    outbox = FakeOutbox()
+    submit_all(H.AlertCoalescer(outbox, window=60),
+               [H.PRIORITY_ALERT, H.PRIORITY_CRITICAL, H.PRIORITY_CRITICAL, H.PRIORITY_ALERT])
+    assert [priority for _, _, _, priority in outbox.enqueued] == [
+        H.PRIORITY_ALERT, H.PRIORITY_CRITICAL, H.PRIORITY_CRITICAL]
+    # The last, less urgent alert is folded into the open critical message
+    assert outbox.updates[-1][0] == "a3"
+
+
+def test_coalescer_disabled():
+    outbox = FakeOutbox()
+    submit_all(H.AlertCoalescer(outbox, window=0), [H.PRIORITY_ALERT] * 2)
+    assert len(outbox.enqueued) == 2 and not outbox.updates
+
+
+# Doctor digest
+
+def finding(parameter, value):
+    return H.RuleFinding("routine_symptom", parameter, value, None, H.PRIORITY_ROUTINE)
+
+
+def test_digest_format_counts_repeats():
+    digest = H.DoctorDigest(FakeOutbox(), path="unused")
+    entries = [
+        {"seq": i, "patient_id": 7, "time": f"2026-10-19T0{i}:00:00",
+         "findings": [["gastrointestinal", "constipation", None]]}
+        for i in range(1, 4)
+    ]
+    (text,) = digest.format(entries, "cardiac_a")
+    assert text.startswith("📋 DIGEST since 19.10 01:00 (cardiac_a)")
+    assert "03:00 gastrointestinal: constipation ×3" in text
+
+
+def test_digest_format_splits_long_digests():
+    digest = H.DoctorDigest(FakeOutbox(), path="unused")
+    entries = [{"seq": i, "patient_id": i, "time": "2026-10-19T08:00:00",
+                "findings": [["diet", "x" * 200, None]]} for i in range(100)]
+    messages = digest.format(entries)
+    assert len(messages) > 1
+    assert all(len(text) <= H.TELEGRAM_MESSAGE_LIMIT for text in messages)
+
+
+def test_digest_send_keeps_findings_added_meanwhile(tmp_path):
+    outbox = FakeOutbox()
+    digest = H.DoctorDigest(outbox, path=str(tmp_path / "digest.jsonl"))
+
+    async def run():
+        await digest.add(1, [finding("gastrointestinal", "constipation")])
+        outbox.on_enqueue = lambda: digest.add(2, [finding("sleep_pattern", "short_time")])
+        assert await digest.send() == 1
+        outbox.on_enqueue = None
+
+    asyncio.run(run())
+    assert "constipation" in outbox.enqueued[0][1]
+    assert [entry['patient_id'] for entry in digest._entries] == [2]
+    assert [entry['patient_id'] for entry in digest._load()] == [2]
+
+
+def test_patient_is_told_who_reviews_the_findings(monkeypatch):
+    monkeypatch.setattr(H.doctor_digest, 'interval_hours', 4)
+    routine = [finding("gastrointestinal", "constipation")]
+    urgent = H.rule_engine.evaluate(1, {"type": "gastrointestinal", "description": "fever"})
+    assert H.findings_notice([]) == ""
+    assert H.findings_notice(routine) == "\nYour care team will review this."
+    assert H.findings_notice(routine + urgent) == "\nA doctor has been notified."
+    # Without a digest every finding is alerted at once
+    monkeypatch.setattr(H.doctor_digest, 'interval_hours', 0)
+    assert H.findings_notice(routine) == "\nA doctor has been notified."
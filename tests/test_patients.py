@@ -0,0 +1,68 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import HomeCare as H
+
+
+# Questionnaire answers
+
+def test_parse_answers():
+    assert H.parse_answers("1 2,3", 3, 3) == [1, 2, 3]
+    assert H.parse_answers("10, 0", 2, 10) == [10, 0]
+
+
+@pytest.mark.parametrize("text", ["1 2", "1 2 3 4", "1 2 4", "1 -2 3", "1 2.0 3"])
+def test_parse_answers_rejects(text):
+    with pytest.raises(ValueError):
+        H.parse_answers(text, 3, 3)
+
+
+@pytest.mark.parametrize("text", ["1 ٢ 3", "1 ² 3"])
+def test_parse_answers_rejects_non_ascii_digits(text):
+    with pytest.raises(ValueError):
+        H.parse_answers(text, 3, 3)
+
+
+def test_looks_like_answers():
+    assert H.looks_like_answers("1 2 3")
+    assert not H.looks_like_answers("3")
+    assert not H.looks_like_answers("١ ٢ ٣")
+    assert not H.looks_like_answers("I feel fine")
+
+
+# Vital signs
+
+def test_vital_sign_entry_rejects_non_finite_values():
+    replies = []
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    message = SimpleNamespace(reply_text=reply_text)
+    context = SimpleNamespace(user_data=SimpleNamespace(patient_id=1, current_vital="heart_rate"))
+    for text in ("nan", "inf", "-Infinity", "fast"):
+        message.text = text
+        state = asyncio.run(H.enter_vital_sign_value(SimpleNamespace(message=message), context))
+        assert state == H.ENTER_VITAL_SIGN_VALUE
+    assert replies == ["Please enter a valid number. Try again:"] * 4
+
+
+# Reminders
+
+def test_reminder_minutes():
+    assert H.reminder_minutes(["20:00", "08:00"], ["thu", "mon"]) == [480, 1200, 3 * 1440 + 480, 3 * 1440 + 1200]
+    for times, days in ((["08:00"], ["someday"]), (["24:00"], ["mon"]), (["25:00"], ["mon"]), ([], ["mon"])):
+        with pytest.raises(ValueError):
+            H.reminder_minutes(times, days)
+
+
+def test_next_occurrence():
+    minutes = H.reminder_minutes(["08:00", "20:00"], ["mon", "thu"])
+    monday = datetime(2026, 10, 19)
+    assert H.next_occurrence(minutes, monday.replace(hour=7, minute=59)) == monday.replace(hour=8)
+    # Strictly after the minute of `after`, so a reminder sent at 08:00 moves on
+    assert H.next_occurrence(minutes, monday.replace(hour=8, second=30)) == monday.replace(hour=20)
+    assert H.next_occurrence(minutes, datetime(2026, 10, 22, 21, 0)) == datetime(2026, 10, 26, 8, 0)
@@ -0,0 +1,282 @@
+import asyncio
+import csv
+import json
+import os
+
+import pytest
+
+import HomeCare as H
+
+
+def vital(timestamp, value=80.0, parameter="heart_rate", out_of_range=False):
+    return {"type": "vital_sign", "parameter": parameter, "value": value, "unit": "bpm",
+            "timestamp": timestamp, "out_of_range": out_of_range}
+
+
+def hourly(count, start_day=1):
+    """`count` timestamps an hour apart from October `start_day`, 2026."""
+    return [f"2026-10-{start_day + i // 24:02d}T{i % 24:02d}:00:00" for i in range(count)]
+
+
+@pytest.fixture(params=["jsonl", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "jsonl":
+        store = H.JsonlRecordStore(str(tmp_path))
+    else:
+        store = H.SqliteRecordStore(str(tmp_path / "records.db"))
+    yield store
+    store.close()
+
+
+# Record stores
+
+def test_jsonl_log_skips_torn_lines(tmp_path):
+    store = H.JsonlRecordStore(str(tmp_path))
+    store.append(1, {"type": "diet_compliance", "timestamp": "2026-10-19T08:00:00"})
+    with open(store.log_path(1), 'ab') as f:
+        f.write(b'{"type": "sle')     # a write torn by a crash
+    store.append(1, {"type": "sleep_pattern", "timestamp": "2026-10-19T09:00:00"})
+    assert [record['type'] for record in store.records(1)] == ["diet_compliance", "sleep_pattern"]
+
+
+def test_jsonl_legacy_records_come_first(tmp_path):
+    store = H.JsonlRecordStore(str(tmp_path))
+    with open(store.legacy_path(1), 'w') as f:
+        json.dump({"records": [{"type": "shower", "timestamp": "2026-10-01T08:00:00"}]}, f)
+    store.append(1, {"type": "driving", "timestamp": "2026-10-19T08:00:00"})
+    assert [record['type'] for record in store.records(1)] == ["shower", "driving"]
+    assert store.patient_ids() == [1]
+
+
+def test_store_round_trip(store):
+    records = [vital(timestamp) for timestamp in hourly(3)]
+    store.append_many([(1, records[0]), (2, records[1])])
+    store.append(1, records[2])
+    store.flush()
+    assert list(store.records(1)) == [records[0], records[2]]
+    assert store.patient_ids() == [1, 2]
+    found = store.query(record_type="vital_sign", since=records[1]['timestamp'])
+    assert sorted(found, key=lambda item: item[1]['timestamp']) == [(2, records[1]), (1, records[2])]
+
+
+def test_store_query_filters(store):
+    timestamps = hourly(48)
+    for i, timestamp in enumerate(timestamps):
+        store.append(i % 2 + 1, vital(timestamp) if i % 3 else {"type": "diet_compliance", "timestamp": timestamp})
+    store.flush()
+    since, until = timestamps[10], timestamps[30]
+    found = [(pid, record['timestamp']) for pid, record in store.query(1, "vital_sign", since, until)]
+    expected = [(1, timestamp) for i, timestamp in enumerate(timestamps)
+                if i % 2 == 0 and i % 3 and since <= timestamp < until]
+    assert sorted(found) == expected
+    assert len(list(store.query(record_type=["vital_sign", "diet_compliance"]))) == 48
+
+
+# Group-commit writer
+
+@pytest.mark.parametrize("durability", ["buffered", "commit"])
+def test_writer_writes_every_record(tmp_path, durability):
+    store = H.JsonlRecordStore(str(tmp_path))
+    writer = H.RecordWriter(store, durability=durability, batch_size=10)
+    records = [vital(timestamp) for timestamp in hourly(50)]
+
+    async def run():
+        await writer.start()
+        await asyncio.gather(*(writer.submit(i % 5, record) for i, record in enumerate(records)))
+        if durability == "commit":
+            # Acknowledged records are already in the store
+            assert sum(len(list(store.records(pid))) for pid in range(5)) == 50
+        await writer.stop()
+
+    asyncio.run(run())
+    assert [record for pid in range(5) for record in store.records(pid)] == [
+        record for pid in range(5) for record in records[pid::5]]
+
+
+def test_writer_sets_aside_records_it_cannot_write(tmp_path, monkeypatch):
+    unwritten = tmp_path / "unwritten.jsonl"
+    monkeypatch.setattr(H, 'UNWRITTEN_RECORDS_PATH', str(unwritten))
+
+    class BrokenStore:
+        def append_many(self, items):
+            raise OSError("disk full")
+
+    writer = H.RecordWriter(BrokenStore(), durability="commit", retries=0)
+    record = vital("2026-10-19T08:00:00")
+
+    async def run():
+        await writer.start()
+        with pytest.raises(OSError):
+            await writer.submit(7, record)
+        await writer.stop()
+
+    asyncio.run(run())
+    assert list(H.read_lines(str(unwritten))) == [{"patient_id": 7, "record": record}]
+
+
+# Vital sign aggregates
+
+def test_vital_aggregate_is_updated_incrementally():
+    aggregate = None
+    for value, out_of_range in ((80, False), (120, True), (130, True), (90, False)):
+        aggregate = H.update_vital_aggregate(aggregate, vital("2026-10-19T08:00:00", value, out_of_range=out_of_range))
+    assert aggregate['count'] == 4
+    assert (aggregate['min'], aggregate['max'], aggregate['mean']) == (80, 130, 105)
+    assert aggregate['ewma'] == pytest.approx(99.38)
+    assert aggregate['last_value'] == 90
+    assert (aggregate['out_of_range_streak'], aggregate['longest_out_of_range_streak']) == (0, 2)
+
+
+def test_vital_aggregate_skips_non_finite_readings():
+    aggregate = H.update_vital_aggregate(None, vital("2026-10-19T08:00:00", 80.0))
+    for value in (float('nan'), float('inf'), float('-inf')):
+        assert H.update_vital_aggregate(aggregate, vital("2026-10-19T09:00:00", value)) == aggregate
+    assert H.update_vital_aggregate(None, vital("2026-10-19T09:00:00", float('nan'))) is None
+    records = [vital("2026-10-19T08:00:00", 80.0), vital("2026-10-19T09:00:00", float('nan'))]
+    assert H.fold_vital_records({}, records) == {"heart_rate": aggregate}
+
+
+def test_fold_vital_records_ignores_other_records():
+    records = [vital("2026-10-19T08:00:00", 36.6, "temperature"),
+               {"type": "vital_sign", "parameter": "mood", "value": 3},
+               {"type": "diet_compliance", "description": "no"}]
+    assert list(H.fold_vital_records({}, records)) == ["temperature"]
+
+
+def test_store_vital_summary(store):
+    records = [vital(timestamp, value) for timestamp, value in zip(hourly(4), (70, 80, 90, 100))]
+    store.append_many([(1, record) for record in records[:3]])
+    store.append(1, records[3])
+    store.append(2, vital("2026-10-19T08:00:00", 36.6, "temperature"))
+    summary = store.vital_summary(1)
+    assert list(summary) == ["heart_rate"]
+    assert summary['heart_rate'] == H.fold_vital_records({}, records)['heart_rate']
+
+
+def test_store_vital_summary_skips_non_finite_readings(store):
+    values = (70, float('nan'), 90, float('inf'))
+    store.append_many([(1, vital(timestamp, value)) for timestamp, value in zip(hourly(4), values)])
+    store.append(1, vital("2026-10-02T00:00:00", float('-inf')))
+    summary = store.vital_summary(1)['heart_rate']
+    assert (summary['count'], summary['mean'], summary['max']) == (2, 80, 90)
+
+
+def test_jsonl_vital_summary_catches_up_after_a_crash(tmp_path):
+    store = H.JsonlRecordStore(str(tmp_path))
+    store.append(1, vital("2026-10-19T08:00:00", 70))
+    assert store.vital_summary(1)['heart_rate']['count'] == 1
+    # Appended to the log, but the stats file was never written
+    H.append_lines(store.log_path(1), json.dumps(vital("2026-10-19T09:00:00", 90)).encode() + b"\n")
+    assert H.JsonlRecordStore(str(tmp_path)).vital_summary(1)['heart_rate']['mean'] == 80
+    os.remove(store.stats_path(1))
+    assert H.JsonlRecordStore(str(tmp_path)).vital_summary(1)['heart_rate']['count'] == 2
+
+
+# Time-range queries
+
+def test_sparse_index_seeks_to_the_window(tmp_path):
+    store = H.JsonlRecordStore(str(tmp_path))
+    store.append_many([(1, vital(timestamp)) for timestamp in hourly(24 * 10)])
+    index = H.SparseLogIndex(str(tmp_path / "heart.idx"), store.log_path(1), interval=8)
+    index.load()
+    start, stop = index.span("2026-10-05T00:00:00", "2026-10-06T00:00:00")
+    with open(store.log_path(1), 'rb') as f:
+        f.seek(start)
+        scanned = [json.loads(line)['timestamp'] for line in f.read(stop - start).splitlines()]
+    assert [t for t in scanned if t.startswith("2026-10-05")] == hourly(24, start_day=5)
+    assert len(scanned) <= 24 + 2 * 8
+
+
+def test_jsonl_query_with_out_of_order_and_unindexed_records(tmp_path):
+    store = H.JsonlRecordStore(str(tmp_path))
+    timestamps = hourly(300)
+    shuffled = timestamps[::2] + timestamps[1::2]
+    for chunk in range(0, 200, 50):
+        store.append_many([(1, vital(timestamp)) for timestamp in shuffled[chunk:chunk + 50]])
+    # Lines the index has not seen yet, as after a crash
+    H.append_lines(store.log_path(1), b"".join(
+        json.dumps(vital(timestamp)).encode() + b"\n" for timestamp in shuffled[200:]))
+    since, until = timestamps[100], timestamps[180]
+    for reader in (store, H.JsonlRecordStore(str(tmp_path))):
+        found = [record['timestamp'] for _, record in reader.query(1, since=since, until=until)]
+        assert sorted(found) == timestamps[100:180]
+    os.remove(store.index_path(1))
+    found = [record['timestamp'] for _, record in H.JsonlRecordStore(str(tmp_path)).query(1, since=since)]
+    assert sorted(found) == timestamps[100:]
+
+
+# Bulk export
+
+def test_export_writes_one_table_per_record_type(tmp_path, monkeypatch):
+    data = tmp_path / "data"
+    data.mkdir()
+    monkeypatch.setattr(H, 'DATA_DIR', str(data))
+    monkeypatch.setattr(H, 'RECORD_STORE', "jsonl")
+    store = H.JsonlRecordStore(str(data))
+    store.append(1, vital("2026-10-19T08:00:00", 72))
+    store.append(2, {"type": "qor_assessment", "timestamp": "2026-10-19T09:00:00", "score": 120,
+                     "interpretation": "Good recovery", "answers": [8] * 15})
+    store.append(2, {"type": "respiratory", "timestamp": "2026-10-19T10:00:00", "description": "cough"})
+
+    out = tmp_path / "export"
+    counts = H.export_patients(str(out), "csv", 0, [1, 2])
+    assert counts == {"vital_sign": 1, "qor_assessment": 1, "respiratory": 1}
+    for table in counts:
+        H.merge_csv_parts(str(out), table)
+    with open(out / "qor_assessment.csv", newline='') as f:
+        (row,) = csv.DictReader(f)
+    assert (row['patient_id'], row['score'], row['q1'], row['q15']) == ("2", "120", "8", "8")
+    with open(out / "vital_sign.csv", newline='') as f:
+        (row,) = csv.DictReader(f)
+    assert (row['parameter'], row['value'], row['out_of_range']) == ("heart_rate", "72", "False")
+
+
+# Legacy migration
+
+def write_legacy(directory, patient_id, records):
+    path = os.path.join(directory, f"patient_{patient_id}.json")
+    with open(path, 'w') as f:
+        json.dump({"records": records}, f)
+    return path
+
+
+LEGACY_RECORDS = [vital("2026-10-01T08:00:00", 70), {"type": "shower", "timestamp": "2026-10-01T09:00:00"}]
+NEW_RECORD = vital("2026-10-19T08:00:00", 90)
+
+
+def test_jsonl_migration_can_be_run_again(tmp_path):
+    store = H.JsonlRecordStore(str(tmp_path))
+    store.append(1, NEW_RECORD)
+    legacy = write_legacy(str(tmp_path), 1, LEGACY_RECORDS)
+    result = H.migrate_patient_jsonl(str(tmp_path), 1)
+    assert (result['status'], result['records']) == ("migrated", 2)
+    assert os.path.exists(legacy + ".migrated")
+
+    # Interrupted after the log was replaced but before the file was renamed
+    os.replace(legacy + ".migrated", legacy)
+    assert H.migrate_patient_jsonl(str(tmp_path), 1)['status'] == "verified"
+    store = H.JsonlRecordStore(str(tmp_path))
+    assert list(store.records(1)) == LEGACY_RECORDS + [NEW_RECORD]
+    assert store.vital_summary(1)['heart_rate']['count'] == 2
+
+
+def test_sqlite_migration_can_be_run_again(tmp_path):
+    path = str(tmp_path / "records.db")
+    H.prepare_sqlite_migration(path)
+    store = H.SqliteRecordStore(path)
+    store.append(1, NEW_RECORD)
+    store.close()
+    legacy = write_legacy(str(tmp_path), 1, LEGACY_RECORDS)
+    assert H.migrate_patient_sqlite(path, str(tmp_path), 1)['status'] == "migrated"
+
+    os.replace(legacy + ".migrated", legacy)
+    assert H.migrate_patient_sqlite(path, str(tmp_path), 1)['status'] == "verified"
+    store = H.SqliteRecordStore(path)
+    assert list(store.records(1)) == LEGACY_RECORDS + [NEW_RECORD]
+    assert store.vital_summary(1)['heart_rate']['count'] == 2
+    store.close()
+
+    # A different file for a patient already migrated is refused
+    write_legacy(str(tmp_path), 1, LEGACY_RECORDS[:1])
+    with pytest.raises(RuntimeError):
+        H.migrate_patient_sqlite(path, str(tmp_path), 1)
@@ -0,0 +1,157 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import HomeCare as H
+
+
+# Duplicate updates
+
+def test_recent_keys_forgets_oldest():
+    recent = H.RecentKeys(3)
+    for key in "abcd":
+        recent.add(key)
+    assert len(recent) == 3
+    assert not recent.seen("a")
+    assert all(recent.seen(key) for key in "bcd")
+    recent.add("b")            # already there: refreshed, nothing evicted
+    assert len(recent) == 3 and recent.seen("c")
+
+
+def test_recent_keys_max_age(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(H.time, 'monotonic', lambda: now[0])
+    recent = H.RecentKeys(10)
+    recent.add("tap")
+    now[0] += 2
+    assert recent.seen("tap", max_age=3)
+    now[0] += 2
+    assert not recent.seen("tap", max_age=3)
+    assert recent.seen("tap")
+
+
+# Profiling
+
+@pytest.mark.parametrize("mode,value", [
+    ("sample", 0.5), ("sample", 0), ("window", -1), ("window", float('nan')), ("bogus", 10),
+])
+def test_profiler_rejects_invalid_start(tmp_path, mode, value):
+    profiler = H.UpdateProfiler(str(tmp_path))
+    with pytest.raises(ValueError):
+        profiler.start(mode, value)
+    assert not profiler.enabled
+
+
+def test_profiler_runs_unsampled_calls_concurrently(tmp_path):
+    profiler = H.UpdateProfiler(str(tmp_path))
+
+    async def handler(started, other):
+        started.set()
+        await other.wait()
+
+    async def run():
+        profiler.start("sample", 1000)
+        first, second = asyncio.Event(), asyncio.Event()
+        # Each handler waits for the other, so run one at a time they never finish
+        await asyncio.wait_for(asyncio.gather(
+            profiler.call(lambda update, context: handler(first, second), SimpleNamespace(update_id=1), None),
+            profiler.call(lambda update, context: handler(second, first), SimpleNamespace(update_id=2), None),
+        ), 1)
+        profiler.stop()
+
+    asyncio.run(run())
+
+
+def test_profiler_runs_sampled_calls_alone(tmp_path):
+    profiler = H.UpdateProfiler(str(tmp_path))
+    log = []
+
+    async def handler(update, context):
+        log.append(("start", update.update_id))
+        await asyncio.sleep(0.02)
+        log.append(("end", update.update_id))
+
+    async def run():
+        profiler.start("sample", 2)
+        tasks = []
+        for update_id in (1, 2, 3):     # the second update is sampled
+            tasks.append(asyncio.create_task(profiler.call(handler, SimpleNamespace(update_id=update_id), None)))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return profiler.stop()
+
+    assert asyncio.run(run()).endswith(".prof")
+    assert log == [("start", 1), ("end", 1), ("start", 2), ("end", 2), ("start", 3), ("end", 3)]
+
+
+def test_profiler_reports_finished_window(tmp_path):
+    profiler = H.UpdateProfiler(str(tmp_path))
+    reports = []
+
+    async def report(path):
+        reports.append(path)
+
+    async def run():
+        profiler.start("window", 0.05, on_window_end=report)
+        sum(i * i for i in range(10000))
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    assert not profiler.enabled
+    assert len(reports) == 1 and reports[0].endswith(".prof")
+
+
+# Metrics
+
+def test_metrics_render():
+    registry = H.MetricsRegistry()
+    sends = registry.register(H.Counter("sends_total", "Messages sent.", ("result",)))
+    latency = registry.register(H.Histogram("latency_seconds", "Time taken.", buckets=(0.125, 1)))
+    sends.inc(("ok",))
+    sends.inc(('say "hi"\n',), 2)
+    for seconds in (0.0625, 0.125, 0.5, 4):
+        latency.observe(seconds)
+    assert registry.render().splitlines() == [
+        "# HELP sends_total Messages sent.",
+        "# TYPE sends_total counter",
+        'sends_total{result="ok"} 1',
+        'sends_total{result="say \\"hi\\"\\n"} 2',
+        "# HELP latency_seconds Time taken.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.125"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 4.6875",
+        "latency_seconds_count 4",
+    ]
+
+
+# Update processing
+
+def chat_update(chat_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id))
+
+
+def test_updates_of_a_chat_are_processed_in_order():
+    processor = H.ChatOrderedUpdateProcessor(workers=4)
+    log = []
+
+    async def handle(name, release=None):
+        log.append(("start", name))
+        if release is not None:
+            await release.wait()
+        log.append(("end", name))
+
+    async def run():
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(processor.do_process_update(chat_update(chat), handle(name, wait)))
+                 for chat, name, wait in ((1, "a1", release), (1, "a2", None), (2, "b1", None))]
+        await asyncio.sleep(0.05)
+        # A slow handler holds up its own chat only
+        assert ("end", "b1") in log and ("start", "a2") not in log
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert log.index(("end", "a1")) < log.index(("start", "a2"))